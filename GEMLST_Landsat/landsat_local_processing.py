@@ -0,0 +1,327 @@
+'''
+# landsat_local_processing.py
+Local (NumPy/rasterio) version of the Landsat Collection 2 Level 2 surface temperature
+preparation done in Earth Engine by maskL8sr/maskL457sr, so archived scenes can be
+reprocessed on our own machines without Earth Engine quotas.
+
+## Functionality
+- Cloud/saturation masking: QA_PIXEL bits 0-4 (fill, dilated cloud, cirrus/unused, cloud,
+  cloud shadow) must be 0 and QA_RADSAT must be 0, decoded with vectorized bit operations
+- ST scaling: ST_B10 (Landsat 8/9) or ST_B6 (Landsat 4/5/7) DN * 0.00341802 + 149.0 (K),
+  computed in float32 into a preallocated block buffer, masked pixels set to NaN
+- Block processing: scenes are read and written window by window, so memory use does not
+  depend on the scene size
+- Scenes are processed in parallel with a thread pool (GDAL reads/writes and the NumPy
+  kernels release the GIL)
+- CalibrationKernel: DN -> calibrated °C in one step. The ST scaling, the Kelvin offset
+  and the land/ocean(/ice) calibration of GEMLST_Landsat.js are folded into one
+  precomputed affine (gain, bias) per mask class, applied blockwise in float32 with
+  in-place ufuncs and threads, so a whole scene needs the float32 output plus a small
+  scratch block per thread instead of several full float64 copies
+
+## Input
+Scene folders of the USGS Collection 2 Level 2 product, e.g.
+LC08_L2SP_008011_20200715_20200912_02_T1/
+    LC08_L2SP_008011_20200715_20200912_02_T1_ST_B10.TIF
+    LC08_L2SP_008011_20200715_20200912_02_T1_QA_PIXEL.TIF
+    LC08_L2SP_008011_20200715_20200912_02_T1_QA_RADSAT.TIF
+
+## Output
+One float32 GeoTIFF per scene (<product_id>_ST.tif, Kelvin, NaN = masked), tiled and
+deflate-compressed, on the grid of the input scene.
+'''
+#%%
+import os
+import sys
+import glob
+import threading
+import concurrent.futures
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from tqdm import tqdm
+
+# ===== CONFIGURE THESE PATHS =====
+scene_root = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/Landsat_LST/data/L2_scenes"
+output_dir = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/Landsat_LST/data/L2_ST"
+# =================================
+
+QA_PIXEL_MASK_BITS = 0b11111        # bits 0-4: fill, dilated cloud, cirrus/unused, cloud, cloud shadow
+ST_SCALE = np.float32(0.00341802)
+ST_OFFSET = np.float32(149.0)
+
+# Mask classes of the calibration (as in GEMLST_Landsat.js: ocean, land and ice)
+MASK_OCEAN, MASK_LAND, MASK_ICE = 0, 1, 2
+KELVIN = 273.15
+script_dir = os.path.dirname(os.path.abspath(__file__))
+calibfile_land = os.path.join(script_dir, "landsat_calibration_parameters.txt")
+calibfile_ocean = os.path.join(script_dir, "landsat_SSTcalibration_parameters.txt")
+
+# Thermal band per sensor, keyed by the first four characters of the product ID
+THERMAL_BANDS = {'LC08': 'ST_B10', 'LC09': 'ST_B10', 'LE07': 'ST_B6', 'LT05': 'ST_B6', 'LT04': 'ST_B6'}
+
+#%% functions
+def qa_clear_mask(qa_pixel, qa_radsat):
+    """
+    Decode the clear-pixel mask from the QA bands (maskL8sr/maskL457sr in Earth Engine).
+
+    Parameters:
+    -----------
+    qa_pixel : numpy.ndarray
+        QA_PIXEL band (uint16)
+    qa_radsat : numpy.ndarray
+        QA_RADSAT band (uint16)
+
+    Returns:
+    --------
+    numpy.ndarray
+        Boolean mask, True where the pixel is clear and not saturated
+    """
+    return ((qa_pixel & QA_PIXEL_MASK_BITS) == 0) & (qa_radsat == 0)
+
+def scale_st(st_dn, out=None):
+    """
+    Scale ST DN values to Kelvin in float32 (DN * 0.00341802 + 149.0).
+
+    Parameters:
+    -----------
+    st_dn : numpy.ndarray
+        ST_B10/ST_B6 digital numbers
+    out : numpy.ndarray, optional
+        float32 buffer of the same shape to write the result into
+
+    Returns:
+    --------
+    numpy.ndarray
+        Surface temperature in K (float32)
+    """
+    out = np.multiply(st_dn, ST_SCALE, out=out, dtype=np.float32, casting='unsafe')
+    out += ST_OFFSET
+    return out
+
+def mask_and_scale_st(st_dn, qa_pixel, qa_radsat, out=None):
+    """Scale an ST block to Kelvin (float32) and set cloudy, fill and saturated pixels to NaN."""
+    out = scale_st(st_dn, out)
+    out[~qa_clear_mask(qa_pixel, qa_radsat)] = np.nan
+    return out
+
+def load_calibration(path):
+    """Read (coefficient, intercept) from a calibration parameter file."""
+    with open(path) as f:
+        header = f.readline().strip().split(',')
+        values = dict(zip(header, map(float, f.readline().strip().split(','))))
+    return values['coefficient'], values['intercept']
+
+class CalibrationKernel:
+    """
+    Fused ST DN -> calibrated LST (°C) conversion with one affine per mask class.
+
+    For class c with calibration (k, b) the chain
+        ((DN * 0.00341802 + 149) - 273.15) * k + b
+    is folded into DN * gain[c] + bias[c], gain = 0.00341802 k, bias = (149 - 273.15) k + b,
+    computed once in float64 and stored as float32 lookup tables over the uint8 classes.
+    Classes without calibration map to NaN, as do DN 0 (no data).
+
+    Parameters:
+    -----------
+    calibrations : dict
+        class -> (coefficient, intercept); None loads the land and ocean (SST) parameter
+        files and keeps ice uncalibrated, as calibrateLST in GEMLST_Landsat.js
+    """
+    def __init__(self, calibrations=None):
+        if calibrations is None:
+            calibrations = {MASK_OCEAN: load_calibration(calibfile_ocean),
+                            MASK_LAND: load_calibration(calibfile_land),
+                            MASK_ICE: (1.0, 0.0)}
+        self.gain = np.full(256, np.nan, dtype=np.float32)
+        self.bias = np.full(256, np.nan, dtype=np.float32)
+        for cls, (coefficient, intercept) in calibrations.items():
+            self.gain[cls] = float(ST_SCALE) * coefficient
+            self.bias[cls] = (float(ST_OFFSET) - KELVIN) * coefficient + intercept
+
+    def apply(self, dn, classes, out=None, scratch=None):
+        """
+        Calibrate one block: out = DN * gain[class] + bias[class] (float32).
+
+        Parameters:
+        -----------
+        dn : numpy.ndarray
+            ST digital numbers (uint16)
+        classes : numpy.ndarray
+            Mask class per pixel (uint8)
+        out, scratch : numpy.ndarray, optional
+            float32 buffers of the block shape (allocated if not given)
+        """
+        out = np.empty(dn.shape, dtype=np.float32) if out is None else out
+        scratch = np.empty(dn.shape, dtype=np.float32) if scratch is None else scratch
+        np.take(self.gain, classes, out=out, mode='clip')
+        np.multiply(out, dn, out=out, casting='unsafe')
+        np.take(self.bias, classes, out=scratch, mode='clip')
+        out += scratch
+        out[dn == 0] = np.nan
+        return out
+
+    def calibrate(self, dn, classes, out=None, block_rows=128, max_workers=4):
+        """
+        Calibrate a whole array in row blocks with a thread pool, into one float32 output.
+
+        Each thread reuses one scratch block; the class lookups also need a temporary
+        index block, so small blocks keep the memory beyond the output negligible.
+        """
+        out = np.empty(dn.shape, dtype=np.float32) if out is None else out
+        local = threading.local()
+
+        def run(row):
+            rows = slice(row, min(row + block_rows, dn.shape[0]))
+            if getattr(local, 'scratch', None) is None:
+                local.scratch = np.empty((block_rows,) + dn.shape[1:], dtype=np.float32)
+            self.apply(dn[rows], classes[rows], out[rows], local.scratch[:rows.stop - rows.start])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(run, range(0, dn.shape[0], block_rows)))
+        return out
+
+def celsius_to_dn(lst):
+    """Encode LST in °C as uint16 ST DN in one fused step, (LST + 273.15 - 149) / 0.00341802 (NaN -> 0)."""
+    scaled = np.multiply(lst, np.float32(1 / float(ST_SCALE)), dtype=np.float32)
+    scaled += np.float32((KELVIN - float(ST_OFFSET)) / float(ST_SCALE))
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, 0, 65535, out=scaled)
+    scaled[np.isnan(scaled)] = 0
+    return scaled.astype(np.uint16)
+
+def calibrate_scene(st_path, mask_path, output_path, kernel=None, block_size=1024):
+    """
+    Calibrate an ST GeoTIFF (DN) with a class mask GeoTIFF on the same grid, block by block.
+
+    Writes a float32 GeoTIFF in °C (NaN = no data or unclassified).
+    """
+    kernel = CalibrationKernel() if kernel is None else kernel
+    tmp_path = output_path + '.part'
+    with rasterio.open(st_path) as st_src, rasterio.open(mask_path) as mask_src:
+        profile = st_src.profile
+        profile.update(driver='GTiff', dtype='float32', nodata=np.nan, count=1, tiled=True,
+                       blockxsize=512, blockysize=512, compress='deflate', predictor=3)
+        out = np.empty((block_size, block_size), dtype=np.float32)
+        scratch = np.empty_like(out)
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for window in block_windows(st_src.width, st_src.height, block_size):
+                h, w = window.height, window.width
+                block = kernel.apply(st_src.read(1, window=window), mask_src.read(1, window=window).astype(np.uint8),
+                                     out[:h, :w], scratch[:h, :w])
+                dst.write(block, 1, window=window)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+def find_scene_bands(scene_dir):
+    """
+    Find the thermal and QA band files of a Collection 2 Level 2 scene folder.
+
+    Returns:
+    --------
+    tuple or None
+        (product_id, st_path, qa_pixel_path, qa_radsat_path), None if a band is missing
+    """
+    qa_files = glob.glob(os.path.join(scene_dir, '*_QA_PIXEL.TIF'))
+    if not qa_files:
+        return None
+    product_id = os.path.basename(qa_files[0])[:-len('_QA_PIXEL.TIF')]
+    band = THERMAL_BANDS.get(product_id[:4])
+    if band is None:
+        return None
+    paths = [os.path.join(scene_dir, f"{product_id}_{name}.TIF") for name in (band, 'QA_PIXEL', 'QA_RADSAT')]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    return (product_id, *paths)
+
+def find_scenes(scene_root):
+    """Return the folders below scene_root that contain a complete Level 2 scene."""
+    scenes = []
+    for root, _, files in os.walk(scene_root):
+        if any(f.endswith('_QA_PIXEL.TIF') for f in files) and find_scene_bands(root):
+            scenes.append(root)
+    return sorted(scenes)
+
+def block_windows(width, height, block_size):
+    """Yield the windows of a block_size x block_size tiling of a raster."""
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield Window(col, row, min(block_size, width - col), min(block_size, height - row))
+
+def process_scene(scene_dir, output_dir, block_size=1024, overwrite=False):
+    """
+    Mask and scale the thermal band of one scene block by block.
+
+    Parameters:
+    -----------
+    scene_dir : str
+        Folder of the Level 2 scene
+    output_dir : str
+        Folder of the output GeoTIFF (<product_id>_ST.tif)
+    block_size : int
+        Size of the processing blocks in pixels
+    overwrite : bool
+        Process the scene again if the output already exists
+
+    Returns:
+    --------
+    tuple
+        (output path, fraction of clear pixels), the fraction is None if the scene was skipped
+    """
+    product_id, st_path, qa_pixel_path, qa_radsat_path = find_scene_bands(scene_dir)
+    output_path = os.path.join(output_dir, f"{product_id}_ST.tif")
+    if os.path.exists(output_path) and not overwrite:
+        return output_path, None
+
+    tmp_path = output_path + '.part'
+    clear = total = 0
+    with rasterio.open(st_path) as st_src, rasterio.open(qa_pixel_path) as qa_src, \
+            rasterio.open(qa_radsat_path) as radsat_src:
+        profile = st_src.profile
+        profile.update(driver='GTiff', dtype='float32', nodata=np.nan, count=1, tiled=True,
+                       blockxsize=512, blockysize=512, compress='deflate', predictor=3)
+        buffer = np.empty((block_size, block_size), dtype=np.float32)
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for window in block_windows(st_src.width, st_src.height, block_size):
+                out = buffer[:window.height, :window.width]
+                mask_and_scale_st(st_src.read(1, window=window), qa_src.read(1, window=window),
+                                  radsat_src.read(1, window=window), out=out)
+                dst.write(out, 1, window=window)
+                clear += int(np.count_nonzero(~np.isnan(out)))
+                total += out.size
+    os.replace(tmp_path, output_path)
+    return output_path, clear / total if total else 0.0
+
+def process_scenes(scene_dirs, output_dir, max_workers=4, block_size=1024, overwrite=False):
+    """
+    Process many scenes in parallel with a thread pool.
+
+    Returns:
+    --------
+    list
+        (scene_dir, output path or None, clear fraction or error message) per scene
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_scene, scene_dir, output_dir, block_size, overwrite): scene_dir
+                   for scene_dir in scene_dirs}
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Processing scenes"):
+            scene_dir = futures[future]
+            try:
+                output_path, clear_fraction = future.result()
+                results.append((scene_dir, output_path, clear_fraction))
+            except Exception as e:
+                print(f"Error processing {scene_dir}: {e}", file=sys.stderr)
+                results.append((scene_dir, None, str(e)))
+    return results
+
+#%%
+if __name__ == "__main__":
+    scenes = find_scenes(scene_root)
+    print(f"Found {len(scenes)} Level 2 scenes in {scene_root}")
+    max_workers = int(input("Enter number of parallel scenes (default 4): ") or "4")
+    results = process_scenes(scenes, output_dir, max_workers)
+    failed = [r for r in results if r[1] is None]
+    print(f"Processed {len(results) - len(failed)} scenes, {len(failed)} failed")
@@ -0,0 +1,542 @@
+'''
+# landsat_point_extraction.py
+Helpers for extracting Landsat Collection 2 surface temperature at many points with
+Google Earth Engine, used by extractLandsatSST.py.
+
+## Functionality
+- Cloud/saturation masking, ST band scaling and band renaming for Landsat 4/5/7/8/9
+- Batched extraction: in-situ rows are reduced to unique (lon, lat, date) keys, the keys
+  are grouped by date, and each group is sampled with one request (a FeatureCollection
+  of points reduced over every image of the date window) instead of two blocking
+  round-trips per row. The per-key values are joined back to all original rows, so rows
+  that share position and date (e.g. different depths) cost nothing extra.
+- Persistent cache: the raw getRegion-style array of every point is stored on disk
+  (ExtractionCache, SQLite) keyed by collection IDs, point, date window, band and scale,
+  so an interrupted or repeated run only asks Earth Engine for the missing points.
+- Concurrent requests: RequestScheduler runs the group requests in a thread pool within
+  a requests-per-second and concurrency quota, retrying quota/429 errors with backoff,
+  so many points are limited by the quota rather than by the getInfo() round-trip time.
+
+All functions that talk to Earth Engine take an optional ee_module argument, so they can
+be run against a fake client (see test_landsat_point_extraction.py); the ee package is
+only imported when no client is given.
+'''
+#%%
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+import concurrent.futures
+from datetime import date as Date, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Earth Engine refuses to return collections of more than 5000 elements with getInfo()
+MAX_ELEMENTS_PER_REQUEST = 5000
+
+# Landsat Collection 2 Level 2 collections and their sensor type (see PREP_FUNCTIONS)
+LANDSAT_COLLECTIONS = [
+    ('LANDSAT/LC08/C02/T1_L2', 'oli'),
+    ('LANDSAT/LC09/C02/T1_L2', 'oli'),
+    ('LANDSAT/LE07/C02/T1_L2', 'etm'),
+    ('LANDSAT/LT05/C02/T1_L2', 'etm'),
+]
+
+#%% functions
+def earth_engine(ee_module=None):
+    """The Earth Engine client to use: ee_module, or the ee package (imported on first use)."""
+    if ee_module is not None:
+        return ee_module
+    import ee
+    return ee
+
+def maskL8sr(image):
+    """
+    Apply cloud masking to Landsat 8/9 imagery using the QA_PIXEL band.
+
+    Parameters:
+        image (ee.Image): Landsat image to mask
+
+    Returns:
+        ee.Image: Cloud-masked image with properly scaled band values
+    """
+    # Get the QA band for cloud masking
+    qaMask = image.select('QA_PIXEL').bitwiseAnd(int('11111', 2)).eq(0)
+    saturationMask = image.select('QA_RADSAT').eq(0)  # Mask saturated pixels
+
+    # Apply scaling factors to convert DN to reflectance or temperature
+    # opticalBands = image.select('SR_B.').multiply(0.0000275).add(-0.2).updateMask(qaMask).updateMask(saturationMask)
+    thermalBands = image.select('ST_B.*').multiply(0.00341802).add(149.0).updateMask(qaMask).updateMask(saturationMask)
+
+    # Return the masked and scaled image
+    return image.addBands(thermalBands, None, True)
+
+# the Landsat 4, 5, 7 Collection 2
+def maskL457sr(image):
+  # Bit 0 - Fill
+  # Bit 1 - Dilated Cloud
+  # Bit 2 - Unused
+  # Bit 3 - Cloud
+  # Bit 4 - Cloud Shadow
+  qaMask = image.select('QA_PIXEL').bitwiseAnd(int('11111', 2)).eq(0)
+  saturationMask = image.select('QA_RADSAT').eq(0)
+
+  # Apply the scaling factors to the appropriate bands.
+  # opticalBands = image.select('SR_B.')
+  # opticalBands = image.select('SR_B.').multiply(0.0000275).add(-0.2)
+  thermalBand = image.select('ST_B6').multiply(0.00341802).add(149.0).updateMask(qaMask).updateMask(saturationMask)
+
+  # Replace the original bands with the scaled ones and apply the masks.
+  return image.addBands(thermalBand, None, True)
+
+def renameOli(img):
+    """
+    Rename Landsat 8/9 bands to standardized names for easier processing.
+
+    Parameters:
+        img (ee.Image): Landsat image with original band names
+
+    Returns:
+        ee.Image: Image with renamed bands
+    """
+    return img.select(
+        ['ST_B10',   'QA_PIXEL', 'QA_RADSAT'],
+        ['SST',      'QA_PIXEL', 'QA_RADSAT']
+    )
+# Function to get and rename bands of interest from ETM+, TM.
+def renameEtm(img):
+  return img.select(
+    ['ST_B6', 'QA_PIXEL', 'QA_RADSAT'], #,   'QA_PIXEL', 'QA_RADSAT'
+    ['SST',   'QA_PIXEL', 'QA_RADSAT']) #, 'QA_PIXEL', 'QA_RADSAT'
+
+def prepOli(img, ee_module=None):
+    """
+    Prepare Landsat 8/9 imagery by applying cloud mask and renaming bands.
+
+    Parameters:
+        img (ee.Image): Raw Landsat image
+        ee_module (module, optional): Earth Engine client to use (defaults to the ee package)
+
+    Returns:
+        ee.Image: Processed image with cloud masking and standardized band names
+    """
+    orig = img
+    img = maskL8sr(img)  # Apply cloud masking
+    img = renameOli(img)  # Rename bands to standardized names
+
+    # Preserve original metadata
+    ee_module = earth_engine(ee_module)
+    return ee_module.Image(img.copyProperties(orig, orig.propertyNames()))
+
+def prepEtm(img, ee_module=None):
+    """
+    Prepare Landsat 4/5/7 imagery by applying cloud mask and renaming bands.
+
+    Parameters:
+        img (ee.Image): Raw Landsat image
+        ee_module (module, optional): Earth Engine client to use (defaults to the ee package)
+
+    Returns:
+        ee.Image: Processed image with cloud masking and standardized band names
+    """
+    orig = img
+    img = maskL457sr(img)  # Apply cloud masking
+    img = renameEtm(img)  # Rename bands to standardized names
+
+    # Preserve original metadata
+    ee_module = earth_engine(ee_module)
+    return ee_module.Image(img.copyProperties(orig, orig.propertyNames()))
+
+PREP_FUNCTIONS = {'oli': prepOli, 'etm': prepEtm}
+
+def prep_function(sensor, ee_module=None):
+    """One-argument prepare function of a sensor type for ImageCollection.map, bound to ee_module."""
+    prep = PREP_FUNCTIONS[sensor]
+    def prepare(img):
+        return prep(img, ee_module)
+    return prepare
+
+def ee_array_to_df(arr, list_of_bands):
+    """Transforms client-side ee.Image.getRegion array to pandas.DataFrame."""
+    df = pd.DataFrame(arr)
+
+    # Rearrange the header.
+    headers = df.iloc[0]
+    df = pd.DataFrame(df.values[1:], columns=headers)
+
+    # Remove rows without data inside.
+    df = df[['longitude', 'latitude', 'time', *list_of_bands]]
+
+    # Convert the data to numeric values.
+    for band in list_of_bands:
+        df[band] = pd.to_numeric(df[band], errors='coerce')
+
+    # Keep the columns of interest.
+    df = df[['time', 'longitude', 'latitude', *list_of_bands]]
+
+    return df
+
+def point_keys(df, lon_col='Lon', lat_col='Lat', date_col='Date', decimals=6):
+    """
+    Reduce in-situ rows to their unique (lon, lat, date) keys.
+
+    Coordinates are rounded to `decimals` so float noise does not split a site in two.
+
+    Returns:
+    --------
+    tuple
+        (keys DataFrame with columns lon, lat, date and a 'key' id column,
+         array mapping every row of df to its key id)
+    """
+    rows = pd.DataFrame({
+        'lon': df[lon_col].astype(float).round(decimals).to_numpy(),
+        'lat': df[lat_col].astype(float).round(decimals).to_numpy(),
+        'date': pd.to_datetime(df[date_col]).dt.strftime('%Y-%m-%d').to_numpy(),
+    })
+    rows['key'] = rows.groupby(['lon', 'lat', 'date'], sort=False).ngroup()
+    keys = rows.drop_duplicates('key').reset_index(drop=True)
+    return keys, rows['key'].to_numpy()
+
+def landsat_collection(region, start_date, end_date, ee_module=None):
+    """Merged, masked and scaled Landsat 5/7/8/9 collection over region and a date window."""
+    ee_module = earth_engine(ee_module)
+    colFilter = ee_module.Filter.And(
+        ee_module.Filter.bounds(region),
+        ee_module.Filter.date(start_date, end_date)
+    )
+    landsatCol = None
+    for collection_id, sensor in LANDSAT_COLLECTIONS:
+        col = ee_module.ImageCollection(collection_id).filter(colFilter).map(prep_function(sensor, ee_module))
+        landsatCol = col if landsatCol is None else landsatCol.merge(col)
+    return landsatCol
+
+def sample_points_request(keys, date, day_step=0, band='SST', scale=30, ee_module=None):
+    """
+    Build (without evaluating) one request sampling all points of a date group.
+
+    Every image in the date window is reduced over the FeatureCollection of points with
+    ee.Reducer.first() at the given scale (the pixel that getRegion would return), and the
+    per-image results are flattened into one FeatureCollection carrying key, time and band.
+    """
+    ee_module = earth_engine(ee_module)
+    year, month, day = (int(part) for part in date.split('-'))
+    start_date = ee_module.Date.fromYMD(year, month, day).advance(-1 * day_step, 'day')
+    end_date = ee_module.Date.fromYMD(year, month, day).advance(day_step + 1, 'day')
+
+    points = ee_module.FeatureCollection([
+        ee_module.Feature(ee_module.Geometry.Point(float(lon), float(lat)), {'key': int(key)})
+        for lon, lat, key in zip(keys['lon'], keys['lat'], keys['key'])
+    ])
+    landsatCol = landsat_collection(points.geometry(), start_date, end_date, ee_module)
+
+    def sample(img):
+        # only the points inside the footprint, so the result has one feature per point and image
+        samples = img.select(band).reduceRegions(
+            collection=points.filterBounds(img.geometry()), reducer=ee_module.Reducer.first().setOutputs([band]), scale=scale)
+        return samples.map(lambda f: f.set({'time': img.get('system:time_start'), 'id': img.get('system:index')}))
+
+    return landsatCol.map(sample).flatten().filter(ee_module.Filter.notNull([band]))
+
+def features_to_arrays(features, keys, band='SST'):
+    """
+    Convert sampled features to one getRegion-style array per key.
+
+    Returns:
+    --------
+    dict
+        key id -> [['id', 'longitude', 'latitude', 'time', band], rows...]; keys without
+        any valid sample get a header-only array
+    """
+    coords = {int(k): (lon, lat) for lon, lat, k in zip(keys['lon'], keys['lat'], keys['key'])}
+    arrays = {k: [['id', 'longitude', 'latitude', 'time', band]] for k in coords}
+    for feature in features:
+        props = feature['properties']
+        k = int(props['key'])
+        lon, lat = coords[k]
+        arrays[k].append([props.get('id'), lon, lat, props.get('time'), props.get(band)])
+    return arrays
+
+def is_element_limit_error(error):
+    """True for Earth Engine errors caused by a result of more than MAX_ELEMENTS_PER_REQUEST elements."""
+    return 'accumulating over' in str(error).lower()
+
+def fetch_group(keys, date, day_step=0, band='SST', scale=30, ee_module=None, scheduler=None):
+    """
+    Evaluate the sampling request of one date group (one getInfo round-trip).
+
+    If the result still exceeds the element limit of getInfo() (more images per point
+    than group_keys assumed), the group is split in halves that are fetched separately.
+    With a scheduler every getInfo() call, including those of the halves, goes through
+    scheduler.call, i.e. within its rate limit and with its quota retries.
+    """
+    request = sample_points_request(keys, date, day_step, band, scale, ee_module)
+    try:
+        info = scheduler.call(request.getInfo) if scheduler is not None else request.getInfo()
+    except Exception as e:
+        if not is_element_limit_error(e) or len(keys) < 2:
+            raise
+        half = len(keys) // 2
+        arrays = fetch_group(keys.iloc[:half], date, day_step, band, scale, ee_module, scheduler)
+        arrays.update(fetch_group(keys.iloc[half:], date, day_step, band, scale, ee_module, scheduler))
+        return arrays
+    return features_to_arrays(info['features'], keys, band)
+
+def group_keys(keys, max_points_per_request=1000, day_step=0, images_per_day=6,
+               max_elements=MAX_ELEMENTS_PER_REQUEST):
+    """
+    Split the unique keys into (date, keys) groups for one request each.
+
+    A request returns one feature per point and image covering it in the date window,
+    so a group holds at most max_elements / (images_per_day * window days) points (and
+    never more than max_points_per_request). images_per_day is the number of Landsat
+    scenes expected over a point on one day, counting overlapping paths and sensors.
+    """
+    window_images = images_per_day * (2 * day_step + 1)
+    size = max(1, min(max_points_per_request, max_elements // window_images))
+    groups = []
+    for date, by_date in keys.groupby('date', sort=True):
+        for start in range(0, len(by_date), size):
+            groups.append((date, by_date.iloc[start:start + size]))
+    return groups
+
+def arrays_to_means(arrays, band='SST'):
+    """Mean of the band over all images of each key's getRegion-style array (NaN if empty)."""
+    means = {}
+    for k, arr in arrays.items():
+        values = ee_array_to_df(arr, [band])[band] if len(arr) > 1 else pd.Series(dtype=float)
+        means[k] = values.mean() if values.notna().any() else np.nan
+    return means
+
+class ExtractionCache:
+    """
+    On-disk cache of raw getRegion-style arrays per extraction key (SQLite).
+
+    Parameters:
+    -----------
+    path : str
+        SQLite file holding the cache
+    max_age_days : float, optional
+        Entries older than this are treated as missing and removed by evict()
+    max_size_mb : float, optional
+        evict() removes the least recently used entries until the cache fits this size
+    """
+    def __init__(self, path, max_age_days=None, max_size_mb=None):
+        self.path = path
+        self.max_age = max_age_days * 86400 if max_age_days is not None else None
+        self.max_bytes = max_size_mb * 1024 * 1024 if max_size_mb is not None else None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key      TEXT PRIMARY KEY,
+                    created  REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    size     INTEGER NOT NULL,
+                    value    TEXT NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def make_key(collection_ids, lon, lat, start_date, end_date, band, scale):
+        """Hash of (collection IDs, point, date window, band, scale)."""
+        parts = [sorted(collection_ids), round(float(lon), 6), round(float(lat), 6),
+                 str(start_date), str(end_date), band, float(scale)]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def get_many(self, keys):
+        """Return {key: array} for the keys found in the cache and not expired."""
+        found = {}
+        now = time.time()
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, created, value FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, created, value in rows:
+                    if self.max_age is None or now - created <= self.max_age:
+                        found[key] = json.loads(value)
+            with self.conn:
+                self.conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(now, k) for k in found])
+        return found
+
+    def put_many(self, items):
+        """Store {key: array} in the cache."""
+        now = time.time()
+        rows = []
+        for key, array in items.items():
+            value = json.dumps(array)
+            rows.append((key, now, now, len(value), value))
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", rows)
+
+    def evict(self):
+        """Remove expired entries, then least recently used ones until the size limit is met."""
+        with self.lock, self.conn:
+            if self.max_age is not None:
+                self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            if self.max_bytes is not None:
+                (total,) = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+                if total > self.max_bytes:
+                    doomed, freed = [], 0
+                    for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                        if total - freed <= self.max_bytes:
+                            break
+                        doomed.append((key,))
+                        freed += size
+                    self.conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+def is_quota_error(error):
+    """True for Earth Engine errors caused by request quotas or rate limits (HTTP 429)."""
+    message = str(error).lower()
+    return any(text in message for text in ('429', 'too many requests', 'quota', 'rate limit', 'resource_exhausted'))
+
+class RequestScheduler:
+    """
+    Run Earth Engine requests concurrently within a rate and concurrency quota.
+
+    Parameters:
+    -----------
+    max_concurrent : int
+        Maximum number of requests in flight (size of the thread pool)
+    requests_per_second : float
+        Maximum rate at which requests are started (token bucket, bursts of one second)
+    max_retries : int
+        Number of retries of a request failing with a quota/429 error
+    backoff_factor : float
+        Base delay in seconds of the exponential backoff (with full jitter)
+    """
+    def __init__(self, max_concurrent=8, requests_per_second=5.0, max_retries=6, backoff_factor=1.0):
+        self.max_concurrent = max_concurrent
+        self.rate = float(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0}
+
+    def _acquire(self):
+        """Wait for a token of the rate limit."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.stats['requests'] += 1
+        if wait > 0:
+            time.sleep(wait)
+
+    def call(self, fn, *args):
+        """Call fn(*args) within the rate limit, retrying quota errors with backoff."""
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                return fn(*args)
+            except Exception as e:
+                if not is_quota_error(e) or attempt == self.max_retries:
+                    raise
+                with self.lock:
+                    self.stats['retries'] += 1
+                time.sleep(random.uniform(0, self.backoff_factor * 2 ** attempt))
+
+    def map(self, fn, items):
+        """
+        Apply fn to every item concurrently and return the results in input order.
+
+        fn runs in the thread pool (at most max_concurrent at a time) and must send its
+        Earth Engine requests through call(), so each request is rate limited and retried.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            futures = [executor.submit(fn, item) for item in items]
+            return [future.result() for future in futures]
+
+def date_window(date, day_step=0):
+    """Start (inclusive) and end (exclusive) dates of the ±day_step window around date."""
+    day = Date.fromisoformat(date)
+    return (day - timedelta(days=day_step)).isoformat(), (day + timedelta(days=day_step + 1)).isoformat()
+
+def extract_landsat_points(df, day_step=0, band='SST', scale=30, max_points_per_request=1000,
+                           lon_col='Lon', lat_col='Lat', date_col='Date', ee_module=None, verbose=True,
+                           cache=None, scheduler=None, images_per_day=6):
+    """
+    Extract the mean Landsat band value (Kelvin for SST) for every row of df.
+
+    Rows are deduplicated to (lon, lat, date) keys, keys are grouped by date and each group
+    is sampled with a single request of at most max_points_per_request points, fewer if
+    points times images in the date window would exceed the getInfo() element limit.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        In-situ rows with longitude, latitude and date columns
+    day_step : int
+        Half-width of the date window in days (0 = same day only)
+    band : str
+        Standardized band name to extract
+    scale : float
+        Sampling scale in metres
+    max_points_per_request : int
+        Maximum number of points per request (Earth Engine limits the request size)
+    images_per_day : int
+        Expected number of Landsat images over a point per day, used to keep points
+        times images of a request within MAX_ELEMENTS_PER_REQUEST (see group_keys)
+    ee_module : module, optional
+        Earth Engine client to use (defaults to the ee package)
+    cache : ExtractionCache, optional
+        Cache answering points that were extracted before; newly fetched groups are
+        stored in it as soon as they arrive
+    scheduler : RequestScheduler, optional
+        Run the group requests concurrently within its quota (sequential if None)
+
+    Returns:
+    --------
+    numpy.ndarray
+        Mean band value per row of df, NaN where no clear image was found
+    """
+    keys, codes = point_keys(df, lon_col, lat_col, date_col)
+
+    arrays = {}
+    if cache is not None:
+        collection_ids = [collection_id for collection_id, _ in LANDSAT_COLLECTIONS]
+        cache_keys = {
+            int(k): cache.make_key(collection_ids, lon, lat, *date_window(d, day_step), band, scale)
+            for lon, lat, d, k in zip(keys['lon'], keys['lat'], keys['date'], keys['key'])
+        }
+        cached = cache.get_many(list(cache_keys.values()))
+        arrays = {k: cached[ck] for k, ck in cache_keys.items() if ck in cached}
+
+    missing = keys[~keys['key'].isin(list(arrays))]
+    groups = group_keys(missing, max_points_per_request, day_step, images_per_day)
+    if verbose:
+        print(f"{len(df)} rows -> {len(keys)} unique points ({len(arrays)} cached) -> {len(groups)} requests")
+
+    def fetch(item):
+        i, (date, group) = item
+        if verbose:
+            print(f"Processing {i+1}/{len(groups)}: {date} ({len(group)} points)")
+        group_arrays = fetch_group(group, date, day_step, band, scale, ee_module, scheduler)
+        if cache is not None:
+            cache.put_many({cache_keys[k]: array for k, array in group_arrays.items()})
+        return group_arrays
+
+    if scheduler is not None:
+        results = scheduler.map(fetch, list(enumerate(groups)))
+    else:
+        results = [fetch(item) for item in enumerate(groups)]
+    for group_arrays in results:
+        arrays.update(group_arrays)
+
+    means = arrays_to_means(arrays, band)
+    key_values = np.array([means[k] for k in keys['key']], dtype=float)
+    return key_values[codes]
@@ -0,0 +1,278 @@
+'''
+# landsat_scene_index.py
+Spatio-temporal index of local Landsat scenes for offline point extraction, the local
+counterpart of ee.Filter.bounds(poi) and ee.Filter.date(...) in extractLandsatSST.py.
+
+## Functionality
+- SceneIndex: a packed, time-sorted table of scene footprints (corner quadrilateral and
+  bounding box in lon/lat), acquisition dates, CRS and geotransforms, stored in one .npz
+  file. A point/date-window query is a binary search on the date followed by vectorized
+  bounding-box and point-in-quadrilateral tests over the scenes of that window only.
+- build_scene_index: (re)builds the index from raster files, reusing the entries of
+  unchanged files, so only new scenes are opened.
+- extract_points_local: finds the scenes of each unique (lon, lat, date) key, opens each
+  relevant file once and reads only a small window around its points (thread pool across
+  files), and returns the mean over scenes per input row like extract_landsat_points.
+
+## Input
+Scene GeoTIFFs named after the Collection 2 product ID, e.g. the float32 ST outputs of
+landsat_local_processing.py (LC08_L2SP_008011_20200715_20200912_02_T1_ST.tif, Kelvin).
+'''
+#%%
+import os
+import re
+import sys
+import glob
+import concurrent.futures
+from datetime import date as Date
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+from pyproj import Transformer
+from tqdm import tqdm
+
+# ===== CONFIGURE THESE PATHS =====
+scene_dir = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/Landsat_LST/data/L2_ST"
+index_path = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/Landsat_LST/data/L2_ST/scene_index.npz"
+# =================================
+
+# Acquisition date of a Collection 2 product ID: <sensor>_<level>_<pathrow>_<acquired>_<processed>_...
+ACQUISITION_RE = re.compile(r'L[CEOT]0\d_L\w{3}_\d{6}_(\d{8})_\d{8}_')
+EPOCH = Date(1970, 1, 1)
+
+#%% functions
+def acquisition_day(path):
+    """Acquisition date of a scene file as days since 1970-01-01 (None if not a product ID)."""
+    match = ACQUISITION_RE.search(os.path.basename(path))
+    if match is None:
+        return None
+    d = match.group(1)
+    return (Date(int(d[:4]), int(d[4:6]), int(d[6:])) - EPOCH).days
+
+def to_day(value):
+    """Convert a date string/datetime to days since 1970-01-01."""
+    return (pd.Timestamp(value).date() - EPOCH).days
+
+def scene_record(path):
+    """Read the footprint, CRS and geotransform of one scene."""
+    with rasterio.open(path) as src:
+        t = src.transform
+        transform = (t.a, t.b, t.c, t.d, t.e, t.f)
+        crs = src.crs.to_wkt()
+        width, height = src.width, src.height
+    # Corners in pixel coordinates -> scene CRS -> lon/lat
+    cols = np.array([0, width, width, 0], dtype=float)
+    rows = np.array([0, 0, height, height], dtype=float)
+    x = transform[2] + cols * transform[0] + rows * transform[1]
+    y = transform[5] + cols * transform[3] + rows * transform[4]
+    lon, lat = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True).transform(x, y)
+    return {'path': path, 'mtime': os.path.getmtime(path), 'day': acquisition_day(path),
+            'lon': np.asarray(lon), 'lat': np.asarray(lat), 'crs': crs,
+            'transform': transform, 'width': width, 'height': height}
+
+class SceneIndex:
+    """
+    Packed spatio-temporal index of scenes, sorted by acquisition day.
+
+    Parameters:
+    -----------
+    records : list of dict
+        Scene records as returned by scene_record()
+    """
+    def __init__(self, records):
+        records = sorted(records, key=lambda r: (r['day'], r['path']))
+        self.paths = np.array([r['path'] for r in records], dtype=str)
+        self.mtimes = np.array([r['mtime'] for r in records], dtype=float)
+        self.days = np.array([r['day'] for r in records], dtype=np.int64)
+        self.corner_lon = np.array([r['lon'] for r in records], dtype=float).reshape(-1, 4)
+        self.corner_lat = np.array([r['lat'] for r in records], dtype=float).reshape(-1, 4)
+        self.crs = np.array([r['crs'] for r in records], dtype=str)
+        self.transforms = np.array([r['transform'] for r in records], dtype=float).reshape(-1, 6)
+        self.shapes = np.array([(r['height'], r['width']) for r in records], dtype=np.int64).reshape(-1, 2)
+        self._prepare()
+
+    def _prepare(self):
+        """Precompute the bounding boxes and footprint edges used by query()."""
+        self.min_lon, self.min_lat = self.corner_lon.min(axis=1), self.corner_lat.min(axis=1)
+        self.max_lon, self.max_lat = self.corner_lon.max(axis=1), self.corner_lat.max(axis=1)
+        # Edges (x0, y0) -> (x1, y1) of the footprints, with dx/dy for the ray-casting test
+        x1, y1 = np.roll(self.corner_lon, -1, axis=1), np.roll(self.corner_lat, -1, axis=1)
+        dy = y1 - self.corner_lat
+        self.edge_slope = np.divide(x1 - self.corner_lon, dy, out=np.zeros_like(dy), where=dy != 0)
+        self.edge_y1 = y1
+
+    def __len__(self):
+        return len(self.paths)
+
+    def records(self):
+        """Return the scene records, e.g. to extend the index."""
+        return [{'path': str(self.paths[i]), 'mtime': self.mtimes[i], 'day': int(self.days[i]),
+                 'lon': self.corner_lon[i], 'lat': self.corner_lat[i], 'crs': str(self.crs[i]),
+                 'transform': tuple(self.transforms[i]), 'width': int(self.shapes[i, 1]),
+                 'height': int(self.shapes[i, 0])} for i in range(len(self))]
+
+    def save(self, path):
+        """Write the index to an .npz file (atomically)."""
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, paths=self.paths, mtimes=self.mtimes, days=self.days,
+                 corner_lon=self.corner_lon, corner_lat=self.corner_lat, crs=self.crs,
+                 transforms=self.transforms, shapes=self.shapes)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by save()."""
+        index = cls.__new__(cls)
+        with np.load(path) as data:
+            for name in ('paths', 'mtimes', 'days', 'corner_lon', 'corner_lat', 'crs', 'transforms', 'shapes'):
+                setattr(index, name, data[name])
+        index._prepare()
+        return index
+
+    def query(self, lon, lat, start, end):
+        """
+        Find the scenes whose footprint contains a point within a date window.
+
+        Parameters:
+        -----------
+        lon, lat : float
+            Point in degrees
+        start, end : int
+            First and last acquisition day (days since 1970-01-01, inclusive)
+
+        Returns:
+        --------
+        numpy.ndarray
+            Positions of the matching scenes in the index
+        """
+        i0 = np.searchsorted(self.days, start, side='left')
+        i1 = np.searchsorted(self.days, end, side='right')
+        candidates = np.flatnonzero((self.min_lon[i0:i1] <= lon) & (lon <= self.max_lon[i0:i1]) &
+                                    (self.min_lat[i0:i1] <= lat) & (lat <= self.max_lat[i0:i1])) + i0
+        if len(candidates) == 0:
+            return candidates
+        # Point in the corner quadrilateral (ray casting over the four edges)
+        y0 = self.corner_lat[candidates]
+        crosses = ((y0 > lat) != (self.edge_y1[candidates] > lat)) & \
+            (lon < self.edge_slope[candidates] * (lat - y0) + self.corner_lon[candidates])
+        return candidates[crosses.sum(axis=1) % 2 == 1]
+
+def build_scene_index(raster_paths, index_path=None, verbose=True):
+    """
+    Build the index of raster_paths, reusing the entries of an existing index file.
+
+    Files that are already in the index with the same mtime are not opened again; files
+    that no longer exist are dropped. Files without a product ID date are skipped.
+
+    Returns:
+    --------
+    SceneIndex
+    """
+    known = {}
+    if index_path and os.path.exists(index_path):
+        try:
+            known = {r['path']: r for r in SceneIndex.load(index_path).records()}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: could not read index '{index_path}' ({e}), rebuilding it", file=sys.stderr)
+
+    records, new = [], []
+    for path in raster_paths:
+        record = known.get(path)
+        if record is not None and os.path.exists(path) and record['mtime'] == os.path.getmtime(path):
+            records.append(record)
+        elif acquisition_day(path) is not None:
+            new.append(path)
+    for path in tqdm(new, desc="Indexing scenes", disable=not verbose):
+        try:
+            records.append(scene_record(path))
+        except Exception as e:
+            print(f"Error reading {path}: {e}", file=sys.stderr)
+
+    index = SceneIndex(records)
+    if index_path:
+        index.save(index_path)
+    if verbose:
+        print(f"Scene index: {len(index)} scenes ({len(new)} newly indexed)")
+    return index
+
+def read_scene_points(path, crs, transform, shape, points, half_window=0):
+    """
+    Read the pixel (or the mean of a (2*half_window+1)^2 window) at each point of one scene.
+
+    Parameters:
+    -----------
+    points : list of tuple
+        (key, lon, lat)
+
+    Returns:
+    --------
+    list of tuple
+        (key, value) for points inside the scene with at least one valid pixel
+    """
+    keys = [p[0] for p in points]
+    lon = np.array([p[1] for p in points])
+    lat = np.array([p[2] for p in points])
+    x, y = Transformer.from_crs('EPSG:4326', crs, always_xy=True).transform(lon, lat)
+    # North-up geotransform (Landsat products): col = (x - c) / a, row = (y - f) / e
+    cols = np.floor((np.asarray(x) - transform[2]) / transform[0]).astype(int)
+    rows = np.floor((np.asarray(y) - transform[5]) / transform[4]).astype(int)
+    height, width = shape
+
+    values = []
+    with rasterio.open(path) as src:
+        for key, row, col in zip(keys, rows, cols):
+            if not (0 <= row < height and 0 <= col < width):
+                continue
+            r0, c0 = max(row - half_window, 0), max(col - half_window, 0)
+            r1, c1 = min(row + half_window + 1, height), min(col + half_window + 1, width)
+            block = src.read(1, window=Window(c0, r0, c1 - c0, r1 - r0), masked=True).astype(float).filled(np.nan)
+            if np.isfinite(block).any():
+                values.append((key, np.nanmean(block)))
+    return values
+
+def extract_points_local(df, index, day_step=0, half_window=0, lon_col='Lon', lat_col='Lat', date_col='Date',
+                         max_workers=8, verbose=True):
+    """
+    Extract scene values for every row of df from local scenes.
+
+    Each unique (lon, lat, date) key is matched against the index within ±day_step days,
+    every relevant scene is opened once, and the per-key mean over scenes is joined back to
+    all rows, like extract_landsat_points (values in the unit of the scenes, K for ST).
+
+    Returns:
+    --------
+    numpy.ndarray
+        Mean value per row of df (NaN where no scene has a valid pixel)
+    """
+    key_cols = [lon_col, lat_col, date_col]
+    keys = df[key_cols].drop_duplicates().reset_index(drop=True)
+
+    # Group the requested points by scene, so each file is opened once
+    by_scene = {}
+    for k, (lon, lat, day) in enumerate(zip(keys[lon_col], keys[lat_col], keys[date_col].map(to_day))):
+        for i in index.query(lon, lat, day - day_step, day + day_step):
+            by_scene.setdefault(int(i), []).append((k, lon, lat))
+    if verbose:
+        print(f"{len(keys)} unique points in {len(by_scene)} scenes")
+
+    sums = np.zeros(len(keys))
+    counts = np.zeros(len(keys))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(read_scene_points, str(index.paths[i]), str(index.crs[i]), index.transforms[i],
+                                   index.shapes[i], points, half_window) for i, points in by_scene.items()]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures),
+                           desc="Reading scenes", disable=not verbose):
+            for k, value in future.result():
+                sums[k] += value
+                counts[k] += 1
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        keys['value'] = np.where(counts > 0, sums / counts, np.nan)
+    return df[key_cols].merge(keys, on=key_cols, how='left')['value'].to_numpy()
+
+#%%
+if __name__ == "__main__":
+    paths = sorted(glob.glob(os.path.join(scene_dir, '**', '*.tif'), recursive=True))
+    index = build_scene_index(paths, index_path)
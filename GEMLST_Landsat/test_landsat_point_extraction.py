@@ -0,0 +1,215 @@
+"""
+Checks of landsat_point_extraction.py against a fake Earth Engine client (run with pytest,
+no earthengine-api or network needed).
+"""
+import time
+import threading
+import collections
+
+import numpy as np
+import pandas as pd
+
+from landsat_point_extraction import (MAX_ELEMENTS_PER_REQUEST, ExtractionCache, RequestScheduler,
+                                      extract_landsat_points, group_keys, point_keys)
+
+class FakeObject:
+    """Chainable stand-in for any Earth Engine object, carrying the points of a FeatureCollection."""
+    def __init__(self, client, points=None):
+        self.client = client
+        self.points = points
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            if name == 'map':
+                args[0](FakeObject(self.client))   # run the mapped function once
+            points = self.points
+            for arg in (*args, *kwargs.values()):
+                if points is None and isinstance(arg, FakeObject):
+                    points = arg.points
+            return FakeObject(self.client, points)
+        return method
+
+    def getInfo(self):
+        return self.client.get_info(self.points)
+
+class FakeEarthEngine:
+    """
+    Minimal fake of the ee module for extract_landsat_points, counting getInfo() calls.
+
+    Every point gets two images with SST 280 + key and 282 + key, i.e. a mean of 281 + key.
+    A request returning more than MAX_ELEMENTS_PER_REQUEST features fails as in Earth Engine.
+
+    Parameters:
+    -----------
+    latency : float
+        Seconds every getInfo() call takes
+    max_calls_per_second : int, optional
+        getInfo() calls beyond this number within one second fail with a 429 error
+    """
+    def __init__(self, latency=0.0, max_calls_per_second=None):
+        self.latency = latency
+        self.max_calls_per_second = max_calls_per_second
+        self.calls = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.recent = collections.deque()
+        self.lock = threading.Lock()
+        self.Filter = self.Date = self.Reducer = self.Geometry = FakeObject(self)
+
+    def FeatureCollection(self, features):
+        return FakeObject(self, list(features))
+
+    def Feature(self, geometry, properties):
+        return properties
+
+    def ImageCollection(self, collection_id):
+        return FakeObject(self)
+
+    def Image(self, image):
+        return image
+
+    def get_info(self, points):
+        with self.lock:
+            self.calls += 1
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] >= 1.0:
+                self.recent.popleft()
+            self.recent.append(now)
+            if self.max_calls_per_second is not None and len(self.recent) > self.max_calls_per_second:
+                self.throttled += 1
+                raise Exception("HTTP 429: Too Many Requests")
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            if len(points) * 2 > MAX_ELEMENTS_PER_REQUEST:
+                raise Exception("Collection query aborted after accumulating over 5000 elements.")
+            return {'features': [{'properties': {'key': p['key'], 'id': image, 'time': t,
+                                                 'SST': 280.0 + 2 * t + p['key']}}
+                                 for p in points for t, image in enumerate(('a', 'b'))]}
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+def make_rows(n_sites=3000, n_dates=2, rows_per_key=3):
+    """In-situ rows: n_sites points on n_dates days, rows_per_key rows (depths) per point and day."""
+    sites = np.arange(n_sites)
+    return pd.DataFrame({
+        'Lon': np.tile(np.repeat(sites * 0.001, rows_per_key), n_dates),
+        'Lat': 69.0,
+        'Date': np.repeat([f'2020-07-{day + 1:02d}' for day in range(n_dates)], n_sites * rows_per_key),
+    })
+
+def test_one_request_per_date_group():
+    df = make_rows(n_sites=1500)
+    fake = FakeEarthEngine()
+    values = extract_landsat_points(df, ee_module=fake, verbose=False, images_per_day=1)
+    keys, codes = point_keys(df)
+    np.testing.assert_allclose(values, 281.0 + codes)
+    assert fake.calls == len(group_keys(keys, images_per_day=1))
+
+def test_groups_respect_element_limit():
+    keys, _ = point_keys(make_rows(n_dates=1, rows_per_key=1))
+    for day_step, images_per_day in ((0, 6), (2, 6), (0, 1)):
+        groups = group_keys(keys, day_step=day_step, images_per_day=images_per_day)
+        window_images = images_per_day * (2 * day_step + 1)
+        assert max(len(group) for _, group in groups) * window_images <= MAX_ELEMENTS_PER_REQUEST
+
+def test_groups_over_element_limit_are_split():
+    df = make_rows(n_dates=1, rows_per_key=1)
+    fake = FakeEarthEngine()
+    values = extract_landsat_points(df, ee_module=fake, verbose=False, images_per_day=1,
+                                    max_points_per_request=5000)
+    _, codes = point_keys(df)
+    np.testing.assert_allclose(values, 281.0 + codes)
+    # one failing request, then its two halves
+    assert fake.calls == 3
+
+def test_scheduler_rate_and_concurrency():
+    df = make_rows(n_sites=5, n_dates=30, rows_per_key=1)
+    # a burst of one second of tokens plus one second at the rate stays under the server limit
+    fake = FakeEarthEngine(latency=0.05, max_calls_per_second=45)
+    scheduler = RequestScheduler(max_concurrent=4, requests_per_second=20)
+    start = time.monotonic()
+    values = extract_landsat_points(df, ee_module=fake, verbose=False, scheduler=scheduler)
+    elapsed = time.monotonic() - start
+    _, codes = point_keys(df)
+    np.testing.assert_allclose(values, 281.0 + codes)
+    assert fake.calls == scheduler.stats['requests'] == 30
+    assert fake.throttled == 0
+    assert fake.max_in_flight <= 4
+    # the bucket holds 20 tokens, the other 10 requests are paced at 20 per second
+    assert elapsed >= 0.45
+
+def test_scheduler_retries_throttled_requests():
+    df = make_rows(n_sites=5, n_dates=15, rows_per_key=1)
+    fake = FakeEarthEngine(latency=0.01, max_calls_per_second=8)
+    scheduler = RequestScheduler(max_concurrent=4, requests_per_second=1000, max_retries=12, backoff_factor=0.05)
+    values = extract_landsat_points(df, ee_module=fake, verbose=False, scheduler=scheduler)
+    _, codes = point_keys(df)
+    np.testing.assert_allclose(values, 281.0 + codes)
+    assert fake.throttled > 0
+    assert scheduler.stats['retries'] == fake.throttled
+    assert fake.calls == 15 + fake.throttled
+
+def test_scheduler_keeps_input_order():
+    scheduler = RequestScheduler(max_concurrent=8, requests_per_second=1000)
+    delays = np.random.default_rng(0).uniform(0, 0.02, 40)
+    def work(i):
+        return scheduler.call(lambda: time.sleep(delays[i]) or i)
+    assert scheduler.map(work, range(40)) == list(range(40))
+
+def test_split_requests_go_through_scheduler():
+    df = make_rows(n_dates=1, rows_per_key=1)
+    fake = FakeEarthEngine()
+    scheduler = RequestScheduler(max_concurrent=2, requests_per_second=1000)
+    extract_landsat_points(df, ee_module=fake, verbose=False, images_per_day=1, max_points_per_request=5000,
+                           scheduler=scheduler)
+    assert fake.calls == scheduler.stats['requests'] == 3
+
+def test_cache_answers_rerun_without_requests(tmp_path):
+    df = make_rows(n_sites=20, n_dates=3)
+    cache = ExtractionCache(str(tmp_path / 'cache.sqlite'))
+    first = extract_landsat_points(df, ee_module=FakeEarthEngine(), verbose=False, cache=cache)
+    cache.close()
+
+    cache = ExtractionCache(str(tmp_path / 'cache.sqlite'))
+    fake = FakeEarthEngine()
+    second = extract_landsat_points(df, ee_module=fake, verbose=False, cache=cache)
+    assert fake.calls == 0
+    np.testing.assert_array_equal(second, first)
+    # a new date is the only miss
+    more = pd.concat([df, make_rows(n_sites=20, n_dates=4).tail(60)], ignore_index=True)
+    extract_landsat_points(more, ee_module=fake, verbose=False, cache=cache)
+    assert fake.calls == 1
+    cache.close()
+
+def test_cache_entries_expire(tmp_path):
+    df = make_rows(n_sites=20, n_dates=2)
+    path = str(tmp_path / 'cache.sqlite')
+    cache = ExtractionCache(path, max_age_days=1)
+    extract_landsat_points(df, ee_module=FakeEarthEngine(), verbose=False, cache=cache)
+    with cache.conn:
+        cache.conn.execute("UPDATE responses SET created = created - 2 * 86400")
+    fake = FakeEarthEngine()
+    extract_landsat_points(df, ee_module=fake, verbose=False, cache=cache)
+    assert fake.calls == 2
+    # the refetched entries replaced the expired ones
+    cache.evict()
+    assert cache.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 40
+    cache.close()
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ExtractionCache(str(tmp_path / 'cache.sqlite'))
+    value = [['id', 'longitude', 'latitude', 'time', 'SST']] + [['a', 0.0, 69.0, 1, 281.0]] * 100
+    cache.put_many({f'key{i}': value for i in range(5)})
+    size = cache.conn.execute("SELECT size FROM responses WHERE key = 'key0'").fetchone()[0]
+    with cache.conn:
+        cache.conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(i, f'key{i}') for i in range(5)])
+    assert set(cache.get_many(['key0'])) == {'key0'}   # key0 becomes the most recently used
+    cache.max_bytes = 3 * size
+    cache.evict()
+    remaining = {key for (key,) in cache.conn.execute("SELECT key FROM responses")}
+    assert remaining == {'key0', 'key3', 'key4'}
+    cache.close()
@@ -0,0 +1,294 @@
+'''
+# modis_local_calibration.py
+Local (NumPy/rasterio) version of the MODIS LST calibration of GEMLST_MODIS.js, so the
+gap-free daily 1 km LST can be produced on our own machines in one pass per day.
+
+## Functionality
+- Quality control as maskQualityDaytime/maskQualityNighttime: mandatory QA (bits 0-1)
+  <= 1 and data quality, emissivity error and LST error (bits 2-7) equal to 0, looked up
+  in the precomputed table of modis_qc
+- Availability pattern per pixel: MODLST_Day * 8 + MODLST_Night * 4 + MYDLST_Day * 2
+  + MYDLST_Night (1 = valid observation), as calculateAvailability
+- PatternCalibration: instead of one masked full image per pattern (applyCorrection),
+  intercept, Tx and SW_netx are gathered from 16-entry lookup tables with the pattern as
+  index and the calibrated LST is evaluated in one multiply-add over the whole grid.
+  Pattern 0 (no MODIS observation) is an entry of the same tables (Tx = 1, SW_netx = 0,
+  intercept = 0) applied to the ERA5-Land skin temperature, so the gap filling needs no
+  separate pass
+
+## Input
+Daily GeoTIFFs on the common 1 km EPSG:3413 grid of the Greenland mask:
+    MOD11A1_<YYYY-MM-DD>.tif, MYD11A1_<YYYY-MM-DD>.tif
+        bands LST_Day_1km, QC_Day, LST_Night_1km, QC_Night (raw DN, found by band
+        description, otherwise in this order); a missing file means no observations
+    ERA5Land_<YYYY-MM-DD>.tif
+        bands skin_temperature (K), surface_net_solar_radiation (J m-2), means of the
+        hourly values as day_mosaics (climate/era5land_daily_aggregation.py with grid_file)
+    greenland_mask.tif
+        OSU/GIMP/2000_ICE_OCEAN_MASK ocean_mask (0 = land/ice)
+
+## Output
+GEMLST_<YYYY-MM-DD>.tif with the bands Corrected_LST (°C, NaN outside Greenland) and
+Available_Pattern (0-15, 255 outside Greenland), as the Earth Engine export. Both bands
+are float32; the pixels outside Greenland are masked in the internal mask of the file
+(read with masked=True), which marks the pattern value 255 as nodata.
+'''
+#%%
+import os
+import re
+import sys
+import glob
+import concurrent.futures
+
+import numpy as np
+import rasterio
+from tqdm import tqdm
+
+from modis_qc import LST_QC_TABLE, apply_table
+
+# ===== CONFIGURE THESE PATHS =====
+modis_folder = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/GEMLST/data/MODIS"
+era5land_folder = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/GEMLST/data/ERA5Land_daily"
+maskfile = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/GEMLST/data/greenland_mask.tif"
+output_folder = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/GEMLST/data/GEMLST_MODIS"
+# =================================
+
+LST_SCALE = 0.02
+KELVIN = 273.15
+PATTERN_NODATA = 255
+
+# Calibration coefficients per availability pattern (GEMLST_MODIS.js)
+# pattern: (intercept, Tx, SW_netx), pattern bits MODLST_Day 8, MODLST_Night 4, MYDLST_Day 2, MYDLST_Night 1
+COEFFICIENTS = {
+    8:  (-1.34695967294259,   0.918214355203352,  4.53098106772407E-08),
+    2:  (-2.72772961154428,   0.864013566310192, -3.35940233622233E-08),
+    4:  (-0.482353446197247,  0.9232805167859,    6.28895745791016E-07),
+    1:  (-0.784992834128613,  0.906590788274843,  1.03669127251288E-06),
+    10: (-1.87107581116087,   0.905781514375017, -6.98570333719986E-08),
+    12: (-0.0945029361445182, 0.984136140624823,  6.02125454340973E-08),
+    9:  (-0.284975970024893,  0.972507056820705,  2.90972229423868E-07),
+    6:  (-0.644606390843865,  0.971834024884555, -7.48746592128951E-08),
+    3:  (-0.631502973964556,  0.976195873933907,  8.5668092908308E-08),
+    5:  (0.13822534121047,    0.972898933945562,  6.07908419848783E-07),
+    14: (-0.669653995793039,  0.970568958538719, -1.11444153642164E-07),
+    13: (0.2080247987705,     0.998557440221747,  2.29617740169069E-07),
+    11: (-0.710224635510656,  0.969619217974844,  1.17703947635499E-08),
+    7:  (-0.0074406421379301, 1.00258673602663,   8.30382103055948E-08),
+    15: (-0.155889791750814,  0.996384902208461,  2.61860711397444E-09),
+}
+
+# Observations in the order of their pattern bits: (product, LST band, QC band, bit value)
+OBSERVATIONS = [('MOD11A1', 'LST_Day_1km', 'QC_Day', 8),
+                ('MOD11A1', 'LST_Night_1km', 'QC_Night', 4),
+                ('MYD11A1', 'LST_Day_1km', 'QC_Day', 2),
+                ('MYD11A1', 'LST_Night_1km', 'QC_Night', 1)]
+MODIS_BANDS = ['LST_Day_1km', 'QC_Day', 'LST_Night_1km', 'QC_Night']
+ERA5LAND_BANDS = ['skin_temperature', 'surface_net_solar_radiation']
+
+#%% functions
+def qc_mask_lst(qc):
+    """
+    Quality mask of MOD11A1/MYD11A1 QC_Day or QC_Night (True = keep).
+
+    Bits 0-1 <= 1 (good or other quality) and bits 2-7 == 0, as maskQualityDaytime.
+    """
+    return apply_table(LST_QC_TABLE, qc)
+
+def decode_lst(lst_dn, qc):
+    """LST DN -> °C (float32), NaN where the DN is fill (0) or the QC rejects the pixel."""
+    lst = lst_dn.astype(np.float32) * np.float32(LST_SCALE) - np.float32(KELVIN)
+    lst[(lst_dn == 0) | ~qc_mask_lst(qc)] = np.nan
+    return lst
+
+class PatternCalibration:
+    """
+    Availability-pattern calibration of daily MODIS LST with 16-entry lookup tables.
+
+    For pattern p (0-15) the corrected LST is
+        T * Tx[p] + SW_net * SW_netx[p] + intercept[p]
+    with T the mean of the available MODIS LSTs (°C). For p = 0 T is the ERA5-Land skin
+    temperature (°C) and the table entry is the identity, so ERA5-Land fills the gaps.
+
+    Parameters:
+    -----------
+    coefficients : dict
+        pattern -> (intercept, Tx, SW_netx); None uses COEFFICIENTS
+    """
+    def __init__(self, coefficients=None):
+        coefficients = COEFFICIENTS if coefficients is None else coefficients
+        self.intercept = np.zeros(16, dtype=np.float32)
+        self.tx = np.ones(16, dtype=np.float32)
+        self.sw_netx = np.zeros(16, dtype=np.float32)
+        missing = [p for p in range(1, 16) if p not in coefficients]
+        if missing:
+            raise ValueError(f"No calibration coefficients for patterns {missing}")
+        for pattern, (intercept, tx, sw_netx) in coefficients.items():
+            self.intercept[pattern] = intercept
+            self.tx[pattern] = tx
+            self.sw_netx[pattern] = sw_netx
+
+    @staticmethod
+    def availability(observations):
+        """
+        Availability pattern and mean LST of the four observations.
+
+        Parameters:
+        -----------
+        observations : list of numpy.ndarray
+            MODLST_Day, MODLST_Night, MYDLST_Day, MYDLST_Night in °C (NaN = not available)
+
+        Returns:
+        --------
+        tuple
+            (pattern as uint8, mean LST as float32, NaN where the pattern is 0)
+        """
+        shape = observations[0].shape
+        pattern = np.zeros(shape, dtype=np.uint8)
+        total = np.zeros(shape, dtype=np.float32)
+        count = np.zeros(shape, dtype=np.float32)
+        for bit, lst in zip((8, 4, 2, 1), observations):
+            valid = ~np.isnan(lst)
+            pattern[valid] |= bit
+            np.add(total, lst, out=total, where=valid)
+            count += valid
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total /= count
+        return pattern, total
+
+    def apply(self, observations, skin_temperature, sw_net, landmask=None):
+        """
+        Calibrated LST of one day.
+
+        Parameters:
+        -----------
+        observations : list of numpy.ndarray
+            MODLST_Day, MODLST_Night, MYDLST_Day, MYDLST_Night in °C (NaN = not available)
+        skin_temperature : numpy.ndarray
+            ERA5-Land daily mean skin temperature (K)
+        sw_net : numpy.ndarray
+            ERA5-Land surface net solar radiation (J m-2)
+        landmask : numpy.ndarray, optional
+            True inside Greenland; outside, LST is NaN and the pattern PATTERN_NODATA
+
+        Returns:
+        --------
+        tuple
+            (Corrected_LST as float32 °C, Available_Pattern as uint8)
+        """
+        pattern, lst = self.availability(observations)
+        gap = pattern == 0
+        lst[gap] = skin_temperature[gap] - np.float32(KELVIN)
+        lst *= np.take(self.tx, pattern)
+        lst += np.take(self.sw_netx, pattern) * sw_net.astype(np.float32, copy=False)
+        lst += np.take(self.intercept, pattern)
+        if landmask is not None:
+            lst[~landmask] = np.nan
+            pattern[~landmask] = PATTERN_NODATA
+        return lst, pattern
+
+def read_bands(path, names):
+    """Read the named bands of a GeoTIFF (by band description, otherwise in the given order)."""
+    with rasterio.open(path) as src:
+        descriptions = list(src.descriptions)
+        indexes = [descriptions.index(name) + 1 if name in descriptions else i + 1
+                   for i, name in enumerate(names)]
+        return dict(zip(names, src.read(indexes)))
+
+def read_observations(date_str, shape):
+    """The four quality-controlled MODIS LSTs of a day in °C (all NaN if a product is missing)."""
+    products = {}
+    for product in ('MOD11A1', 'MYD11A1'):
+        path = os.path.join(modis_folder, f"{product}_{date_str}.tif")
+        products[product] = read_bands(path, MODIS_BANDS) if os.path.exists(path) else None
+    observations = []
+    for product, lst_band, qc_band, _ in OBSERVATIONS:
+        bands = products[product]
+        if bands is None:
+            observations.append(np.full(shape, np.nan, dtype=np.float32))
+        else:
+            observations.append(decode_lst(bands[lst_band], bands[qc_band]))
+    return observations
+
+def read_landmask(path):
+    """Greenland mask (True = land or ice) and its profile."""
+    with rasterio.open(path) as src:
+        return src.read(1) == 0, src.profile
+
+def calibrate_day(date_str, calibration, landmask, profile, overwrite=False):
+    """
+    Produce GEMLST_<date>.tif of one day.
+
+    Returns:
+    --------
+    tuple
+        (output path, fraction of Greenland pixels with a MODIS observation), the
+        fraction is None if the day was skipped
+    """
+    output_path = os.path.join(output_folder, f"GEMLST_{date_str}.tif")
+    if os.path.exists(output_path) and not overwrite:
+        return output_path, None
+    era5 = read_bands(os.path.join(era5land_folder, f"ERA5Land_{date_str}.tif"), ERA5LAND_BANDS)
+    observations = read_observations(date_str, landmask.shape)
+    lst, pattern = calibration.apply(observations, era5['skin_temperature'].astype(np.float32),
+                                     era5['surface_net_solar_radiation'], landmask)
+
+    # A GeoTIFF has one nodata value for all bands, so instead of nodata (NaN would not
+    # mark the pattern 255) the pixels outside Greenland are flagged in an internal mask
+    # valid for both bands
+    out_profile = profile.copy()
+    out_profile.update(driver='GTiff', dtype='float32', count=2, nodata=None, tiled=True,
+                       blockxsize=512, blockysize=512, compress='deflate')
+    tmp_path = output_path + '.part'
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True):
+        with rasterio.open(tmp_path, 'w', **out_profile) as dst:
+            dst.write(lst, 1)
+            dst.write(pattern.astype(np.float32), 2)
+            dst.write_mask(pattern != PATTERN_NODATA)
+            dst.descriptions = ('Corrected_LST', 'Available_Pattern')
+    os.replace(tmp_path, output_path)
+    observed = np.count_nonzero((pattern > 0) & (pattern != PATTERN_NODATA))
+    return output_path, float(observed / max(np.count_nonzero(landmask), 1))
+
+def list_dates():
+    """Dates with an ERA5-Land daily file (the base collection, as in GEMLST_MODIS.js)."""
+    dates = []
+    for path in sorted(glob.glob(os.path.join(era5land_folder, 'ERA5Land_*.tif'))):
+        match = re.search(r'(\d{4}-\d{2}-\d{2})\.tif$', path)
+        if match:
+            dates.append(match.group(1))
+    return dates
+
+def run_calibration(dates, max_workers=4, overwrite=False):
+    """
+    Calibrate many days in parallel with a thread pool.
+
+    Returns:
+    --------
+    list
+        (date, output path or None, observed fraction or error message) per day
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    calibration = PatternCalibration()
+    landmask, profile = read_landmask(maskfile)
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(calibrate_day, date_str, calibration, landmask, profile, overwrite): date_str
+                   for date_str in dates}
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Calibrating days"):
+            date_str = futures[future]
+            try:
+                output_path, observed = future.result()
+                results.append((date_str, output_path, observed))
+            except Exception as e:
+                print(f"Error processing {date_str}: {e}", file=sys.stderr)
+                results.append((date_str, None, str(e)))
+    return sorted(results)
+
+#%%
+if __name__ == "__main__":
+    dates = list_dates()
+    print(f"Found {len(dates)} days with ERA5-Land data in {era5land_folder}")
+    max_workers = int(input("Enter number of parallel days (default 4): ") or "4")
+    results = run_calibration(dates, max_workers)
+    failed = [r for r in results if r[1] is None]
+    print(f"Processed {len(results) - len(failed)} days, {len(failed)} failed")
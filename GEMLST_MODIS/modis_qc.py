@@ -0,0 +1,98 @@
+'''
+# modis_qc.py
+Lookup-table decoding of MODIS QC bit fields, the local counterpart of the
+bitwiseExtract-based quality masks of the Earth Engine scripts:
+- maskQualityDaytime / maskQualityNighttime (GEMLST_MODIS.js): MOD11A1/MYD11A1
+  QC_Day and QC_Night (8 bit)
+- maskQuality (GEMNDVI_MODIS.js): MOD09GQ/MYD09GQ QC_250m (16 bit)
+
+A QC value has only 2^8 or 2^16 possible values, so every rule set is evaluated once for
+all of them into a boolean (keep/reject) or enum (field value) table. Masking a raster or
+a whole tile stack is then a table lookup (np.take with the QC values as indexes, run in
+cache-sized chunks) instead of one shift, and and compare per field and pixel.
+
+## Usage
+    from modis_qc import LST_QC_TABLE, apply_table
+    keep = apply_table(LST_QC_TABLE, qc_day)            # bool, same shape as qc_day
+    lst_error = apply_table(LST_ERROR_TABLE, qc_day)    # uint8 field values 0-3
+'''
+#%%
+import numpy as np
+
+#%% functions
+def bitwise_extract(value, from_bit, to_bit):
+    """Value of the bits from_bit...to_bit (inclusive), as bitwiseExtract in the EE scripts."""
+    mask = (1 << (to_bit - from_bit + 1)) - 1
+    return (np.asarray(value) >> from_bit) & mask
+
+def qc_table(rules, bits=8):
+    """
+    Boolean lookup table of a QC rule set over all 2^bits QC values.
+
+    Parameters:
+    -----------
+    rules : list of tuple
+        (from_bit, to_bit, allowed field values); a QC value is kept when every field
+        has one of its allowed values
+    bits : int
+        Width of the QC band (8 or 16)
+
+    Returns:
+    --------
+    numpy.ndarray
+        bool array of length 2^bits, True = keep
+    """
+    values = np.arange(1 << bits, dtype=np.uint32)
+    table = np.ones(values.shape, dtype=bool)
+    for from_bit, to_bit, allowed in rules:
+        table &= np.isin(bitwise_extract(values, from_bit, to_bit), list(allowed))
+    return table
+
+def field_table(from_bit, to_bit, bits=8):
+    """Enum lookup table with the value of one bit field for all 2^bits QC values (uint8)."""
+    return bitwise_extract(np.arange(1 << bits, dtype=np.uint32), from_bit, to_bit).astype(np.uint8)
+
+def apply_table(table, qc, out=None, chunk_size=1 << 16):
+    """
+    Look up a QC raster or stack in a table with np.take.
+
+    The lookup runs over chunks of chunk_size values: np.take converts the indexes to
+    intp first, and per chunk that temporary stays in cache instead of being a full
+    8-byte-per-pixel copy of the stack.
+
+    Parameters:
+    -----------
+    table : numpy.ndarray
+        Lookup table from qc_table or field_table
+    qc : numpy.ndarray
+        Integer QC values of any shape (values beyond the table are clipped to its last entry)
+    out : numpy.ndarray, optional
+        C-contiguous output buffer of the shape of qc and the dtype of table, reused across calls
+
+    Returns:
+    --------
+    numpy.ndarray
+        Table values in the shape of qc
+    """
+    qc = np.ascontiguousarray(qc)
+    out = np.empty(qc.shape, dtype=table.dtype) if out is None else out
+    flat_qc, flat_out = qc.reshape(-1), out.reshape(-1)
+    for start in range(0, flat_qc.size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        np.take(table, flat_qc[chunk], out=flat_out[chunk], mode='clip')
+    return out
+
+# MOD11A1/MYD11A1 QC_Day and QC_Night (maskQualityDaytime, maskQualityNighttime)
+# Bits 0-1 mandatory QA: 0 good quality, 1 other quality (allowed), 2 cloud, 3 other reasons
+# Bits 2-3 data quality, bits 4-5 emissivity error, bits 6-7 LST error: 0 only
+LST_QC_RULES = [(0, 1, {0, 1}), (2, 3, {0}), (4, 5, {0}), (6, 7, {0})]
+LST_QC_TABLE = qc_table(LST_QC_RULES, 8)
+LST_MANDATORY_TABLE = field_table(0, 1, 8)
+LST_EMISSIVITY_ERROR_TABLE = field_table(4, 5, 8)
+LST_ERROR_TABLE = field_table(6, 7, 8)
+
+# MOD09GQ/MYD09GQ QC_250m (maskQuality)
+# Bits 0-1 land QA: 0 ideal quality only; bits 4-7 band 1 and bits 8-11 band 2 data quality: 0 only
+SR250_QC_RULES = [(0, 1, {0}), (4, 7, {0}), (8, 11, {0})]
+SR250_QC_TABLE = qc_table(SR250_QC_RULES, 16)
+SR250_LAND_QA_TABLE = field_table(0, 1, 16)
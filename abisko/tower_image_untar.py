@@ -1,34 +1,241 @@
 """
 Script to extract all tar files from a source directory to a target directory.
 Simply modify the source_dir and target_dir variables below to specify your folders.
+
+Re-runs are incremental: an extraction manifest (.untar_manifest.json in the target
+directory) records the size, mtime and SHA-256 of every archive together with the size
+and mtime of each member. Archives that are unchanged and already fully extracted are
+skipped without being opened, and members already on disk are not overwritten again.
+Set member_pattern to only extract matching members (glob or regex).
+
+While extracting, every file is also recorded in an SQLite catalogue
+(frame_catalogue.sqlite in the target directory) with the timestamp parsed from its
+path/name, its folder, size and relative path. The catalogue is indexed by time and
+folder, so frames around e.g. a Landsat overpass can be found without walking the tree.
+When an archive changes, its rows are replaced, so frames it no longer holds drop out:
+
+    frames = query_frames(target_dir, datetime(2023, 7, 14, 10, 35), window=timedelta(minutes=30))
 """
 #%%
 import os
+import re
+import json
+import fnmatch
+import hashlib
 import tarfile
 from pathlib import Path
 import sys
+import sqlite3
+from datetime import datetime, timedelta
 from tqdm import tqdm
 #%%
 # ===== CONFIGURE THESE PATHS =====
 source_dir = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/1_Simon/1_Abisko/6_Tower_Data/Tower Thermal images/1 Data"  # Change this to your source folder path
 target_dir =  "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/1_Simon/1_Abisko/6_Tower_Data/Tower Thermal images/2_Extracted_Data_Shunan"  # Change this to your target folder path
+member_pattern = None   # Only extract matching members, e.g. "*.jpg" (None extracts everything)
+pattern_type = "glob"   # "glob" or "regex"
 # =================================
 #%%
-def untar_files(source_dir, target_dir):
+MANIFEST_NAME = ".untar_manifest.json"
+CATALOGUE_NAME = "frame_catalogue.sqlite"
+
+# Timestamps in file/folder names, e.g. 20230714_103512, 2023-07-14T10-35-12, 2023-07-14 10.35.12
+TIMESTAMP_RE = re.compile(
+    r'(?<!\d)(\d{4})[-_]?(\d{2})[-_]?(\d{2})[T_\- ]?(\d{2})[-_:.h]?(\d{2})[-_:.m]?(\d{2})(?!\d)'
+)
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(target_dir):
+    """Load the extraction manifest from target_dir, or return an empty one."""
+    manifest_path = Path(target_dir) / MANIFEST_NAME
+    if manifest_path.exists():
+        try:
+            with open(manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not read manifest '{manifest_path}' ({e}), starting a new one", file=sys.stderr)
+    return {'archives': {}}
+
+def save_manifest(manifest, target_dir):
+    """Write the manifest atomically so an interrupted run never leaves it half-written."""
+    manifest_path = Path(target_dir) / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def compile_member_filter(pattern, pattern_type="glob"):
+    """
+    Build a predicate selecting tar members by name.
+
+    Glob patterns are matched against both the full member path and its base name,
+    so "t2m_elvcorr_2001*" also selects "KO30m/t2m_elvcorr_2001_01.nc".
+    Regex patterns are searched in the full member path.
+    Returns None when no pattern is given (all members selected).
+    """
+    if not pattern:
+        return None
+    if pattern_type == "glob":
+        return lambda name: fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(os.path.basename(name), pattern)
+    if pattern_type == "regex":
+        regex = re.compile(pattern)
+        return lambda name: regex.search(name) is not None
+    raise ValueError(f"Unknown pattern_type '{pattern_type}', use 'glob' or 'regex'")
+
+def member_on_disk(extract_dir, name, record):
+    """Check that a member exists in extract_dir with the size and mtime recorded for it."""
+    target = extract_dir / name
+    if record.get('isdir'):
+        return target.is_dir()
+    try:
+        st = target.stat()
+    except OSError:
+        return False
+    return st.st_size == record['size'] and int(st.st_mtime) == int(record['mtime'])
+
+def archive_state(tar_path, entry):
+    """
+    Compare an archive against its manifest entry.
+
+    The content hash is only computed when the size or mtime differ from the manifest
+    (or the archive is new), so unchanged multi-GB archives are not re-read.
+
+    Returns:
+    --------
+    tuple
+        (unchanged, size, mtime, sha256)
+    """
+    st = tar_path.stat()
+    if entry and entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime:
+        return True, st.st_size, st.st_mtime, entry.get('sha256')
+    sha256 = file_sha256(tar_path)
+    unchanged = bool(entry) and entry.get('sha256') == sha256
+    return unchanged, st.st_size, st.st_mtime, sha256
+
+def parse_frame_timestamp(rel_path):
+    """
+    Parse the acquisition time of a frame from its relative path.
+
+    The file name is tried first, then the full path (for timestamps that are only
+    encoded in the folder names). Returns an ISO 'YYYY-MM-DD HH:MM:SS' string, which
+    sorts chronologically in SQLite, or None if no valid timestamp is found.
+    """
+    rel_path = str(rel_path).replace(os.sep, '/')
+    for text in (os.path.basename(rel_path), rel_path):
+        for match in TIMESTAMP_RE.finditer(text):
+            try:
+                return datetime(*map(int, match.groups())).strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                continue
+    return None
+
+def open_catalogue(target_dir):
+    """Open (and create if needed) the frame catalogue in target_dir."""
+    conn = sqlite3.connect(Path(target_dir) / CATALOGUE_NAME)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS frames (
+            relpath   TEXT PRIMARY KEY,
+            folder    TEXT NOT NULL,
+            timestamp TEXT,
+            size      INTEGER,
+            archive   TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_frames_time ON frames (timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_frames_folder_time ON frames (folder, timestamp)")
+    return conn
+
+def catalogue_archive(conn, archive, target_dir, extract_dir, members, member_filter=None):
+    """
+    Replace the catalogue rows of one archive by its selected file members present on disk.
+
+    The old rows are deleted first, so frames of a previous version of the archive that
+    no longer exist do not stay in the catalogue.
+    """
+    rows = []
+    for name, record in members.items():
+        if record.get('isdir') or (member_filter is not None and not member_filter(name)):
+            continue
+        if not member_on_disk(extract_dir, name, record):
+            continue
+        rel_path = (extract_dir / name).relative_to(target_dir).as_posix()
+        folder = os.path.dirname(rel_path)
+        rows.append((rel_path, folder, parse_frame_timestamp(rel_path), record['size'], archive))
+
+    with conn:
+        conn.execute("DELETE FROM frames WHERE archive = ?", (archive,))
+        conn.executemany("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+def query_frames(target_dir, when, window=timedelta(minutes=30), folder=None):
+    """
+    Find catalogued frames within +/- window of a given time.
+
+    Parameters:
+    -----------
+    target_dir : str or Path
+        Extraction directory holding the catalogue
+    when : datetime
+        Centre of the time window (e.g. a Landsat overpass time)
+    window : timedelta
+        Half-width of the time window
+    folder : str, optional
+        Restrict the search to this folder (relative to target_dir) and its subfolders
+
+    Returns:
+    --------
+    list of tuple
+        (timestamp, folder, relpath, size) ordered by time
+    """
+    start = (when - window).strftime('%Y-%m-%d %H:%M:%S')
+    end = (when + window).strftime('%Y-%m-%d %H:%M:%S')
+    sql = "SELECT timestamp, folder, relpath, size FROM frames WHERE timestamp BETWEEN ? AND ?"
+    params = [start, end]
+    if folder is not None:
+        folder = str(folder).replace(os.sep, '/').strip('/')
+        sql += " AND (folder = ? OR folder LIKE ?)"
+        params += [folder, folder + '/%']
+    sql += " ORDER BY timestamp"
+    conn = sqlite3.connect(Path(target_dir) / CATALOGUE_NAME)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+def untar_files(source_dir, target_dir, member_pattern=None, pattern_type="glob"):
     """
     Recursively find and extract all .tar files from source_dir to target_dir
     while preserving the folder structure and showing a progress bar.
+
+    Archives whose size/mtime (or content hash) match the manifest and whose selected
+    members are all present on disk are skipped. Only members matching member_pattern
+    are extracted when a pattern is given. Extracted files are added to the frame catalogue;
+    the manifest records the archive size/mtime the catalogue rows were built from.
     """
     source_dir = Path(source_dir).resolve()
     target_dir = Path(target_dir).resolve()
-    
+
     if not source_dir.exists():
         print(f"Error: Source directory '{source_dir}' does not exist", file=sys.stderr)
         return False
-    
+
     # Create target directory if it doesn't exist
     target_dir.mkdir(parents=True, exist_ok=True)
-    
+    member_filter = compile_member_filter(member_pattern, pattern_type)
+    manifest = load_manifest(target_dir)
+    if not (target_dir / CATALOGUE_NAME).exists():
+        # A new catalogue holds none of the archives recorded as catalogued
+        for entry in manifest['archives'].values():
+            entry.pop('catalogued', None)
+    catalogue = open_catalogue(target_dir)
+
     # First collect all tar files
     print("Finding all tar files...")
     tar_files = []
@@ -39,33 +246,89 @@ def untar_files(source_dir, target_dir):
                 rel_path = Path(root).relative_to(source_dir)
                 extract_dir = target_dir / rel_path
                 tar_files.append((tar_path, extract_dir))
-    
+
     if not tar_files:
         print("No .tar files found in the source directory")
         return False
-    
+
     # Now extract each file with a progress bar
     print(f"Found {len(tar_files)} tar files. Beginning extraction...")
-    
+    skipped_archives = 0
+
     for tar_path, extract_dir in tqdm(tar_files, desc="Extracting tar files"):
+        key = str(tar_path.relative_to(source_dir))
+        entry = manifest['archives'].get(key)
+
+        try:
+            unchanged, size, mtime, sha256 = archive_state(tar_path, entry)
+        except OSError as e:
+            print(f"Error reading tar file '{tar_path}': {e}", file=sys.stderr)
+            continue
+
+        if not unchanged:
+            # New or modified archive: forget the member list of the old version
+            entry = {'members': {}}
+        entry.update({'size': size, 'mtime': mtime, 'sha256': sha256})
+        manifest['archives'][key] = entry
+
+        # The catalogue rows of an archive are current if they were written for this
+        # version (size and mtime) of the archive and the same member selection
+        catalogued = {'size': size, 'mtime': mtime, 'pattern': [member_pattern, pattern_type]}
+
+        # Skip the archive without opening it if every selected member is already on disk
+        members = entry['members']
+        if unchanged and entry.get('complete'):
+            selected = [name for name in members if member_filter is None or member_filter(name)]
+            if all(member_on_disk(extract_dir, name, members[name]) for name in selected):
+                if entry.get('catalogued') != catalogued:
+                    catalogue_archive(catalogue, key, target_dir, extract_dir, members, member_filter)
+                    entry['catalogued'] = catalogued
+                    save_manifest(manifest, target_dir)
+                skipped_archives += 1
+                continue
+
         # Create extract directory if it doesn't exist
         extract_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Extract the tar file
+
+        # Extract the selected members that are not on disk yet
         try:
             with tarfile.open(tar_path) as tar:
-                tar.extractall(path=extract_dir, filter='fully_trusted')
+                # Get list of members
+                all_members = tar.getmembers()
+                for member in all_members:
+                    members[member.name] = {'size': member.size, 'mtime': member.mtime, 'isdir': member.isdir()}
+                # The member list is now complete, later runs can decide without opening the tar
+                entry['complete'] = True
+
+                selected = [m for m in all_members if member_filter is None or member_filter(m.name)]
+                todo = [m for m in selected if not member_on_disk(extract_dir, m.name, members[m.name])]
+
+                for member in tqdm(todo, desc=f"Files in {tar_path.name}", leave=False):
+                    try:
+                        tar.extract(member, path=extract_dir, filter='fully_trusted')
+                    except Exception as e:
+                        print(f"  Error extracting '{member.name}': {e}", file=sys.stderr)
+
         except Exception as e:
-            print(f"Error extracting '{tar_path}': {e}", file=sys.stderr)
-    
-    print(f"Extraction complete! Processed {len(tar_files)} tar files")
+            print(f"Error opening tar file '{tar_path}': {e}", file=sys.stderr)
+
+        catalogue_archive(catalogue, key, target_dir, extract_dir, members, member_filter)
+        entry['catalogued'] = catalogued
+        # Save after every archive so an interrupted run resumes where it stopped
+        save_manifest(manifest, target_dir)
+
+    save_manifest(manifest, target_dir)
+    catalogue.close()
+    print(f"Extraction complete! Processed {len(tar_files)} tar files ({skipped_archives} unchanged and skipped)")
     return True
 
 if __name__ == "__main__":
     print(f"Source directory: {source_dir}")
     print(f"Target directory: {target_dir}")
+    if member_pattern:
+        print(f"Member pattern ({pattern_type}): {member_pattern}")
     
-    if untar_files(source_dir, target_dir):
+    if untar_files(source_dir, target_dir, member_pattern, pattern_type):
         print("Extraction completed successfully!")
     else:
         print("Extraction process had issues. Check the output for details.")
@@ -2,9 +2,19 @@
 Script to extract all tar files from a source directory to a target directory.
 Simply modify the source_dir and target_dir variables below to specify your folders.
 This script shows progress for both overall extraction and for individual files within each tar.
+
+Re-runs are incremental: an extraction manifest (.untar_manifest.json in the target
+directory) records the size, mtime and SHA-256 of every archive together with the size
+and mtime of each member. Archives that are unchanged and already fully extracted are
+skipped without being opened, and members already on disk are not written again.
+Set member_pattern to only extract matching members (e.g. "t2m_elvcorr_2001*").
 """
 
 import os
+import re
+import json
+import fnmatch
+import hashlib
 import tarfile
 from pathlib import Path
 import sys
@@ -13,25 +23,110 @@ from tqdm import tqdm
 # ===== CONFIGURE THESE PATHS =====
 source_dir = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/GEMLST_MODIS/ERA5"  # Change this to your source folder path
 target_dir = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/GEMLST_MODIS/ERA5"   # Change this to your target folder path
+member_pattern = None   # Only extract matching members, e.g. "t2m_elvcorr_2001*" (None extracts everything)
+pattern_type = "glob"   # "glob" or "regex"
 # =================================
 
-def untar_files(source_dir, target_dir):
+MANIFEST_NAME = ".untar_manifest.json"
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(target_dir):
+    """Load the extraction manifest from target_dir, or return an empty one."""
+    manifest_path = Path(target_dir) / MANIFEST_NAME
+    if manifest_path.exists():
+        try:
+            with open(manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not read manifest '{manifest_path}' ({e}), starting a new one", file=sys.stderr)
+    return {'archives': {}}
+
+def save_manifest(manifest, target_dir):
+    """Write the manifest atomically so an interrupted run never leaves it half-written."""
+    manifest_path = Path(target_dir) / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def compile_member_filter(pattern, pattern_type="glob"):
+    """
+    Build a predicate selecting tar members by name.
+
+    Glob patterns are matched against both the full member path and its base name,
+    so "t2m_elvcorr_2001*" also selects "KO30m/t2m_elvcorr_2001_01.nc".
+    Regex patterns are searched in the full member path.
+    Returns None when no pattern is given (all members selected).
+    """
+    if not pattern:
+        return None
+    if pattern_type == "glob":
+        return lambda name: fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(os.path.basename(name), pattern)
+    if pattern_type == "regex":
+        regex = re.compile(pattern)
+        return lambda name: regex.search(name) is not None
+    raise ValueError(f"Unknown pattern_type '{pattern_type}', use 'glob' or 'regex'")
+
+def member_on_disk(extract_dir, name, record):
+    """Check that a member exists in extract_dir with the size and mtime recorded for it."""
+    target = extract_dir / name
+    if record.get('isdir'):
+        return target.is_dir()
+    try:
+        st = target.stat()
+    except OSError:
+        return False
+    return st.st_size == record['size'] and int(st.st_mtime) == int(record['mtime'])
+
+def archive_state(tar_path, entry):
+    """
+    Compare an archive against its manifest entry.
+
+    The content hash is only computed when the size or mtime differ from the manifest
+    (or the archive is new), so unchanged multi-GB archives are not re-read.
+
+    Returns:
+    --------
+    tuple
+        (unchanged, size, mtime, sha256)
+    """
+    st = tar_path.stat()
+    if entry and entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime:
+        return True, st.st_size, st.st_mtime, entry.get('sha256')
+    sha256 = file_sha256(tar_path)
+    unchanged = bool(entry) and entry.get('sha256') == sha256
+    return unchanged, st.st_size, st.st_mtime, sha256
+
+def untar_files(source_dir, target_dir, member_pattern=None, pattern_type="glob"):
     """
     Recursively find and extract all .tar files from source_dir to target_dir
     while preserving the folder structure and showing nested progress bars:
     - Outer progress bar for all tar files
     - Inner progress bar for files within each tar
+
+    Archives whose size/mtime (or content hash) match the manifest and whose selected
+    members are all present on disk are skipped. Only members matching member_pattern
+    are extracted when a pattern is given.
     """
     source_dir = Path(source_dir).resolve()
     target_dir = Path(target_dir).resolve()
-    
+
     if not source_dir.exists():
         print(f"Error: Source directory '{source_dir}' does not exist", file=sys.stderr)
         return False
-    
+
     # Create target directory if it doesn't exist
     target_dir.mkdir(parents=True, exist_ok=True)
-    
+    member_filter = compile_member_filter(member_pattern, pattern_type)
+    manifest = load_manifest(target_dir)
+
     # First collect all tar files
     print("Finding all tar files...")
     tar_files = []
@@ -42,49 +137,85 @@ def untar_files(source_dir, target_dir):
                 rel_path = Path(root).relative_to(source_dir)
                 extract_dir = target_dir / rel_path
                 tar_files.append((tar_path, extract_dir))
-    
+
     if not tar_files:
         print("No .tar files found in the source directory")
         return False
-    
+
     # Now extract each file with a progress bar
     print(f"Found {len(tar_files)} tar files. Beginning extraction...")
-    
+    skipped_archives = 0
+
     # Outer progress bar for all tar files
     for tar_path, extract_dir in tqdm(tar_files, desc="Extracting tar files"):
+        key = str(tar_path.relative_to(source_dir))
+        entry = manifest['archives'].get(key)
+
+        try:
+            unchanged, size, mtime, sha256 = archive_state(tar_path, entry)
+        except OSError as e:
+            print(f"Error reading tar file '{tar_path}': {e}", file=sys.stderr)
+            continue
+
+        if not unchanged:
+            # New or modified archive: forget the member list of the old version
+            entry = {'members': {}}
+        entry.update({'size': size, 'mtime': mtime, 'sha256': sha256})
+        manifest['archives'][key] = entry
+
+        # Skip the archive without opening it if every selected member is already on disk
+        members = entry['members']
+        if unchanged and entry.get('complete'):
+            selected = [name for name in members if member_filter is None or member_filter(name)]
+            if all(member_on_disk(extract_dir, name, members[name]) for name in selected):
+                skipped_archives += 1
+                continue
+
         # Create extract directory if it doesn't exist
         extract_dir.mkdir(parents=True, exist_ok=True)
-        
+
         # Extract the tar file with progress for internal files
         try:
             with tarfile.open(tar_path) as tar:
                 # Get list of members
-                members = tar.getmembers()
-                num_files = len(members)
-                
+                all_members = tar.getmembers()
+                for member in all_members:
+                    members[member.name] = {'size': member.size, 'mtime': member.mtime, 'isdir': member.isdir()}
+                # The member list is now complete, later runs can decide without opening the tar
+                entry['complete'] = True
+
+                selected = [m for m in all_members if member_filter is None or member_filter(m.name)]
+                todo = [m for m in selected if not member_on_disk(extract_dir, m.name, members[m.name])]
+
                 # Display tar file name
                 tar_name = tar_path.name
-                print(f"\nExtracting {tar_name} ({num_files} files)")
-                
+                print(f"\nExtracting {tar_name} ({len(todo)} of {len(selected)} selected files, {len(all_members)} in archive)")
+
                 # Inner progress bar for files within this tar
-                for member in tqdm(members, desc=f"Files in {tar_name}", leave=False):
+                for member in tqdm(todo, desc=f"Files in {tar_name}", leave=False):
                     try:
                         tar.extract(member, path=extract_dir, filter='data')
                     except Exception as e:
                         print(f"  Error extracting '{member.name}': {e}", file=sys.stderr)
-                
+
         except Exception as e:
             print(f"Error opening tar file '{tar_path}': {e}", file=sys.stderr)
-    
-    print(f"Extraction complete! Processed {len(tar_files)} tar files")
+
+        # Save after every archive so an interrupted run resumes where it stopped
+        save_manifest(manifest, target_dir)
+
+    save_manifest(manifest, target_dir)
+    print(f"Extraction complete! Processed {len(tar_files)} tar files ({skipped_archives} unchanged and skipped)")
     return True
 
 if __name__ == "__main__":
     print(f"Source directory: {source_dir}")
     print(f"Target directory: {target_dir}")
-    
-    if untar_files(source_dir, target_dir):
+    if member_pattern:
+        print(f"Member pattern ({pattern_type}): {member_pattern}")
+
+    if untar_files(source_dir, target_dir, member_pattern, pattern_type):
         print("Extraction completed successfully!")
     else:
         print("Extraction process had issues. Check the output for details.")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,133 @@
+"""
+Benchmark of the two download engines in era5downscaled_downloader_multi.py.
+
+A local HTTP stand-in for the ERA5 downscaled data server is started on localhost. It
+serves an HTML directory listing and a set of random t2m_elvcorr_*.nc files with support
+for HTTP Range requests, and can add a fixed latency to every request to mimic the
+round-trip time to the real server. The same listing is then downloaded with the
+ThreadPoolExecutor engine and with the asyncio engine, and the throughput is reported.
+
+Simply modify the settings below and run the script.
+"""
+#%%
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from era5downscaled_downloader_multi import download_matching_files
+
+# ===== CONFIGURE THE BENCHMARK =====
+num_files = 48          # number of files in the stand-in listing
+file_size_mb = 16       # size of each file
+max_workers = 8         # parallel downloads for both engines
+latency_ms = 20         # added to every request to mimic the server round trip
+engines = ["threads", "asyncio"]
+# ===================================
+
+#%%
+def make_handler(file_dir, latency):
+    """Create a request handler serving file_dir with a listing page and Range support."""
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            name = self.path.lstrip('/')
+            if not name:
+                names = sorted(os.listdir(file_dir))
+                body = ''.join(f'<a href="{n}">{n}</a><br>' for n in names).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            path = os.path.join(file_dir, os.path.basename(name))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            size = os.path.getsize(path)
+            start = 0
+            match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(size - start))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                f.seek(start)
+                shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    return StandInHandler
+
+def start_stand_in_server(file_dir, latency=0.0):
+    """Start the stand-in server on a free localhost port and return it with its base URL."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(file_dir, latency))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+def create_test_files(file_dir, num_files, file_size_mb):
+    """Write num_files random files named like the ERA5 downscaled NetCDFs."""
+    os.makedirs(file_dir, exist_ok=True)
+    for i in range(num_files):
+        with open(os.path.join(file_dir, f"t2m_elvcorr_2001_{i:03d}.nc"), 'wb') as f:
+            for _ in range(file_size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+def run_benchmark(num_files=48, file_size_mb=16, max_workers=8, latency_ms=20, engines=("threads", "asyncio")):
+    """
+    Download the stand-in listing once per engine and report time and throughput.
+
+    Returns:
+    --------
+    dict
+        engine -> (elapsed seconds, MB/s)
+    """
+    work_dir = tempfile.mkdtemp(prefix="era5_download_benchmark_")
+    file_dir = os.path.join(work_dir, "server")
+    create_test_files(file_dir, num_files, file_size_mb)
+    server, base_url = start_stand_in_server(file_dir, latency_ms / 1000)
+    total_mb = num_files * file_size_mb
+
+    timings = {}
+    try:
+        for engine in engines:
+            dest_path = os.path.join(work_dir, engine)
+            start_time = time.perf_counter()
+            results = download_matching_files(base_url, "user", "password", r"t2m_elvcorr_2001.*\.nc",
+                                              dest_path, max_workers, engine=engine)
+            elapsed_time = time.perf_counter() - start_time
+            if not results or not all(success for success, _, _ in results):
+                print(f"Warning: not all files were downloaded with the {engine} engine")
+            timings[engine] = (elapsed_time, total_mb / elapsed_time)
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n{num_files} files x {file_size_mb} MB, {max_workers} workers, {latency_ms} ms latency")
+    for engine, (elapsed_time, throughput) in timings.items():
+        print(f"{engine:>8}: {elapsed_time:8.2f} s  {throughput:8.1f} MB/s")
+    return timings
+
+#%%
+if __name__ == "__main__":
+    run_benchmark(num_files, file_size_mb, max_workers, latency_ms, engines)
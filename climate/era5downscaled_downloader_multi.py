@@ -1,20 +1,289 @@
 #%%
 import requests
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import re
+import random
+import threading
 from urllib.parse import urljoin
 from bs4 import BeautifulSoup
 import getpass
+import json
+import hashlib
 from tqdm import tqdm
 import concurrent.futures
+import asyncio
 import time
 
 #%%
-def download_single_file(session, file_url, local_path):
+class BandwidthLimiter:
+    """
+    Token bucket shared by all download threads to cap the total transfer rate.
+    
+    Parameters:
+    -----------
+    max_bytes_per_second : float
+        Total bandwidth allowed across all downloads
+    """
+    def __init__(self, max_bytes_per_second):
+        self.rate = float(max_bytes_per_second)
+        # Allow bursts of up to one second worth of data
+        self.capacity = self.rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, num_bytes):
+        """Take num_bytes from the bucket and return how long the caller has to wait (seconds)."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= num_bytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def consume(self, num_bytes):
+        """Block until num_bytes may be transferred without exceeding the rate."""
+        wait = self.reserve(num_bytes)
+        if wait > 0:
+            time.sleep(wait)
+
+INTEGRITY_MANIFEST_NAME = ".era5_integrity_manifest.json"
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class IntegrityManifest:
+    """
+    Size and SHA-256 of every file under a folder, kept in .era5_integrity_manifest.json
+    
+    Files are hashed in a background thread pool (hashlib releases the GIL), so a file is
+    hashed as soon as its download finishes while other downloads keep streaming.
+    
+    Parameters:
+    -----------
+    root : str
+        Folder holding the files; manifest keys are paths relative to it
+    hash_workers : int
+        Number of threads hashing files
+    """
+    def __init__(self, root, hash_workers=2):
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root, INTEGRITY_MANIFEST_NAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=hash_workers)
+        self.futures = []
+        self.unverified = []
+
+    def key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, '/')
+
+    def _record(self, path):
+        size = os.path.getsize(path)
+        sha256 = file_sha256(path)
+        with self.lock:
+            self.entries[self.key(path)] = {'size': size, 'sha256': sha256}
+
+    def submit(self, path):
+        """Queue a file for hashing."""
+        self.futures.append(self.executor.submit(self._record, path))
+
+    def record_download(self, path, message):
+        """Hash a downloaded file, and skipped existing files that are not in the manifest yet."""
+        if not message.startswith("File already exists") or self.key(path) not in self.entries:
+            self.submit(path)
+
+    def remove(self, path):
+        with self.lock:
+            self.entries.pop(self.key(path), None)
+
+    def save(self):
+        """Write the manifest atomically."""
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+    def close(self):
+        """Wait for pending hashes and save the manifest."""
+        for future in concurrent.futures.as_completed(self.futures):
+            try:
+                future.result()
+            except OSError as e:
+                print(f"\nError hashing file: {e}")
+        self.futures = []
+        self.executor.shutdown()
+        self.save()
+
+    def untracked_files(self, recursive=True):
+        """Files under root that are not in the manifest (partial and hidden files excluded)."""
+        untracked = []
+        for dirpath, dirnames, files in os.walk(self.root):
+            if not recursive:
+                dirnames.clear()
+            for name in files:
+                if name.startswith('.') or name.endswith(('.part', '.tmp')):
+                    continue
+                path = os.path.join(dirpath, name)
+                if self.key(path) not in self.entries:
+                    untracked.append(path)
+        return untracked
+
+    def verify(self, max_workers=4, recursive=True, remote_size=None):
+        """
+        Re-check every recorded file in parallel against its size and SHA-256
+        
+        Files found on disk but not in the manifest (in subfolders too if recursive) are
+        not trusted: they are only hashed and added to the manifest when their size
+        matches the server-side size given by remote_size, and count as corrupt when it
+        does not. Without a server-side size they stay untracked and are listed in
+        self.unverified.
+        
+        Parameters:
+        -----------
+        max_workers : int
+            Number of threads hashing files
+        recursive : bool
+            Also look for untracked files in subfolders
+        remote_size : callable, optional
+            Manifest key -> size of the file on the server (None if unknown)
+        
+        Returns:
+        --------
+        list of str
+            Manifest keys of files that are missing or do not match
+        """
+        def check(key, entry):
+            path = os.path.join(self.root, key)
+            if not os.path.exists(path) or os.path.getsize(path) != entry['size']:
+                return key
+            return None if file_sha256(path) == entry['sha256'] else key
+
+        def check_untracked(path):
+            key = self.key(path)
+            size = remote_size(key) if remote_size is not None else None
+            if size is None:
+                with self.lock:
+                    self.unverified.append(key)
+                return None
+            if os.path.getsize(path) != size:
+                return key
+            self._record(path)
+            return None
+
+        with self.lock:
+            items = list(self.entries.items())
+        untracked = self.untracked_files(recursive)
+        self.unverified = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(check, key, entry) for key, entry in items]
+            futures += [executor.submit(check_untracked, path) for path in untracked]
+            bad = [future.result() for future in tqdm(futures, desc="Verifying files", unit="file")]
+        if self.unverified:
+            print(f"{len(self.unverified)} untracked files could not be checked against the server "
+                  f"and were not added to the manifest.")
+        return sorted(key for key in bad if key)
+
+def create_session(username, password, max_workers=4, max_retries=5, backoff_factor=1.0):
+    """
+    Create an authenticated session whose connection pool fits the worker count
+    
+    The urllib3 pool defaults to 10 connections per host; with more workers than that,
+    connections are discarded and re-opened for every file. Mounting an HTTPAdapter with
+    pool_maxsize=max_workers keeps one keep-alive connection per worker. Connection
+    errors and transient 5xx/429 responses are retried with exponential backoff.
+    
+    Parameters:
+    -----------
+    username : str
+        Username for authentication
+    password : str
+        Password for authentication
+    max_workers : int
+        Number of parallel downloads sharing the session
+    max_retries : int
+        Number of retries for failed connections and 5xx/429 responses
+    backoff_factor : float
+        Base delay in seconds of the exponential backoff (1, 2, 4, ... x backoff_factor)
+    
+    Returns:
+    --------
+    requests.Session
+        Authenticated session with a sized, retrying connection pool
+    """
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(username, password)
+    retry_kwargs = dict(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True,
+    )
+    try:
+        # urllib3 >= 2 adds random jitter to the backoff itself
+        retry = Retry(backoff_jitter=backoff_factor, **retry_kwargs)
+    except TypeError:
+        retry = Retry(**retry_kwargs)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, pool_block=True, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def content_range_total(header):
+    """Return the total size from a Content-Range header ('bytes 0-99/1234' or 'bytes */1234')."""
+    if header and '/' in header:
+        total = header.rsplit('/', 1)[1].strip()
+        if total.isdigit():
+            return int(total)
+    return None
+
+def adopt_truncated_file(local_path, remote_size):
+    """
+    Check an existing final file against the size of the file on the server
+    
+    A file shorter than the remote file (left by a download without .part handling) is
+    moved to local_path + '.part' so the download resumes from it, unless a longer .part
+    file exists; a file of another size is removed.
+    
+    Returns:
+    --------
+    bool
+        False if the file is complete (or the remote size is unknown) and can be skipped
+    """
+    size = os.path.getsize(local_path)
+    if remote_size is None or size == remote_size:
+        return False
+    part_path = local_path + '.part'
+    if size < remote_size and (not os.path.exists(part_path) or os.path.getsize(part_path) < size):
+        os.replace(local_path, part_path)
+    else:
+        os.remove(local_path)
+    print(f"\n{os.path.basename(local_path)}: {size} bytes on disk but {remote_size} on the server, downloading again")
+    return True
+
+def download_single_file(session, file_url, local_path, chunk_size=8192, limiter=None):
     """
     Download a single file with the given session
     
+    The file is written to local_path + '.part' and only renamed to local_path once its
+    size matches the Content-Length announced by the server. If a .part file from an
+    interrupted download exists, the transfer resumes from its end with an HTTP Range
+    request; servers that ignore Range simply send the whole file again. An existing
+    local_path is only skipped if its size matches the server (HEAD request), see
+    adopt_truncated_file.
+    
     Parameters:
     -----------
     session : requests.Session
@@ -23,35 +292,335 @@ def download_single_file(session, file_url, local_path):
         URL of the file to download
     local_path : str
         Local path to save the file
+    chunk_size : int
+        Number of bytes read from the response per write
+    limiter : BandwidthLimiter, optional
+        Shared limiter throttling the total download rate
     
     Returns:
     --------
     tuple
         (success, file_name, error_message)
     """
+    return _download_attempt(session, file_url, local_path, chunk_size, limiter)[0]
+
+def _download_attempt(session, file_url, local_path, chunk_size=8192, limiter=None):
+    """
+    download_single_file, also telling whether a failure is worth retrying
+    
+    Only broken or incomplete transfers are retried: HTTP status errors (4xx, and 429/5xx
+    once the session's own retries are used up) and local errors are final.
+    
+    Returns:
+    --------
+    tuple
+        ((success, file_name, error_message), retryable)
+    """
     try:
         file_name = os.path.basename(file_url)
         
-        # Skip if file already exists and has content
+        part_path = local_path + '.part'
         if os.path.exists(local_path) and os.path.getsize(local_path) > 0:
-            return (True, file_name, "File already exists, skipped")
+            # Completed downloads are only ever renamed into place, but files written by
+            # older versions of this script may be truncated: compare with the server
+            if not adopt_truncated_file(local_path, remote_file_info(session, file_url)['size']):
+                return (True, file_name, "File already exists, skipped"), False
         
-        response = session.get(file_url, stream=True)
-        response.raise_for_status()
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
         
-        with open(local_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:  # filter out keep-alive chunks
-                    f.write(chunk)
+        with session.get(file_url, stream=True, headers=headers) as response:
+            if response.status_code == 416:
+                # Range not satisfiable: the .part file may already hold the whole file
+                total = content_range_total(response.headers.get('Content-Range'))
+                if total is not None and total == offset:
+                    os.replace(part_path, local_path)
+                    return (True, file_name, "Success (completed from partial file)"), False
+                # The partial file does not match the remote file, start over next time
+                os.remove(part_path)
+                return (False, file_name, "Partial file did not match remote file, removed"), True
+            response.raise_for_status()
+            
+            if offset and response.status_code == 206:
+                mode = 'ab'
+            else:
+                # Full response (no partial file, or the server ignored the Range header)
+                offset = 0
+                mode = 'wb'
+            content_length = response.headers.get('Content-Length')
+            expected_size = offset + int(content_length) if content_length is not None else None
+            
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:  # filter out keep-alive chunks
+                        if limiter is not None:
+                            limiter.consume(len(chunk))
+                        f.write(chunk)
         
-        return (True, file_name, "Success")
-    except requests.exceptions.RequestException as e:
-        return (False, os.path.basename(file_url), str(e))
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size != expected_size:
+            return (False, file_name, f"Incomplete download ({size} of {expected_size} bytes), will resume on next run"), True
+        
+        # Atomic rename: local_path either does not exist or is complete
+        os.replace(part_path, local_path)
+        return (True, file_name, f"Success (resumed at byte {offset})" if offset else "Success"), False
+    except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout) as e:
+        # Transfer broken off (the session retries failed connects and 429/5xx itself)
+        return (False, os.path.basename(file_url), str(e)), True
     except Exception as e:
-        return (False, os.path.basename(file_url), str(e))
+        return (False, os.path.basename(file_url), str(e)), False
+
+def download_with_retries(session, file_url, local_path, max_retries=5, backoff_factor=1.0, limiter=None):
+    """
+    Call download_single_file until it succeeds, waiting with exponential backoff and jitter
+    
+    The session already retries failed connections and 429/5xx responses; this only
+    covers transfers that break off mid-stream or end short, so the two retry layers do
+    not multiply. Each retry resumes from the .part file. HTTP errors such as 401, 403
+    or 404 are returned at once.
+    
+    Returns:
+    --------
+    tuple
+        (success, file_name, error_message) of the last attempt
+    """
+    for attempt in range(max_retries + 1):
+        result, retryable = _download_attempt(session, file_url, local_path, limiter=limiter)
+        if result[0] or not retryable or attempt == max_retries:
+            return result
+        # Full jitter: sleep a random time up to the exponential backoff delay
+        time.sleep(random.uniform(0, backoff_factor * 2 ** attempt))
+    return result
+
+def retryable_status(status):
+    """True for HTTP statuses worth retrying: 408, 429 and 5xx (other 4xx are final)."""
+    return status in (408, 429) or status >= 500
+
+async def download_single_file_async(session, file_url, local_path, chunk_size=1024 * 1024,
+                                     limiter=None, byte_pbar=None):
+    """
+    asyncio counterpart of download_single_file, using an aiohttp session
+    
+    Follows the same .part / Range / Content-Length rules, but streams in large chunks
+    (1 MiB by default) and hands the disk writes to a worker thread so that slow writes
+    to a network share do not stall the other transfers on the event loop.
+    
+    Returns:
+    --------
+    tuple
+        (success, file_name, error_message)
+    """
+    return (await _download_attempt_async(session, file_url, local_path, chunk_size, limiter, byte_pbar))[0]
+
+async def _download_attempt_async(session, file_url, local_path, chunk_size=1024 * 1024,
+                                  limiter=None, byte_pbar=None):
+    """
+    download_single_file_async, also telling whether a failure is worth retrying
+    
+    As in _download_attempt, broken or incomplete transfers are retried. The aiohttp
+    session has no retry layer of its own, so 408, 429 and 5xx responses are retried
+    here too; other HTTP errors (401, 403, 404, ...) and local errors are final.
+    
+    Returns:
+    --------
+    tuple
+        ((success, file_name, error_message), retryable)
+    """
+    import aiohttp
+    
+    file_name = os.path.basename(file_url)
+    try:
+        part_path = local_path + '.part'
+        if os.path.exists(local_path) and os.path.getsize(local_path) > 0:
+            # As in download_single_file: check an existing file against the remote size
+            async with session.head(file_url, allow_redirects=True) as head:
+                head.raise_for_status()
+                remote_size = head.content_length
+            if not adopt_truncated_file(local_path, remote_size):
+                return (True, file_name, "File already exists, skipped"), False
+        
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        
+        async with session.get(file_url, headers=headers) as response:
+            if response.status == 416:
+                # Range not satisfiable: the .part file may already hold the whole file
+                total = content_range_total(response.headers.get('Content-Range'))
+                if total is not None and total == offset:
+                    os.replace(part_path, local_path)
+                    return (True, file_name, "Success (completed from partial file)"), False
+                os.remove(part_path)
+                return (False, file_name, "Partial file did not match remote file, removed"), True
+            response.raise_for_status()
+            
+            if offset and response.status == 206:
+                mode = 'ab'
+            else:
+                offset = 0
+                mode = 'wb'
+            expected_size = offset + response.content_length if response.content_length is not None else None
+            
+            with open(part_path, mode) as f:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    if limiter is not None:
+                        wait = limiter.reserve(len(chunk))
+                        if wait > 0:
+                            await asyncio.sleep(wait)
+                    await asyncio.to_thread(f.write, chunk)
+                    if byte_pbar is not None:
+                        byte_pbar.update(len(chunk))
+        
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size != expected_size:
+            return (False, file_name, f"Incomplete download ({size} of {expected_size} bytes), will resume on next run"), True
+        
+        os.replace(part_path, local_path)
+        return (True, file_name, f"Success (resumed at byte {offset})" if offset else "Success"), False
+    except aiohttp.ClientResponseError as e:
+        return (False, file_name, str(e) or type(e).__name__), retryable_status(e.status)
+    except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        # Transfer broken off or connection failed
+        return (False, file_name, str(e) or type(e).__name__), True
+    except Exception as e:
+        return (False, file_name, str(e) or type(e).__name__), False
+
+async def download_files_async(download_tasks, username, password, max_workers=4, max_retries=5,
+                               backoff_factor=1.0, limiter=None, chunk_size=1024 * 1024, manifest=None):
+    """
+    Download (url, local_path) tasks concurrently on a single asyncio event loop
+    
+    At most max_workers transfers run at once, over a connection pool of the same size.
+    Broken transfers and 408/429/5xx responses are retried with exponential backoff and
+    jitter, resuming from the .part file; other HTTP errors (401, 403, 404) fail at once. The file and byte progress bars are both
+    driven from the event loop. Finished files are handed to the manifest for hashing.
+    
+    Returns:
+    --------
+    list of tuple
+        (success, file_name, error_message) per task, in task order
+    """
+    import aiohttp
+    
+    semaphore = asyncio.Semaphore(max_workers)
+    connector = aiohttp.TCPConnector(limit=max_workers)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+    auth = aiohttp.BasicAuth(username, password)
+    
+    async with aiohttp.ClientSession(auth=auth, connector=connector, timeout=timeout) as session:
+        with tqdm(total=len(download_tasks), desc="Downloading files", unit="file") as pbar, \
+             tqdm(desc="Downloaded", unit="B", unit_scale=True, unit_divisor=1024, leave=False) as byte_pbar:
+            
+            async def fetch(url, path):
+                for attempt in range(max_retries + 1):
+                    async with semaphore:
+                        result, retryable = await _download_attempt_async(session, url, path, chunk_size, limiter,
+                                                                          byte_pbar)
+                    if result[0] or not retryable or attempt == max_retries:
+                        break
+                    await asyncio.sleep(random.uniform(0, backoff_factor * 2 ** attempt))
+                if not result[0]:
+                    print(f"\nError downloading {result[1]}: {result[2]}")
+                elif manifest is not None:
+                    manifest.record_download(path, result[2])
+                pbar.update(1)
+                return result
+            
+            return await asyncio.gather(*(fetch(url, path) for url, path in download_tasks))
+
+def download_files_threaded(session, download_tasks, max_workers=4, max_retries=5, backoff_factor=1.0, limiter=None,
+                            manifest=None):
+    """
+    Download (url, local_path) tasks with a thread pool sharing one requests session
+    
+    Finished files are handed to the manifest, which hashes them while other downloads run.
+    
+    Returns:
+    --------
+    list of tuple
+        (success, file_name, error_message) per task, in completion order
+    """
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Start the download tasks
+        future_to_task = {
+            executor.submit(download_with_retries, session, url, path, max_retries, backoff_factor, limiter): (url, path)
+            for url, path in download_tasks
+        }
+        
+        # Process results with progress bar
+        with tqdm(total=len(download_tasks), desc="Downloading files", unit="file") as pbar:
+            for future in concurrent.futures.as_completed(future_to_task):
+                url, path = future_to_task[future]
+                try:
+                    result = future.result()
+                    if not result[0]:
+                        print(f"\nError downloading {result[1]}: {result[2]}")
+                    elif manifest is not None:
+                        manifest.record_download(path, result[2])
+                except Exception as e:
+                    result = (False, os.path.basename(url), str(e))
+                    print(f"\nException while downloading {result[1]}: {e}")
+                results.append(result)
+                pbar.update(1)
+    return results
+
+def parse_listing(html):
+    """Return the file names linked from an HTML directory listing."""
+    soup = BeautifulSoup(html, 'html.parser')
+    links = [link.get('href') for link in soup.find_all('a')]
+    # split links to get only the file names
+    return [link.split('/')[-1] for link in links if link]
+
+def fetch_listing(session, base_url, cached=None):
+    """
+    Fetch and parse a directory listing, revalidating a cached copy with ETag/Last-Modified
+    
+    Parameters:
+    -----------
+    session : requests.Session
+        Authenticated session
+    base_url : str
+        URL of the server directory
+    cached : dict, optional
+        Listing cache entry from a previous call ({'etag', 'last_modified', 'links'})
+    
+    Returns:
+    --------
+    tuple
+        (links, cache_entry, changed); changed is False when the server answered
+        304 Not Modified and the cached links were reused without parsing
+    """
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    response = session.get(base_url, headers=headers)
+    if response.status_code == 304 and cached:
+        return cached['links'], cached, False
+    response.raise_for_status()
+    entry = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'links': parse_listing(response.text),
+    }
+    return entry['links'], entry, True
+
+def remote_file_info(session, file_url):
+    """Return the remote size (Content-Length) and Last-Modified of a file from a HEAD request."""
+    response = session.head(file_url, allow_redirects=True)
+    response.raise_for_status()
+    content_length = response.headers.get('Content-Length')
+    return {
+        'size': int(content_length) if content_length is not None else None,
+        'mtime': response.headers.get('Last-Modified'),
+    }
 
 def download_matching_files(base_url, username, password, pattern="t2m_elvcorr_2001.*.nc", 
-                           dest_path="downloads", max_workers=4):
+                           dest_path="downloads", max_workers=4, max_retries=5, backoff_factor=1.0,
+                           max_bandwidth=None, engine="threads", integrity=True):
     """
     Download files matching the pattern from an HTTPS server with authentication,
     using parallel downloads
@@ -70,10 +639,29 @@ def download_matching_files(base_url, username, password, pattern="t2m_elvcorr_2
         Destination directory path for downloaded files
     max_workers : int
         Maximum number of parallel downloads
+    max_retries : int
+        Number of retries per file for failed connections, 5xx responses and broken transfers
+    backoff_factor : float
+        Base delay in seconds of the exponential retry backoff
+    max_bandwidth : float, optional
+        Cap on the total download rate in MB/s (None for unlimited)
+    engine : str
+        "threads" for the ThreadPoolExecutor downloader or "asyncio" for the
+        aiohttp-based downloader running every transfer on one event loop
+    integrity : bool
+        Record size and SHA-256 of each downloaded file in .era5_integrity_manifest.json
+    
+    Returns:
+    --------
+    list of tuple
+        (success, file_name, error_message) per file, or None if the listing failed
     """
-    # Create a session with authentication
-    session = requests.Session()
-    session.auth = HTTPBasicAuth(username, password)
+    if engine not in ("threads", "asyncio"):
+        raise ValueError(f"Unknown engine '{engine}', use 'threads' or 'asyncio'")
+    
+    # Create a session with authentication and a connection pool sized to the workers
+    session = create_session(username, password, max_workers, max_retries, backoff_factor)
+    limiter = BandwidthLimiter(max_bandwidth * 1024 * 1024) if max_bandwidth else None
     
     # Create destination directory
     os.makedirs(dest_path, exist_ok=True)
@@ -82,73 +670,222 @@ def download_matching_files(base_url, username, password, pattern="t2m_elvcorr_2
     
     try:
         # Try to get directory listing
-        response = session.get(base_url)
-        response.raise_for_status()
-        
-        # Parse HTML to find links
-        soup = BeautifulSoup(response.text, 'html.parser')
-        links = [link.get('href') for link in soup.find_all('a')]
-
-        # split links to get only the file names
-        links = [link.split('/')[-1] for link in links]
+        links, _, _ = fetch_listing(session, base_url)
         
         # Filter links matching our pattern
-        matching_files = [link for link in links if link and re.match(pattern, link)]
-        
-        if not matching_files:
-            print("No matching files found in directory listing.")
-            return
-            
-        num_files = len(matching_files)
-        print(f"Found {num_files} matching files.")
-        
-        # Prepare download tasks
-        download_tasks = []
-        for file_name in matching_files:
-            file_url = urljoin(base_url, file_name)
-            local_path = os.path.join(dest_path, file_name)
-            download_tasks.append((file_url, local_path))
+        regex = re.compile(pattern)
+        matching_files = [link for link in links if regex.match(link)]
+    except requests.exceptions.RequestException as e:
+        print(f"Error accessing server: {e}")
+        return None
+    
+    if not matching_files:
+        print("No matching files found in directory listing.")
+        return []
         
-        # Download files in parallel
-        successful = 0
-        failed = 0
-        failed_files = []
+    num_files = len(matching_files)
+    print(f"Found {num_files} matching files.")
+    
+    # Prepare download tasks
+    download_tasks = []
+    for file_name in matching_files:
+        file_url = urljoin(base_url, file_name)
+        local_path = os.path.join(dest_path, file_name)
+        download_tasks.append((file_url, local_path))
+    
+    # Download files in parallel
+    manifest = IntegrityManifest(dest_path) if integrity else None
+    results = run_downloads(engine, session, download_tasks, username, password, max_workers,
+                            max_retries, backoff_factor, limiter, manifest)
+    if manifest is not None:
+        manifest.close()
+    report_results(results)
+    return results
+
+def run_downloads(engine, session, download_tasks, username, password, max_workers=4, max_retries=5,
+                  backoff_factor=1.0, limiter=None, manifest=None):
+    """Download (url, local_path) tasks with the selected engine ("threads" or "asyncio")."""
+    if engine == "asyncio":
+        return asyncio.run(download_files_async(download_tasks, username, password, max_workers,
+                                                max_retries, backoff_factor, limiter, manifest=manifest))
+    return download_files_threaded(session, download_tasks, max_workers, max_retries, backoff_factor, limiter,
+                                   manifest)
+
+def report_results(results):
+    """Print a summary of (success, file_name, error_message) download results."""
+    failed_files = [(file_name, error) for success, file_name, error in results if not success]
+    successful = len(results) - len(failed_files)
+    print(f"\nDownload complete. {successful} files downloaded successfully, {len(failed_files)} files failed.")
+    if failed_files:
+        print("\nFailed files:")
+        for file_name, error in failed_files:
+            print(f"- {file_name}: {error}")
+
+SYNC_STATE_NAME = ".era5_sync_state.json"
+
+def load_sync_state(dest_path):
+    """Load the sync state file from dest_path, or return an empty state."""
+    state_path = os.path.join(dest_path, SYNC_STATE_NAME)
+    if os.path.exists(state_path):
+        try:
+            with open(state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not read sync state '{state_path}' ({e}), starting a new one")
+    return {'listings': {}, 'files': {}}
+
+def save_sync_state(state, dest_path):
+    """Write the sync state atomically."""
+    state_path = os.path.join(dest_path, SYNC_STATE_NAME)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_path + '.tmp', state_path)
+
+def local_file_current(dest_path, file_name, record):
+    """Check that a file recorded in the sync state is on disk with the recorded size."""
+    local_path = os.path.join(dest_path, file_name)
+    if record is None or not os.path.exists(local_path):
+        return False
+    return record.get('size') is None or os.path.getsize(local_path) == record['size']
+
+def sync_matching_files(base_url, username, password, pattern="t2m_elvcorr_2001.*.nc",
+                        dest_path="downloads", max_workers=4, max_retries=5, backoff_factor=1.0,
+                        max_bandwidth=None, engine="threads", integrity=True):
+    """
+    Incrementally mirror the files matching the pattern into dest_path
+    
+    The parsed directory listing is cached in a state file (.era5_sync_state.json in
+    dest_path) together with its ETag/Last-Modified, and revalidated with a conditional
+    request. When the server answers 304 Not Modified nothing is parsed and only files
+    missing locally are queued. When the listing changed, the remote size and mtime of
+    each matching file (HEAD request) are compared with the state file and only new or
+    changed files are downloaded. Files downloaded before the first sync are adopted if
+    their size matches the remote size, and fetched again otherwise.
+    
+    Parameters are the same as for download_matching_files.
+    
+    Returns:
+    --------
+    list of tuple
+        (success, file_name, error_message) per queued file, or None if the listing failed
+    """
+    session = create_session(username, password, max_workers, max_retries, backoff_factor)
+    limiter = BandwidthLimiter(max_bandwidth * 1024 * 1024) if max_bandwidth else None
+    os.makedirs(dest_path, exist_ok=True)
+    state = load_sync_state(dest_path)
+    regex = re.compile(pattern)
+    
+    print(f"Checking {base_url} for new files...")
+    try:
+        links, listing, changed = fetch_listing(session, base_url, state['listings'].get(base_url))
+        matching_files = [link for link in links if regex.match(link)]
         
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Start the download tasks
-            future_to_url = {
-                executor.submit(download_single_file, session, url, path): url 
-                for url, path in download_tasks
-            }
-            
-            # Process results with progress bar
-            with tqdm(total=num_files, desc="Downloading files", unit="file") as pbar:
-                for future in concurrent.futures.as_completed(future_to_url):
-                    url = future_to_url[future]
-                    try:
-                        success, file_name, message = future.result()
-                        if success:
-                            successful += 1
-                        else:
-                            failed += 1
-                            failed_files.append((file_name, message))
-                            print(f"\nError downloading {file_name}: {message}")
-                    except Exception as e:
-                        failed += 1
-                        file_name = os.path.basename(url)
-                        failed_files.append((file_name, str(e)))
-                        print(f"\nException while downloading {file_name}: {e}")
-                    pbar.update(1)
-        
-        # Report results
-        print(f"\nDownload complete. {successful} files downloaded successfully, {failed} files failed.")
-        if failed > 0:
-            print("\nFailed files:")
-            for file_name, error in failed_files:
-                print(f"- {file_name}: {error}")
-            
+        # Remote size/mtime: from HEAD requests when the listing changed, otherwise from
+        # the state file (only files never seen before are checked on the server)
+        infos = {name: state['files'].get(name) for name in matching_files}
+        to_check = matching_files if changed else [name for name in matching_files if infos[name] is None]
+        if not changed:
+            print("Directory listing not modified since the last sync.")
+        if to_check:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                infos.update(zip(to_check, executor.map(
+                    lambda name: remote_file_info(session, urljoin(base_url, name)), to_check)))
     except requests.exceptions.RequestException as e:
         print(f"Error accessing server: {e}")
+        return None
+    
+    queue = []
+    for name in matching_files:
+        record = state['files'].get(name)
+        remote = infos[name]
+        local_path = os.path.join(dest_path, name)
+        if record is None:
+            if os.path.exists(local_path):
+                if remote['size'] is not None and os.path.getsize(local_path) == remote['size']:
+                    # Complete file from an earlier (non-sync) download, adopt it
+                    state['files'][name] = remote
+                    continue
+                # Truncated file left by an interrupted download, fetch it again
+                os.remove(local_path)
+            queue.append(name)
+        elif (record.get('size'), record.get('mtime')) != (remote['size'], remote['mtime']):
+            # The remote file changed: drop the stale local copy and any partial download
+            for stale_path in (local_path, local_path + '.part'):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            queue.append(name)
+        elif not local_file_current(dest_path, name, record):
+            # Missing, or a local copy that does not match the recorded size
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            queue.append(name)
+    
+    state['listings'][base_url] = listing
+    print(f"{len(matching_files)} matching files, {len(queue)} new or changed.")
+    if not queue:
+        save_sync_state(state, dest_path)
+        return []
+    
+    download_tasks = [(urljoin(base_url, name), os.path.join(dest_path, name)) for name in queue]
+    manifest = IntegrityManifest(dest_path) if integrity else None
+    results = run_downloads(engine, session, download_tasks, username, password, max_workers,
+                            max_retries, backoff_factor, limiter, manifest)
+    if manifest is not None:
+        manifest.close()
+    for success, file_name, _ in results:
+        if success:
+            state['files'][file_name] = infos[file_name]
+    save_sync_state(state, dest_path)
+    report_results(results)
+    return results
+
+def verify_downloads(dest_path="downloads", base_url=None, username=None, password=None, max_workers=4,
+                     engine="threads"):
+    """
+    Re-check every file in dest_path against the integrity manifest and re-download corrupt ones
+    
+    All files are hashed in parallel. Files that are missing or whose size/SHA-256 no longer
+    match are deleted and, if base_url is given, queued for download again; intact files
+    are left untouched. Files that are not in the manifest are only adopted if base_url is
+    given and their size matches the server (HEAD request); a size mismatch counts as
+    corrupt. Without base_url they are reported as unverified and left alone.
+    
+    Returns:
+    --------
+    list of str
+        Names of the files that failed verification
+    """
+    manifest = IntegrityManifest(dest_path)
+    session = create_session(username, password, max_workers) if base_url else None
+
+    def remote_size(key):
+        try:
+            return remote_file_info(session, urljoin(base_url, key))['size']
+        except requests.exceptions.RequestException as e:
+            print(f"\nWarning: could not get the remote size of {key}: {e}")
+            return None
+
+    # Downloads are stored flat in dest_path, subfolders (e.g. untarred files) are not adopted
+    corrupt = manifest.verify(max_workers, recursive=False, remote_size=remote_size if base_url else None)
+    for key in manifest.unverified:
+        print(f"- unverified: {key}")
+    # corrupt also holds untracked files, so the intact files are counted among the entries
+    bad = set(corrupt)
+    intact = sum(1 for key in list(manifest.entries) if key not in bad)
+    print(f"{intact} files intact, {len(corrupt)} missing or corrupt.")
+    for key in corrupt:
+        print(f"- {key}")
+        path = os.path.join(dest_path, key)
+        if os.path.exists(path):
+            os.remove(path)
+        manifest.remove(path)
+    
+    if corrupt and base_url:
+        download_tasks = [(urljoin(base_url, key), os.path.join(dest_path, key)) for key in corrupt]
+        results = run_downloads(engine, session, download_tasks, username, password, max_workers, manifest=manifest)
+        report_results(results)
+    manifest.close()
+    return corrupt
 
 if __name__ == "__main__":
     server_url = input("Enter server URL (e.g., https://example.com/data/): ")
@@ -157,14 +894,29 @@ if __name__ == "__main__":
     dest_path = input("Enter destination directory path [downloads]: ") or "downloads"
     pattern = input("Enter file pattern e.g., [t2m_elvcorr_2000.*.nc]: ") or r"t2m_elvcorr_2000.*.nc"
     max_workers = input("Enter maximum number of parallel downloads [4]: ")
+    max_bandwidth = input("Enter bandwidth cap in MB/s [unlimited]: ")
+    engine = input("Enter download engine, threads or asyncio [threads]: ") or "threads"
+    mode = input("Enter mode, download, sync or verify [download]: ") or "download"
     
     try:
         max_workers = int(max_workers) if max_workers else 4
     except ValueError:
         max_workers = 4
         print("Invalid number, using default (4 parallel downloads)")
+    try:
+        max_bandwidth = float(max_bandwidth) if max_bandwidth else None
+    except ValueError:
+        max_bandwidth = None
+        print("Invalid number, downloading without bandwidth cap")
     
     start_time = time.time()
-    download_matching_files(server_url, username, password, pattern, dest_path, max_workers)
+    if mode == "verify":
+        verify_downloads(dest_path, server_url, username, password, max_workers, engine)
+    elif mode == "sync":
+        sync_matching_files(server_url, username, password, pattern, dest_path, max_workers,
+                            max_bandwidth=max_bandwidth, engine=engine)
+    else:
+        download_matching_files(server_url, username, password, pattern, dest_path, max_workers,
+                                max_bandwidth=max_bandwidth, engine=engine)
     elapsed_time = time.time() - start_time
     print(f"Total download time: {elapsed_time:.2f} seconds")
\ No newline at end of file
@@ -0,0 +1,356 @@
+"""
+Download -> verify -> extract pipeline for the ERA5 downscaled data.
+
+Instead of running era5downscaled_downloader_multi.py, era5_untar.py and
+era5downscaled_extractor.m one after the other, each stage hands every finished file
+straight to the next one through a bounded queue, so network, disk and CPU work overlap:
+
+1. Download: files matching the pattern are downloaded in parallel (resumable, with retries).
+2. Verify: .nc files are opened and checked for the t2m/X/Y/time variables; .tar archives
+   are checked, and their t2m_elvcorr*.nc members are extracted and verified one by one.
+3. Extract: t2m is interpolated (linear, as griddata in era5downscaled_extractor.m) at every
+   AWS inside the grid for all time steps of the file, and the rows are appended to the
+   output CSV (awsname, imtime, airtemp in Kelvin).
+
+The rows of a downloaded file are kept until all of its NetCDFs are extracted and are
+then appended to the CSV in one step, together with recording the file (and the CSV size
+after the append) in .era5_pipeline_state.json next to the output CSV. A restarted run
+truncates rows written after the last recorded size (an append interrupted by a crash),
+so it neither duplicates rows nor re-downloads finished files.
+With remove_raw = True the downloaded (and untarred) files are deleted once their rows
+are committed. Otherwise the size and SHA-256 of every downloaded and untarred file are
+recorded in integrity manifests (see IntegrityManifest), hashed in the background.
+Bounded queues keep at most a few files waiting between stages.
+"""
+#%%
+import os
+import sys
+import csv
+import json
+import queue
+import fnmatch
+import tarfile
+import threading
+import time
+import getpass
+from datetime import datetime, timedelta
+from urllib.parse import urljoin
+import concurrent.futures
+import re
+
+import numpy as np
+import netCDF4
+import requests
+from scipy.interpolate import LinearNDInterpolator
+
+from era5downscaled_downloader_multi import create_session, fetch_listing, download_with_retries, IntegrityManifest
+
+# ===== CONFIGURE THESE PATHS =====
+dest_path = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/Landsat_LST/data/ERA5/JAXA"   # downloaded files
+untar_path = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/Landsat_LST/data/ERA5/JAXA/untar"   # members of downloaded .tar files
+output_csv = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/Landsat_LST/data/ERA5/JAXA/aws_airtemp_era5land.csv"
+member_pattern = "t2m_elvcorr*.nc"   # members of .tar archives that are extracted
+remove_raw = False   # delete downloaded/untarred files once their rows are committed
+# =================================
+
+# AWS sites, as in era5downscaled_extractor.m
+awslist = {
+    'Kobbefjord_M500': (64.12248229980469, -51.37199020385742),
+    'Disko_T1': (69.27300262451172, -53.479400634765625),
+    'Disko_T2': (69.28909301757812, -53.43281936645508),
+    'Disko_T3': (69.2767105102539, -53.45709991455078),
+    'Disko_T4': (69.25126647949219, -53.49897003173828),
+    'Disko_AWS2': (69.25348663330078, -53.514129638671875),
+    'Zackenberg_M2': (74.46549224853516, -20.563194274902344),
+    'Zackenberg_M3': (74.50310516357422, -20.459354400634766),
+    'Zackenberg_M4': (74.47307586669922, -20.552143096923828),
+}
+
+STATE_NAME = ".era5_pipeline_state.json"
+_DONE = object()   # end-of-stream marker passed through the queues
+
+#%% functions
+def verify_netcdf(nc_path):
+    """Raise an exception if nc_path is not a readable ERA5 downscaled t2m file."""
+    with netCDF4.Dataset(nc_path) as ds:
+        missing = [name for name in ('t2m', 'X', 'Y', 'time') if name not in ds.variables]
+        if missing:
+            raise ValueError(f"missing variables {missing}")
+        # Reading the last time step touches the end of the file, catching truncation
+        ds.variables['t2m'][-1]
+
+def read_t2m(nc_path):
+    """
+    Read t2m, the lon/lat grids and the time axis of an ERA5 downscaled file.
+
+    Returns:
+    --------
+    tuple
+        (t2m [time, y, x] in Kelvin, lon [y, x], lat [y, x], times as datetimes)
+    """
+    with netCDF4.Dataset(nc_path) as ds:
+        t2m = ds.variables['t2m']
+        data = np.asarray(t2m[:, 0] if t2m.ndim == 4 else t2m[:], dtype=np.float64)
+        lon = np.asarray(ds.variables['X'][:], dtype=np.float64)
+        lat = np.asarray(ds.variables['Y'][:], dtype=np.float64)
+        days = np.asarray(ds.variables['time'][:], dtype=np.float64)
+    if lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    times = [datetime(1850, 1, 1) + timedelta(days=float(d)) for d in days]
+    return data, lon, lat, times
+
+def extract_points(data, lon, lat, stations, half_window=2):
+    """
+    Linearly interpolate all time steps at each station inside the grid.
+
+    Rather than triangulating the whole grid for every time step (griddata in MATLAB),
+    only the (2*half_window+1)^2 grid cells around the nearest cell of each station are
+    triangulated, once, and the interpolator is evaluated for all time steps together.
+
+    Returns:
+    --------
+    dict
+        awsname -> array of interpolated values per time step
+    """
+    ny, nx = lon.shape
+    values = {}
+    for awsname, (aws_lat, aws_lon) in stations.items():
+        if not (lon.min() <= aws_lon <= lon.max() and lat.min() <= aws_lat <= lat.max()):
+            continue
+        dist = (lon - aws_lon) ** 2 * np.cos(np.radians(aws_lat)) ** 2 + (lat - aws_lat) ** 2
+        iy, ix = np.unravel_index(np.argmin(dist), dist.shape)
+        ys = slice(max(iy - half_window, 0), min(iy + half_window + 1, ny))
+        xs = slice(max(ix - half_window, 0), min(ix + half_window + 1, nx))
+        points = np.column_stack([lon[ys, xs].ravel(), lat[ys, xs].ravel()])
+        window = data[:, ys, xs].reshape(data.shape[0], -1).T
+        interpolator = LinearNDInterpolator(points, window)
+        values[awsname] = interpolator([[aws_lon, aws_lat]])[0]
+    return values
+
+def load_state(output_csv):
+    """Load the set of committed files from the pipeline state next to output_csv."""
+    state_path = os.path.join(os.path.dirname(os.path.abspath(output_csv)), STATE_NAME)
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    return {'committed': []}
+
+def truncate_uncommitted(state, output_csv):
+    """Cut rows appended to output_csv after the last commit recorded in state (crash during a commit)."""
+    size = state.get('csv_size')
+    if size is None or not os.path.exists(output_csv) or os.path.getsize(output_csv) <= size:
+        return
+    print(f"Warning: removing {os.path.getsize(output_csv) - size} bytes of uncommitted rows from {output_csv}",
+          file=sys.stderr)
+    with open(output_csv, 'r+b') as f:
+        f.truncate(size)
+
+def save_state(state, output_csv):
+    """Write the pipeline state atomically."""
+    state_path = os.path.join(os.path.dirname(os.path.abspath(output_csv)), STATE_NAME)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_path + '.tmp', state_path)
+
+class RawFile:
+    """A downloaded file, the number of its NetCDFs not extracted yet and their rows."""
+    def __init__(self, path):
+        self.path = path
+        self.pending = 0
+        self.failed = False
+        self.intermediates = []
+        self.rows = []
+        self.lock = threading.Lock()
+
+def run_pipeline(base_url, username, password, pattern=r"t2m_elvcorr_2001.*\.nc", dest_path="downloads",
+                 untar_path="downloads/untar", output_csv="aws_airtemp_era5land.csv", stations=awslist,
+                 member_pattern="t2m_elvcorr*.nc", remove_raw=False, max_workers=4, verify_workers=2,
+                 extract_workers=2, queue_size=4):
+    """
+    Run the download, verification and extraction stages concurrently.
+
+    Parameters:
+    -----------
+    base_url, username, password, pattern, dest_path, max_workers :
+        As for download_matching_files in era5downscaled_downloader_multi.py
+    untar_path : str
+        Folder for the members of downloaded .tar archives
+    output_csv : str
+        CSV the extracted rows are appended to (created with a header if missing)
+    stations : dict
+        awsname -> (lat, lon) of the points to extract
+    member_pattern : str
+        Glob selecting the .tar members to extract
+    remove_raw : bool
+        Delete downloaded and untarred files once their rows are committed
+    verify_workers, extract_workers : int
+        Number of threads in the verification and extraction stages
+    queue_size : int
+        Capacity of the queues between stages (backpressure on the faster stage)
+
+    Returns:
+    --------
+    dict
+        Number of files downloaded, verified, committed and failed
+    """
+    os.makedirs(dest_path, exist_ok=True)
+    os.makedirs(untar_path, exist_ok=True)
+    os.makedirs(os.path.dirname(os.path.abspath(output_csv)), exist_ok=True)
+    session = create_session(username, password, max_workers)
+    state = load_state(output_csv)
+    truncate_uncommitted(state, output_csv)
+    committed = set(state['committed'])
+
+    # Keep integrity manifests of the files that stay on disk
+    download_manifest = None if remove_raw else IntegrityManifest(dest_path)
+    untar_manifest = None if remove_raw else IntegrityManifest(untar_path)
+
+    links, _, _ = fetch_listing(session, base_url)
+    regex = re.compile(pattern)
+    names = [link for link in links if regex.match(link) and link not in committed]
+    print(f"{len(names)} files to process ({len(committed)} already committed).")
+
+    verify_queue = queue.Queue(maxsize=queue_size)
+    extract_queue = queue.Queue(maxsize=queue_size)
+    write_lock = threading.Lock()
+    stats = {'downloaded': 0, 'verified': 0, 'committed': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+
+    def count(key):
+        with stats_lock:
+            stats[key] += 1
+
+    def fail(raw, message):
+        # A raw file counts as failed once, however many of its NetCDFs fail
+        with raw.lock:
+            if raw.failed:
+                return
+            raw.failed = True
+        count('failed')
+        print(f"\nError: {os.path.basename(raw.path)}: {message}", file=sys.stderr)
+
+    def download_stage():
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(download_with_retries, session, urljoin(base_url, name), os.path.join(dest_path, name)): name
+                for name in names
+            }
+            for future in concurrent.futures.as_completed(futures):
+                raw = RawFile(os.path.join(dest_path, futures[future]))
+                success, _, message = future.result()
+                if not success:
+                    fail(raw, message)
+                    continue
+                count('downloaded')
+                if download_manifest is not None:
+                    download_manifest.record_download(raw.path, message)
+                verify_queue.put(raw)   # blocks while the verification stage is behind
+        for _ in range(verify_workers):
+            verify_queue.put(_DONE)
+
+    def verify_stage():
+        while (raw := verify_queue.get()) is not _DONE:
+            try:
+                if raw.path.endswith('.tar'):
+                    nc_paths = []
+                    extract_dir = os.path.join(untar_path, os.path.splitext(os.path.basename(raw.path))[0])
+                    with tarfile.open(raw.path) as tar:
+                        for member in tar.getmembers():
+                            if member.isfile() and fnmatch.fnmatch(os.path.basename(member.name), member_pattern):
+                                tar.extract(member, path=extract_dir, filter='data')
+                                nc_paths.append(os.path.join(extract_dir, member.name))
+                    raw.intermediates = nc_paths
+                else:
+                    nc_paths = [raw.path]
+                for nc_path in nc_paths:
+                    verify_netcdf(nc_path)
+                    if untar_manifest is not None and nc_path != raw.path:
+                        untar_manifest.submit(nc_path)
+            except Exception as e:
+                try:
+                    os.remove(raw.path)
+                    fail(raw, f"verification failed ({e}), removed so the next run downloads it again")
+                except OSError as remove_error:
+                    fail(raw, f"verification failed ({e}), could not remove it ({remove_error})")
+                continue
+            count('verified')
+            if not nc_paths:
+                commit(raw)
+                continue
+            raw.pending = len(nc_paths)
+            for nc_path in nc_paths:
+                extract_queue.put((raw, nc_path))
+
+    def commit(raw):
+        # Called once all NetCDFs of a raw file are extracted: append its rows and record
+        # the file and the CSV size in one step, so a restart can drop a partial append
+        with write_lock:
+            new_file = not os.path.exists(output_csv)
+            with open(output_csv, 'a', newline='') as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(['awsname', 'imtime', 'airtemp'])
+                writer.writerows(raw.rows)
+                f.flush()
+                os.fsync(f.fileno())
+            raw.rows = []
+            state['committed'].append(os.path.basename(raw.path))
+            state['csv_size'] = os.path.getsize(output_csv)
+            save_state(state, output_csv)
+        count('committed')
+        if remove_raw:
+            for path in raw.intermediates + [raw.path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def extract_stage():
+        while (item := extract_queue.get()) is not _DONE:
+            raw, nc_path = item
+            try:
+                data, lon, lat, times = read_t2m(nc_path)
+                values = extract_points(data, lon, lat, stations)
+                rows = [(awsname, t.strftime('%Y-%m-%d %H:%M:%S'), v)
+                        for awsname, series in values.items() for t, v in zip(times, series)]
+            except Exception as e:
+                fail(raw, f"extraction of {os.path.basename(nc_path)} failed ({e})")
+                continue
+            with raw.lock:
+                raw.rows.extend(rows)
+                raw.pending -= 1
+                done = raw.pending == 0 and not raw.failed
+            if done:
+                commit(raw)
+
+    start_time = time.time()
+    threads = [threading.Thread(target=download_stage)]
+    threads += [threading.Thread(target=verify_stage) for _ in range(verify_workers)]
+    extractors = [threading.Thread(target=extract_stage) for _ in range(extract_workers)]
+    for thread in threads + extractors:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for _ in range(extract_workers):
+        extract_queue.put(_DONE)
+    for thread in extractors:
+        thread.join()
+    for manifest in (download_manifest, untar_manifest):
+        if manifest is not None:
+            manifest.close()
+
+    print(f"\nPipeline finished in {time.time() - start_time:.1f} s: {stats['downloaded']} downloaded, "
+          f"{stats['verified']} verified, {stats['committed']} committed, {stats['failed']} failed.")
+    return stats
+
+#%%
+if __name__ == "__main__":
+    server_url = input("Enter server URL (e.g., https://example.com/data/): ")
+    username = input("Enter username: ")
+    password = getpass.getpass("Enter password: ")
+    pattern = input("Enter file pattern e.g., [t2m_elvcorr_2000.*.nc]: ") or r"t2m_elvcorr_2000.*.nc"
+
+    try:
+        run_pipeline(server_url, username, password, pattern, dest_path, untar_path, output_csv,
+                     member_pattern=member_pattern, remove_raw=remove_raw)
+    except requests.exceptions.RequestException as e:
+        print(f"Error accessing server: {e}")
+        sys.exit(1)
@@ -0,0 +1,330 @@
+"""
+Streaming daily aggregation of ERA5-Land hourly fields.
+
+Local replacement of the day_mosaics iteration in GEMLST_MODIS.js (and of the
+ECMWF/ERA5_LAND/DAILY_AGGR product used by era5_extractor.js), so the daily ERA5-Land
+inputs of the MODIS calibration can be regenerated for decades of hourly data.
+
+The hourly files (NetCDF, or GRIB if cfgrib is installed) are read one time step at a
+time in time order, and only the accumulators of the days still open are kept in memory
+(float32 grids). Two aggregations are available per field:
+- 'mean': sum and count per pixel -> mean of the hourly values of 00-23 UTC, as
+  filtered.mean() in day_mosaics. This is used for both fields by default (FIELDS):
+  the SW_netx coefficients of the calibration were fitted on the mean of the hourly
+  (accumulated) surface net solar radiation, not on the daily total
+- 'accumulated': the hourly increments are summed, i.e. last minus first value, where
+  the accumulation restarts every day with the hour ending at 01 UTC. The value at
+  time t covers the hour ending at t, so the 00 UTC step closes the previous day (as the
+  _sum bands of DAILY_AGGR). DAILY_TOTAL_FIELDS uses it for the radiation
+A day is written as soon as the stream has passed it, so a year of hourly grids is
+never loaded at once. Days with fewer than 24 hourly steps (e.g. at the ends of the
+stream) are reported and not written unless write_incomplete is set.
+
+Output: one file per day with the bands named as in Earth Engine (skin_temperature in
+K, surface_net_solar_radiation in J m-2):
+- grid_file set (default): ERA5Land_<YYYY-MM-DD>.tif reprojected (nearest neighbour,
+  as Earth Engine without resample()) onto the grid of grid_file, i.e. the 1 km
+  EPSG:3413 Greenland mask, as read by GEMLST_MODIS/modis_local_calibration.py
+- grid_file None: ERA5Land_<YYYY-MM-DD>.nc on the input latitude/longitude grid
+"""
+#%%
+import os
+import sys
+import glob
+
+import numpy as np
+import netCDF4
+import rasterio
+import xarray as xr
+from rasterio.warp import reproject, Resampling
+from tqdm import tqdm
+
+# ===== CONFIGURE THESE PATHS =====
+hourly_folder = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/GEMLST_MODIS/ERA5Land_hourly"
+output_folder = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/GEMLST/data/ERA5Land_daily"
+grid_file = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/GEMLST/data/greenland_mask.tif"   # None = NetCDF on the input grid
+file_pattern = "*.nc"   # e.g. "*.grib" for GRIB files (needs cfgrib)
+# =================================
+
+# output name: (input variable names, aggregation)
+# mean of the hourly values of both fields, as day_mosaics (input of the MODIS calibration)
+FIELDS = {
+    'skin_temperature': (('skt', 'skin_temperature'), 'mean'),
+    'surface_net_solar_radiation': (('ssr', 'surface_net_solar_radiation'), 'mean'),
+}
+# daily radiation totals, as the _sum bands of ECMWF/ERA5_LAND/DAILY_AGGR
+DAILY_TOTAL_FIELDS = {
+    'skin_temperature': (('skt', 'skin_temperature'), 'mean'),
+    'surface_net_solar_radiation': (('ssr', 'surface_net_solar_radiation'), 'accumulated'),
+}
+UNITS = {'skin_temperature': 'K', 'surface_net_solar_radiation': 'J m-2'}
+HOUR = np.timedelta64(1, 'h')
+
+#%% functions
+def open_hourly(path):
+    """Open an hourly ERA5-Land file lazily with xarray (cfgrib for GRIB)."""
+    engine = 'cfgrib' if path.lower().endswith(('.grib', '.grb', '.grib2')) else None
+    return xr.open_dataset(path, engine=engine, cache=False)
+
+def time_name(ds):
+    """Name of the time coordinate ('valid_time' in the new CDS files, 'time' before)."""
+    for name in ('valid_time', 'time'):
+        if name in ds.variables and ds[name].ndim == 1:
+            return name
+    raise ValueError("No time coordinate found")
+
+def first_time(path):
+    """First time step of a file, used to order the files."""
+    with open_hourly(path) as ds:
+        return ds[time_name(ds)].values[0]
+
+def iter_hourly(paths, fields=FIELDS):
+    """
+    Yield the hourly steps of all files in time order, one step at a time.
+
+    Time steps that are not later than the previous one (overlapping files) are skipped.
+
+    Yields:
+    -------
+    tuple
+        (time as numpy.datetime64, {output name: float32 grid}, latitude, longitude)
+    """
+    last = None
+    for path in sorted(paths, key=first_time):
+        with open_hourly(path) as ds:
+            tname = time_name(ds)
+            variables = {}
+            for name, (candidates, _) in fields.items():
+                found = [c for c in candidates if c in ds.data_vars]
+                if not found:
+                    raise ValueError(f"{path}: none of {candidates} found")
+                variables[name] = ds[found[0]]
+            lat = ds['latitude'].values
+            lon = ds['longitude'].values
+            for i, t in enumerate(ds[tname].values):
+                if last is not None and t <= last:
+                    print(f"Warning: skipping repeated time step {t} in {path}", file=sys.stderr)
+                    continue
+                last = t
+                grids = {}
+                for name, variable in variables.items():
+                    grid = variable.isel({tname: i}).values
+                    grids[name] = np.asarray(grid.reshape(grid.shape[-2:]), dtype=np.float32)
+                yield t, grids, lat, lon
+
+def day_of(t):
+    """Date (YYYY-MM-DD) of a numpy.datetime64."""
+    return str(t.astype('datetime64[D]'))
+
+class DailyAccumulator:
+    """
+    Running float32 accumulators of one day.
+
+    Parameters:
+    -----------
+    shape : tuple
+        Grid shape
+    fields : dict
+        As FIELDS
+    """
+    def __init__(self, shape, fields=FIELDS):
+        self.fields = fields
+        self.sums = {name: np.zeros(shape, dtype=np.float32) for name in fields}
+        self.counts = {name: np.zeros(shape, dtype=np.uint16)
+                       for name, (_, how) in fields.items() if how == 'mean'}
+        self.steps = {name: 0 for name in fields}
+
+    def add_instant(self, name, grid):
+        """Add an hourly value of an instantaneous field (NaN is ignored)."""
+        valid = ~np.isnan(grid)
+        np.add(self.sums[name], grid, out=self.sums[name], where=valid)
+        self.counts[name] += valid
+        self.steps[name] += 1
+
+    def add_increment(self, name, increment):
+        """Add the hourly increment of an accumulated field."""
+        self.sums[name] += increment
+        self.steps[name] += 1
+
+    def result(self):
+        """Daily grids: means of instantaneous fields, totals of accumulated fields."""
+        out = {}
+        for name, (_, how) in self.fields.items():
+            if how == 'mean':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    out[name] = self.sums[name] / self.counts[name]
+            else:
+                out[name] = self.sums[name]
+        return out
+
+    def complete(self):
+        """True if every field received 24 hourly steps."""
+        return all(steps >= 24 for steps in self.steps.values())
+
+def aggregate_daily(steps, fields=FIELDS):
+    """
+    Aggregate a time-ordered stream of hourly steps into days.
+
+    Parameters:
+    -----------
+    steps : iterable
+        (time, {name: grid}, lat, lon) as from iter_hourly
+
+    Yields:
+    -------
+    tuple
+        (date, {name: daily float32 grid}, lat, lon, True if every field had 24 steps),
+        in date order, as soon as the day is finished
+    """
+    days = {}
+    previous = {}       # last value of every accumulated field
+    previous_time = None
+    for t, grids, lat, lon in steps:
+        day_instant = day_of(t)
+        day_accumulated = day_of(t - HOUR)
+        # the accumulation restarts with the hour ending at 01 UTC, elsewhere it only grows
+        restart = (t - HOUR).astype('datetime64[h]') == (t - HOUR).astype('datetime64[D]')
+        consecutive = previous_time is not None and t - previous_time == HOUR
+        for name, (_, how) in fields.items():
+            grid = grids[name]
+            if how == 'mean':
+                day = day_instant
+                if day not in days:
+                    days[day] = DailyAccumulator(grid.shape, fields)
+                days[day].add_instant(name, grid)
+                continue
+            increment = grid if restart else grid - previous[name] if consecutive and name in previous else None
+            previous[name] = grid
+            if increment is None:
+                continue
+            day = day_accumulated
+            if day not in days:
+                days[day] = DailyAccumulator(grid.shape, fields)
+            days[day].add_increment(name, increment)
+        previous_time = t
+        # days before the day of the accumulated fields cannot receive more steps
+        for day in sorted(days):
+            if day >= min(day_instant, day_accumulated):
+                break
+            accumulator = days.pop(day)
+            yield day, accumulator.result(), lat, lon, accumulator.complete()
+    for day in sorted(days):
+        accumulator = days.pop(day)
+        yield day, accumulator.result(), lat, lon, accumulator.complete()
+
+def write_day(path, date_str, grids, lat, lon):
+    """Write the daily grids of one day to a NetCDF file (atomic)."""
+    tmp_path = path + '.part'
+    with netCDF4.Dataset(tmp_path, 'w') as ds:
+        ds.createDimension('time', 1)
+        ds.createDimension('latitude', len(lat))
+        ds.createDimension('longitude', len(lon))
+        time = ds.createVariable('time', 'i4', ('time',))
+        time.units = 'days since 1970-01-01'
+        time[:] = [int(np.datetime64(date_str, 'D').astype(np.int64))]
+        ds.createVariable('latitude', 'f4', ('latitude',))[:] = lat
+        ds.createVariable('longitude', 'f4', ('longitude',))[:] = lon
+        ds['latitude'].units = 'degrees_north'
+        ds['longitude'].units = 'degrees_east'
+        for name, grid in grids.items():
+            variable = ds.createVariable(name, 'f4', ('time', 'latitude', 'longitude'),
+                                         zlib=True, complevel=4, fill_value=np.float32(np.nan))
+            variable.units = UNITS.get(name, '')
+            variable[0] = grid
+    os.replace(tmp_path, path)
+
+def geographic_grid(grids, lat, lon):
+    """
+    Daily grids north-up with longitudes in -180...180 (ERA5 files may use 0...360).
+
+    Returns:
+    --------
+    tuple
+        ({name: grid}, Affine transform of the regular latitude/longitude grid)
+    """
+    lon = (np.asarray(lon, dtype=np.float64) + 180) % 360 - 180
+    lat = np.asarray(lat, dtype=np.float64)
+    order = np.argsort(lon, kind='stable')
+    lon = lon[order]
+    rows = slice(None, None, -1) if lat[0] < lat[-1] else slice(None)
+    lat = lat[rows]
+    grids = {name: grid[rows][:, order] for name, grid in grids.items()}
+    dlon = lon[1] - lon[0] if len(lon) > 1 else 0.1
+    dlat = lat[1] - lat[0] if len(lat) > 1 else -0.1
+    transform = rasterio.Affine(dlon, 0, lon[0] - dlon / 2, 0, dlat, lat[0] - dlat / 2)
+    return grids, transform
+
+def write_day_geotiff(path, grids, lat, lon, profile):
+    """
+    Reproject the daily grids onto the grid of profile and write them to a GeoTIFF (atomic).
+
+    Nearest neighbour resampling, as Earth Engine uses when an ERA5-Land image is combined
+    with the 1 km MODIS grid without resample().
+    """
+    grids, src_transform = geographic_grid(grids, lat, lon)
+    out_profile = {'driver': 'GTiff', 'crs': profile['crs'], 'transform': profile['transform'],
+                   'height': profile['height'], 'width': profile['width'], 'count': len(grids),
+                   'dtype': 'float32', 'nodata': np.nan, 'tiled': True, 'blockxsize': 512,
+                   'blockysize': 512, 'compress': 'deflate'}
+    tmp_path = path + '.part'
+    with rasterio.open(tmp_path, 'w', **out_profile) as dst:
+        for band, grid in enumerate(grids.values(), start=1):
+            out = np.full((profile['height'], profile['width']), np.nan, dtype=np.float32)
+            reproject(grid.astype(np.float32), out, src_transform=src_transform, src_crs='EPSG:4326',
+                      src_nodata=np.nan, dst_transform=profile['transform'], dst_crs=profile['crs'],
+                      dst_nodata=np.nan, resampling=Resampling.nearest)
+            dst.write(out, band)
+        dst.descriptions = tuple(grids)
+    os.replace(tmp_path, path)
+
+def run_aggregation(paths, output_folder, overwrite=False, write_incomplete=False, fields=FIELDS,
+                    grid_file=None):
+    """
+    Stream hourly files into daily files.
+
+    Parameters:
+    -----------
+    paths : list
+        Hourly ERA5-Land files
+    fields : dict
+        FIELDS (hourly means, as day_mosaics) or DAILY_TOTAL_FIELDS
+    grid_file : str, optional
+        Raster whose grid the days are reprojected onto (GeoTIFF output); None writes
+        NetCDF files on the input latitude/longitude grid
+
+    Returns:
+    --------
+    list
+        (date, output path or None if not written, True if the day had all 24 hourly steps)
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    profile = None
+    if grid_file is not None:
+        with rasterio.open(grid_file) as src:
+            profile = src.profile
+    extension = 'nc' if profile is None else 'tif'
+    results = []
+    days = aggregate_daily(iter_hourly(paths, fields), fields)
+    for date_str, grids, lat, lon, complete in tqdm(days, desc="Aggregating days"):
+        if not complete:
+            print(f"Warning: {date_str} has fewer than 24 hourly steps", file=sys.stderr)
+            if not write_incomplete:
+                results.append((date_str, None, complete))
+                continue
+        output_path = os.path.join(output_folder, f"ERA5Land_{date_str}.{extension}")
+        if overwrite or not os.path.exists(output_path):
+            if profile is None:
+                write_day(output_path, date_str, grids, lat, lon)
+            else:
+                write_day_geotiff(output_path, grids, lat, lon, profile)
+        results.append((date_str, output_path, complete))
+    return results
+
+#%%
+if __name__ == "__main__":
+    paths = sorted(glob.glob(os.path.join(hourly_folder, file_pattern)))
+    print(f"Found {len(paths)} hourly files in {hourly_folder}")
+    results = run_aggregation(paths, output_folder, grid_file=grid_file)
+    written = [r for r in results if r[1] is not None]
+    incomplete = [r for r in results if not r[2]]
+    print(f"Wrote {len(written)} days, {len(incomplete)} incomplete")
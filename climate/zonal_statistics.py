@@ -0,0 +1,308 @@
+"""
+Local zonal statistics of gridded time series at the AWS stations.
+
+Offline counterpart of zonalStats (ee.Reducer.mean()) in era5_extractor.js, for NetCDF
+files on a regular lon/lat grid (ERA5-Land hourly/daily files, or the daily files of
+era5land_daily_aggregation.py). era5_extractor.js reduces the unbuffered awsPoints, i.e.
+samples the grid cell containing each station; this is the default (buffer_radius = 0).
+A buffer radius gives the statistics of bufferPoints(radius) instead.
+
+The buffers are rasterised once per station set and grid into a sparse weight matrix
+(stations x grid cells, see build_zones): each buffer (a circle of the given radius, or
+its bounding square as bufferPoints(radius, true)) gets the indexes of the grid cells it
+touches and the fraction of each cell it covers. The matrix is cached as .npz, keyed by
+the grid, the stations and the buffer. The statistics of a block of time steps are then
+sparse matrix products with the (time x cells) data:
+- mean: coverage-weighted mean of the valid (non-NaN) cells, as ee.Reducer.mean()
+- count: number of valid cells touched by the buffer
+- min/max: over the valid cells touched by the buffer (np.minimum/maximum.reduceat over
+  the matrix rows)
+so thousands of stations and decades of daily grids take seconds, read in blocks of time
+steps.
+
+extract_stations returns the long format (id, date, band, mean, min, max, count per
+station, time step and variable); the script writes the mean of each variable in its own
+column (id, date, <variables>), as the GEM_AWS_ERA5Land export of era5_extractor.js.
+"""
+#%%
+import os
+import sys
+import glob
+import hashlib
+
+import numpy as np
+import pandas as pd
+import netCDF4
+from scipy import sparse
+from tqdm import tqdm
+
+# ===== CONFIGURE THESE PATHS =====
+input_pattern = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/GEMLST_MODIS/ERA5Land_daily/ERA5Land_*.nc"
+variables = ['skin_temperature', 'surface_net_solar_radiation']
+output_csv = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/GEMLST_MODIS/GEM_AWS_ERA5Land_local.csv"
+zone_cache_dir = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/GEMLST_MODIS/zone_cache"
+buffer_radius = 0           # buffer radius in metres (0: the cell containing the station, as era5_extractor.js)
+buffer_bounds = False       # True: bounding square of the circle, as bufferPoints(radius, true)
+# =================================
+
+EARTH_RADIUS = 6371008.8
+SUBSAMPLES = 10             # per cell and axis, for the coverage of circular buffers
+
+# awsPoints of era5_extractor.js: id -> (lat, lon)
+AWS_STATIONS = {
+    'Kobbefjord_M500': (64.12248229980469, -51.37199020385742),
+    'Disko_T1': (69.27300262451172, -53.479400634765625),
+    'Disko_T2': (69.28909301757812, -53.43281936645508),
+    'Disko_T3': (69.2767105102539, -53.45709991455078),
+    'Disko_T4': (69.25126647949219, -53.49897003173828),
+    'Disko_AWS2': (69.25348663330078, -53.514129638671875),
+    'Zackenberg_M2': (74.46549224853516, -20.563194274902344),
+    'Zackenberg_M3': (74.50310516357422, -20.459354400634766),
+    'Zackenberg_M4_30min': (74.47307586669922, -20.552143096923828),
+}
+
+#%% functions
+def cell_edges(centres):
+    """Edges of the cells of a regular 1-D axis of cell centres."""
+    centres = np.asarray(centres, dtype=np.float64)
+    step = centres[1] - centres[0] if len(centres) > 1 else 1.0
+    return np.concatenate([[centres[0] - step / 2], (centres[:-1] + centres[1:]) / 2, [centres[-1] + step / 2]])
+
+def interval_overlap(lower, upper, radius):
+    """Length of the overlap of the intervals [lower, upper] and [-radius, radius]."""
+    lo, hi = np.minimum(lower, upper), np.maximum(lower, upper)
+    return np.clip(np.minimum(hi, radius) - np.maximum(lo, -radius), 0, None)
+
+def buffer_weights(lat_edges, lon_edges, lat0, lon0, radius, bounds=False):
+    """
+    Cells touched by the buffer of one station and the fraction of each cell it covers.
+
+    The cells are projected to a local equirectangular plane (metres) around the station.
+
+    Returns:
+    --------
+    tuple
+        (row indexes, column indexes, coverage fractions)
+    """
+    y = np.radians(lat_edges - lat0) * EARTH_RADIUS
+    x = np.radians((lon_edges - lon0 + 180) % 360 - 180) * EARTH_RADIUS * np.cos(np.radians(lat0))
+    rows = np.flatnonzero(interval_overlap(y[:-1], y[1:], radius) > 0)
+    cols = np.flatnonzero(interval_overlap(x[:-1], x[1:], radius) > 0)
+    if rows.size == 0 or cols.size == 0:
+        return rows, cols, np.zeros(0, dtype=np.float32)
+    rr, cc = np.meshgrid(rows, cols, indexing='ij')
+    if bounds:
+        fy = interval_overlap(y[rows], y[rows + 1], radius) / np.abs(y[rows + 1] - y[rows])
+        fx = interval_overlap(x[cols], x[cols + 1], radius) / np.abs(x[cols + 1] - x[cols])
+        fraction = np.outer(fy, fx)
+    else:
+        t = (np.arange(SUBSAMPLES) + 0.5) / SUBSAMPLES
+        ys = y[rows, None] + (y[rows + 1] - y[rows])[:, None] * t          # rows x samples
+        xs = x[cols, None] + (x[cols + 1] - x[cols])[:, None] * t          # cols x samples
+        inside = ys[:, None, :, None] ** 2 + xs[None, :, None, :] ** 2 <= radius ** 2
+        fraction = inside.mean(axis=(2, 3))
+    keep = fraction > 0
+    return rr[keep], cc[keep], fraction[keep].astype(np.float32)
+
+def containing_cell(edges, value):
+    """Index of the cell containing value, or None outside the axis."""
+    ascending = edges[-1] > edges[0]
+    i = np.searchsorted(edges if ascending else edges[::-1], value) - 1
+    if i < 0 or i >= len(edges) - 1:
+        return None
+    return int(i) if ascending else len(edges) - 2 - int(i)
+
+def build_zones(lat, lon, stations, radius, bounds=False):
+    """
+    Sparse coverage-weight matrix of the station buffers on a regular lon/lat grid.
+
+    Buffers smaller than a cell that hit no subsample, and a radius of 0, get the cell
+    containing the station, as reduceRegion does for points and regions smaller than a pixel.
+
+    Parameters:
+    -----------
+    lat, lon : numpy.ndarray
+        1-D cell-centre axes of the grid (degrees)
+    stations : dict
+        name -> (lat, lon)
+    radius : float
+        Buffer radius in metres
+    bounds : bool
+        Use the bounding square of the circle
+
+    Returns:
+    --------
+    scipy.sparse.csr_matrix
+        Stations x (lat x lon cells), float32 coverage fractions
+    """
+    lat_edges, lon_edges = cell_edges(lat), cell_edges(lon)
+    nx = len(lon)
+    indptr, indices, data = [0], [], []
+    for lat0, lon0 in stations.values():
+        rows, cols, fraction = buffer_weights(lat_edges, lon_edges, lat0, lon0, radius, bounds)
+        if fraction.size == 0:
+            row, col = containing_cell(lat_edges, lat0), containing_cell(lon_edges, ((lon0 - lon_edges[0]) % 360) + lon_edges[0])
+            if row is not None and col is not None:
+                rows, cols, fraction = np.array([row]), np.array([col]), np.ones(1, dtype=np.float32)
+        order = np.argsort(rows * nx + cols)
+        indices.append((rows * nx + cols)[order])
+        data.append(fraction[order])
+        indptr.append(indptr[-1] + fraction.size)
+    return sparse.csr_matrix((np.concatenate(data) if data else np.zeros(0, np.float32),
+                              np.concatenate(indices) if indices else np.zeros(0, np.int64), indptr),
+                             shape=(len(stations), len(lat) * nx), dtype=np.float32)
+
+def zones_key(lat, lon, stations, radius, bounds):
+    """Hash identifying a grid / station set / buffer combination."""
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(lon, dtype=np.float64).tobytes())
+    digest.update(repr((list(stations.items()), float(radius), bool(bounds))).encode())
+    return digest.hexdigest()[:16]
+
+def load_zones(lat, lon, stations, radius, bounds=False, cache_dir=None):
+    """Return the weight matrix of the station buffers, from cache_dir or by building (and storing) it."""
+    path = os.path.join(cache_dir, f"zones_{zones_key(lat, lon, stations, radius, bounds)}.npz") if cache_dir else None
+    if path and os.path.exists(path):
+        try:
+            return sparse.load_npz(path)
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not read zones '{path}' ({e}), rebuilding them", file=sys.stderr)
+    zones = build_zones(lat, lon, stations, radius, bounds)
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        sparse.save_npz(tmp_path, zones)
+        os.replace(tmp_path, path)
+    return zones
+
+def zonal_stats(zones, block):
+    """
+    Buffer statistics of a block of time steps.
+
+    Parameters:
+    -----------
+    zones : scipy.sparse.csr_matrix
+        Stations x cells weights from build_zones
+    block : numpy.ndarray
+        Time x lat x lon (or time x cells) data, NaN = no data
+
+    Returns:
+    --------
+    dict
+        'mean', 'min', 'max' (float32) and 'count' (int), each time x stations
+    """
+    # only the cells touched by a buffer are needed
+    used, columns = np.unique(zones.indices, return_inverse=True)
+    zones = sparse.csr_matrix((zones.data, columns.ravel(), zones.indptr), shape=(zones.shape[0], len(used)))
+    values = np.asarray(block, dtype=np.float32).reshape(block.shape[0], -1)[:, used]
+    valid = ~np.isnan(values)
+    valid_t = valid.T.astype(np.float32)
+    touched = zones.copy()
+    touched.data = np.ones_like(touched.data)
+    weight_sum = (zones @ valid_t).T
+    count = np.rint((touched @ valid_t).T).astype(np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (zones @ np.where(valid, values, np.float32(0)).T).T / weight_sum
+    mean[weight_sum == 0] = np.nan
+
+    shape = (values.shape[0], zones.shape[0])
+    minimum = np.full(shape, np.nan, dtype=np.float32)
+    maximum = np.full(shape, np.nan, dtype=np.float32)
+    nonempty = np.flatnonzero(np.diff(zones.indptr) > 0)
+    if nonempty.size:
+        gathered = values[:, zones.indices]
+        starts = zones.indptr[nonempty]
+        minimum[:, nonempty] = np.minimum.reduceat(np.where(valid[:, zones.indices], gathered, np.inf), starts, axis=1)
+        maximum[:, nonempty] = np.maximum.reduceat(np.where(valid[:, zones.indices], gathered, -np.inf), starts, axis=1)
+        minimum[count == 0] = np.nan
+        maximum[count == 0] = np.nan
+    return {'mean': mean.astype(np.float32), 'min': minimum, 'max': maximum, 'count': count}
+
+def time_variable(ds):
+    """The time variable of a dataset ('valid_time' in the new CDS files, 'time' before)."""
+    for name in ('valid_time', 'time'):
+        if name in ds.variables:
+            return ds.variables[name]
+    raise ValueError("No time variable found")
+
+def read_grid(path):
+    """1-D latitude and longitude axes of a NetCDF file."""
+    with netCDF4.Dataset(path) as ds:
+        lat = np.asarray(ds.variables['latitude'][:], dtype=np.float64)
+        lon = np.asarray(ds.variables['longitude'][:], dtype=np.float64)
+    return lat, lon
+
+def iter_blocks(paths, variable, chunk_time=64):
+    """
+    Yield (times, time x lat x lon float32 block) of a variable over NetCDF files in time
+    order, at most chunk_time steps at a time (one cube, or many daily files).
+    """
+    times, grids = [], []
+    for path in paths:
+        with netCDF4.Dataset(path) as ds:
+            var = ds.variables[variable]
+            tvar = time_variable(ds)
+            steps = netCDF4.num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard'),
+                                     only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+            for start in range(0, len(steps), chunk_time):
+                block = np.ma.filled(np.ma.asarray(var[start:start + chunk_time], dtype=np.float32), np.nan)
+                times.extend(steps[start:start + chunk_time])
+                grids.append(block.reshape(block.shape[0], -1))
+                if len(times) >= chunk_time:
+                    yield times, np.concatenate(grids)
+                    times, grids = [], []
+    if times:
+        yield times, np.concatenate(grids)
+
+def extract_stations(paths, variables, stations, radius, bounds=False, cache_dir=None, chunk_time=64,
+                     datetime_format='%Y-%m-%d'):
+    """
+    Zonal statistics of variables at the stations for every time step of the files.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        id, date, band, mean, min, max, count
+    """
+    paths = sorted(paths)
+    lat, lon = read_grid(paths[0])
+    zones = load_zones(lat, lon, stations, radius, bounds, cache_dir)
+    names = np.array(list(stations))
+    outside = names[np.diff(zones.indptr) == 0]
+    if outside.size:
+        print(f"Warning: stations outside the grid: {', '.join(outside)}", file=sys.stderr)
+    frames = []
+    for variable in variables:
+        for times, block in tqdm(iter_blocks(paths, variable, chunk_time), desc=f"Zonal statistics {variable}"):
+            stats = zonal_stats(zones, block)
+            frames.append(pd.DataFrame({
+                'id': np.tile(names, len(times)),
+                'date': np.repeat([t.strftime(datetime_format) for t in times], len(names)),
+                'band': variable,
+                **{name: values.ravel() for name, values in stats.items()},
+            }))
+    if not frames:
+        return pd.DataFrame(columns=['id', 'date', 'band', 'mean', 'min', 'max', 'count'])
+    return pd.concat(frames, ignore_index=True)
+
+def to_wide(df):
+    """
+    One row per station and time step with the mean of each band in its own column, as
+    the export of era5_extractor.js. Rows with a missing band are dropped, as
+    filter(ee.Filter.notNull(bands)) there.
+    """
+    bands = list(dict.fromkeys(df['band']))
+    wide = df.pivot(index=['id', 'date'], columns='band', values='mean')
+    wide = wide.reindex(columns=bands).dropna().reset_index()
+    wide.columns.name = None
+    return wide
+
+#%%
+if __name__ == "__main__":
+    paths = sorted(glob.glob(input_pattern))
+    print(f"Found {len(paths)} files matching {input_pattern}")
+    df = extract_stations(paths, variables, AWS_STATIONS, buffer_radius, buffer_bounds, zone_cache_dir)
+    df = to_wide(df)
+    df.to_csv(output_csv, index=False)
+    print(f"Saved {len(df)} rows to {output_csv}")
@@ -0,0 +1,919 @@
+"""
+Python version of LST_generator.m: daily merged Landsat/ERA5 LST for the permafrost ROIs.
+
+For every day of the ERA5 downscaled files of a ROI, the Landsat LST of that day
+(GEMLST_Landsat_YYYY-MM-DD.tif) is calibrated and gaps (and days without Landsat) are
+filled with the calibrated ERA5 2 m temperature, following the rules of LST_generator.m:
+- ERA5: t2m - 273.15, regridded (nearest by default) to the 30 m landmask grid if the extents differ,
+  then calibrated with climate/era5_calibration_parameters.txt
+- Landsat: 0 is no data, DN * 0.00341802 + 149 - 273.15, then calibrated with
+  GEMLST_Landsat/landsat_calibration_parameters.txt, both in one float32 step with the
+  CalibrationKernel of GEMLST_Landsat/landsat_local_processing.py
+- Flag (band 2): 0 water, 1 Landsat, 2 ERA5; the merged LST is set to no data over water
+- Output: LandsatERA5mergedLST_YYYY-MM-DD.tif, uint16 (LST + 273.15 - 149) / 0.00341802
+  with the flag as band 2, EPSG:3413, in <imfolder_merged>/<roi>
+
+Unlike the MATLAB script, all ROIs are processed in one run and the days are processed in
+parallel with a process pool. Each worker loads the landmask and DEM of a ROI once and
+reuses them for all days of that ROI it receives. Days whose output exists are skipped.
+
+Regridding does not run griddata for every day: the source-to-target index map (nearest
+cell, or the three cells and barycentric weights of linear interpolation) is computed once
+per ROI and ERA5 grid with a KD-tree (or triangulation), stored in regrid_cache_dir, and
+every day is then regridded with a single array gather.
+
+Tiled mode (tile_size set) is meant for grids too large to hold in memory, such as a
+Greenland-wide 30 m grid: each day's target grid is split into tile_size x tile_size
+blocks, the workers read only the matching windows of the landmask and Landsat image
+and the ERA5 cells around the block (regridded per block, see merge_block), and the
+main process writes the finished blocks into a tiled, compressed GeoTIFF. At most two
+blocks per worker are in flight, so peak memory is bounded by the block size and the
+number of workers rather than the grid size.
+
+With output_format "netcdf" (or "both") the days are (also) written to one datacube per
+ROI, LandsatERA5mergedLST_<roi>.nc (see MergedCube): time x y x x, chunked and deflate
+compressed, with the LST as uint16 with the same scale/offset encoding as the GeoTIFFs
+and the flag as a second variable. New days are appended to the unlimited time axis (and
+the axis is sorted when the cube is closed), so building a time series no longer means
+opening one GeoTIFF per day.
+
+mode = "pipeline" runs a single-process alternative for slow (network) storage: a reader
+thread prefetches the ERA5 slice and Landsat image of the next days while the current day
+is computed, and a writer thread writes finished days from a bounded queue. At the end a
+run report lists how long each stage worked and how long it stalled waiting for the
+others (see run_prefetch_pipeline).
+"""
+#%%
+import os
+import sys
+import glob
+import time
+import queue
+import hashlib
+import threading
+import concurrent.futures
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import netCDF4
+import rasterio
+from rasterio.windows import Window
+from pyproj import CRS, Transformer
+from scipy.spatial import cKDTree, Delaunay
+from tqdm import tqdm
+
+# ===== CONFIGURE THESE PATHS =====
+imfolder_landsat  = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/permafrost/LST/LandsatLST"
+imfolder_era5     = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/permafrost/LST/era5downscaled"
+imfolder_landmask = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/permafrost/LST/landmask"
+imfolder_merged   = "/mnt/i/SCIENCE-IGN-ALL/AVOCA_Group/1_Personal_folders/3_Shunan/data/permafrost/LST/mergedLST"
+rois = ["Aasiaat", "Disko", "Ilulissat", "Kangerlussuaq", "Kobbefjord", "Zackenberg"]
+regrid_method = "nearest"   # "nearest" (as griddata in LST_generator.m) or "linear"
+regrid_cache_dir = os.path.join(imfolder_merged, "regrid_index")
+tile_size = None            # e.g. 2048 for tiled out-of-core processing of very large grids
+output_format = "geotiff"   # "geotiff" (one file per day), "netcdf" (datacube per ROI) or "both"
+mode = "pool"               # "pool" (days in a process pool) or "pipeline" (prefetching I/O pipeline)
+# =================================
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+calibfile_landsat = os.path.join(repo_dir, "GEMLST_Landsat", "landsat_calibration_parameters.txt")
+calibfile_era5 = os.path.join(repo_dir, "climate", "era5_calibration_parameters.txt")
+
+sys.path.insert(0, os.path.join(repo_dir, "GEMLST_Landsat"))
+from landsat_local_processing import CalibrationKernel, MASK_LAND, MASK_OCEAN
+
+ST_SCALE = 0.00341802
+ST_OFFSET = 149.0
+KELVIN = 273.15
+OUTPUT_CRS = "EPSG:3413"
+EPOCH = datetime(1970, 1, 1)
+CUBE_CACHE_BYTES = 1 << 30   # upper limit of the chunk cache of each datacube variable
+
+#%% functions
+def load_calibration(path):
+    """Read (coefficient, intercept) from a calibration parameter file."""
+    params = pd.read_csv(path)
+    return float(params['coefficient'].iloc[0]), float(params['intercept'].iloc[0])
+
+def roi_paths(roi):
+    """Input and output paths of a ROI."""
+    return {
+        'landmask': os.path.join(imfolder_landmask, f"GreenlandMask_{roi}.tif"),
+        'dem': os.path.join(imfolder_landmask, f"ArcticDEM_{roi}.tif"),
+        'landsat': os.path.join(imfolder_landsat, roi),
+        'merged': os.path.join(imfolder_merged, roi),
+        'cube': os.path.join(imfolder_merged, roi, f"LandsatERA5mergedLST_{roi}.nc"),
+    }
+
+def era5_files(roi):
+    """ERA5 downscaled files of a ROI."""
+    return sorted(glob.glob(os.path.join(imfolder_era5, roi, '**', 't2m_elvcorr*.nc'), recursive=True))
+
+def read_era5_dates(nc_path):
+    """Dates (YYYY-MM-DD) of the time steps of an ERA5 downscaled file (days since 1850-01-01)."""
+    with netCDF4.Dataset(nc_path) as ds:
+        days = np.asarray(ds.variables['time'][:], dtype=np.float64)
+    return [(datetime(1850, 1, 1) + timedelta(days=float(d))).strftime('%Y-%m-%d') for d in days]
+
+def read_era5_day(nc_path, j):
+    """
+    Read one time step of t2m in degrees Celsius together with the lon/lat grids.
+
+    Returns:
+    --------
+    tuple
+        (t2m [y, x] in °C, lon [y, x], lat [y, x])
+    """
+    lon, lat = read_era5_grid(nc_path)
+    return read_era5_window(nc_path, j), lon, lat
+
+def read_era5_grid(nc_path):
+    """lon/lat grids [y, x] of an ERA5 downscaled file."""
+    with netCDF4.Dataset(nc_path) as ds:
+        lon = np.asarray(ds.variables['X'][:], dtype=np.float64)
+        lat = np.asarray(ds.variables['Y'][:], dtype=np.float64)
+    if lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    return lon, lat
+
+def read_era5_window(nc_path, j, rows=slice(None), cols=slice(None)):
+    """Read t2m of one time step in °C, only the given rows and columns of the grid."""
+    with netCDF4.Dataset(nc_path) as ds:
+        t2m = ds.variables['t2m']
+        data = t2m[j, 0, rows, cols] if t2m.ndim == 4 else t2m[j, rows, cols]
+    return np.ma.filled(np.ma.asarray(data, dtype=np.float64), np.nan) - KELVIN
+
+def grid_centres(transform, shape):
+    """Projected x/y coordinates of the cell centres of a north-up raster grid."""
+    rows, cols = shape
+    x = transform.c + (np.arange(cols) + 0.5) * transform.a
+    y = transform.f + (np.arange(rows) + 0.5) * transform.e
+    return np.meshgrid(x, y)
+
+def regrid_key(lon, lat, crs, transform, shape, method):
+    """Hash identifying a source grid / target grid / method combination."""
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(lon, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+    digest.update(repr((str(crs), transform.a, transform.b, transform.c, transform.d, transform.e,
+                        transform.f, tuple(shape), method)).encode())
+    return digest.hexdigest()[:16]
+
+def build_regrid_index(lon, lat, crs, transform, shape, method="nearest"):
+    """
+    Compute the source-to-target index map of a lon/lat grid onto a projected raster grid.
+
+    Parameters:
+    -----------
+    lon, lat : numpy.ndarray
+        Source grid in degrees
+    crs, transform, shape :
+        Target raster grid (north-up)
+    method : str
+        "nearest": index of the nearest source cell (KD-tree, as griddata 'nearest')
+        "linear": the three source cells of the enclosing triangle and their barycentric
+        weights (as griddata 'linear'), nearest outside the source grid
+
+    Returns:
+    --------
+    dict
+        'index' (target cells x k, int32) and 'weights' (target cells x k, float32)
+    """
+    xb, yb = Transformer.from_crs('EPSG:4326', crs, always_xy=True).transform(np.ravel(lon), np.ravel(lat))
+    source = np.column_stack([xb, yb])
+    xa, ya = grid_centres(transform, shape)
+    target = np.column_stack([xa.ravel(), ya.ravel()])
+    _, nearest = cKDTree(source).query(target, workers=-1)
+    if method == "nearest":
+        return {'index': nearest.astype(np.int32)[:, None], 'weights': np.ones((len(target), 1), dtype=np.float32)}
+    if method == "linear":
+        tri = Delaunay(source)
+        simplex = tri.find_simplex(target)
+        inside = simplex >= 0
+        index = np.repeat(nearest[:, None], 3, axis=1)
+        weights = np.zeros((len(target), 3))
+        weights[:, 0] = 1
+        affine = tri.transform[simplex[inside]]
+        bary = np.einsum('nij,nj->ni', affine[:, :2], target[inside] - affine[:, 2])
+        index[inside] = tri.simplices[simplex[inside]]
+        weights[inside] = np.column_stack([bary, 1 - bary.sum(axis=1)])
+        return {'index': index.astype(np.int32), 'weights': weights.astype(np.float32)}
+    raise ValueError(f"Unknown regrid method '{method}', use 'nearest' or 'linear'")
+
+def load_regrid_index(lon, lat, crs, transform, shape, method="nearest", cache_dir=None, name="grid",
+                      memory_cache=True):
+    """
+    Return the index map of a grid pair, from the per-process cache, the cache folder or
+    by computing it (and storing it in cache_dir). With memory_cache=False the map is not
+    kept in the process (tiled mode, where the maps of all blocks would not fit).
+    """
+    key = f"{name}_{method}_{regrid_key(lon, lat, crs, transform, shape, method)}"
+    cache = _worker.setdefault('regrid', {}) if memory_cache else {}
+    if key in cache:
+        return cache[key]
+    path = os.path.join(cache_dir, f"{key}.npz") if cache_dir else None
+    regrid = None
+    if path and os.path.exists(path):
+        try:
+            with np.load(path) as data:
+                regrid = {'index': data['index'], 'weights': data['weights']}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: could not read regrid index '{path}' ({e}), recomputing it", file=sys.stderr)
+    if regrid is None:
+        regrid = build_regrid_index(lon, lat, crs, transform, shape, method)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Unique temporary name, several workers may build the same map at once
+            tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, **regrid)
+            os.replace(tmp_path, path)
+    cache[key] = regrid
+    return regrid
+
+def apply_regrid(data, regrid, shape):
+    """Regrid one field with an index map (a single gather, weighted for linear)."""
+    values = np.ravel(data)[regrid['index']]
+    if regrid['index'].shape[1] == 1:
+        return values[:, 0].reshape(shape)
+    return np.einsum('nk,nk->n', values, regrid['weights']).reshape(shape)
+
+def calibrate(data, calibration):
+    """Apply the AWS-derived linear calibration (coefficient, intercept)."""
+    coefficient, intercept = calibration
+    return data * coefficient + intercept
+
+def encode_lst(lst):
+    """Encode LST in °C as uint16 DN, (LST + 273.15 - 149) / 0.00341802 (rounded, NaN -> 0)."""
+    dn = (lst + KELVIN - ST_OFFSET) / ST_SCALE
+    dn = np.clip(np.floor(dn + 0.5), 0, 65535)
+    return np.nan_to_num(dn, nan=0).astype(np.uint16)
+
+def merge_day(landmask, era5_day, landsat_dn, calib_landsat, calib_era5):
+    """
+    Merge one day of Landsat and ERA5 LST on the landmask grid.
+
+    Parameters:
+    -----------
+    landmask : numpy.ndarray
+        0 for water, 1 for land
+    era5_day : numpy.ndarray
+        ERA5 t2m in °C on the landmask grid (not calibrated)
+    landsat_dn : numpy.ndarray or None
+        Landsat ST DN (0 = no data), None if there is no Landsat image on this day
+    calib_landsat, calib_era5 : tuple
+        (coefficient, intercept)
+
+    Returns:
+    --------
+    tuple
+        (merged LST in °C with NaN over water, flag: 0 water, 1 Landsat, 2 ERA5)
+    """
+    era5_day = calibrate(era5_day, calib_era5)
+    flag = landmask.astype(np.uint16) * 2
+    if landsat_dn is not None:
+        flag[(landsat_dn > 0) & (landmask > 0)] = 1
+        # Water pixels are left uncalibrated (NaN); they are set to no data below anyway
+        classes = np.where(landmask > 0, MASK_LAND, MASK_OCEAN).astype(np.uint8)
+        merged = CalibrationKernel({MASK_LAND: calib_landsat}).apply(landsat_dn, classes)
+        gaps = np.isnan(merged)
+        merged[gaps] = era5_day[gaps]
+    else:
+        merged = era5_day.copy()
+    merged[landmask == 0] = np.nan
+    return merged, flag
+
+def write_merged(path, merged, flag, transform):
+    """Write the merged LST (uint16) and the flag as a two-band GeoTIFF in EPSG:3413."""
+    write_merged_dn(path, encode_lst(merged), flag, transform)
+
+def write_merged_dn(path, dn, flag, transform):
+    """Write already encoded uint16 LST and the flag as a two-band GeoTIFF in EPSG:3413."""
+    tmp_path = path + '.part'
+    with rasterio.open(tmp_path, 'w', driver='GTiff', height=dn.shape[0], width=dn.shape[1],
+                       count=2, dtype='uint16', crs=OUTPUT_CRS, transform=transform, compress='deflate') as dst:
+        dst.write(dn, 1)
+        dst.write(flag, 2)
+    os.replace(tmp_path, path)
+
+class MergedCube:
+    """
+    Chunked, compressed NetCDF datacube (time x y x x) of the merged LST of one ROI.
+
+    lst is stored as uint16 DN with scale_factor 0.00341802 and add_offset 149 (Kelvin,
+    0 = no data) and flag as uint8 (0 water, 1 Landsat, 2 ERA5, 255 = not written). The
+    default chunks of 64 days x 128 x 128 pixels (2 MB of lst) favour time series: the
+    series of one pixel over ten years is 58 chunk reads (229 with 16-day chunks), while a
+    map of one day still reads only the chunks covering it. Days are written one at a
+    time, so the chunk cache of lst and flag is sized to hold one 64-day slab of the grid
+    (up to CUBE_CACHE_BYTES); larger grids pay a re-read of partly written chunks.
+
+    The time axis is unlimited: days are reserved with reserve() and marked complete with
+    mark_written(). The file is flushed once per sync_days completed days (by default the
+    depth of a time chunk) and at close(), not after every day, so a chunk is compressed
+    once instead of being re-read and recompressed for each of its days; an interrupted
+    run leaves the days of the last flush usable. Reserved days are appended in the order
+    of the runs, so a rerun or backfill of earlier dates leaves the axis out of order;
+    close() then rewrites the cube with the days sorted.
+
+    Parameters:
+    -----------
+    path : str
+        NetCDF file, opened for appending if it exists
+    transform, shape :
+        Grid of the ROI (only needed to create the file)
+    readonly : bool
+        Open an existing cube read-only (queries); close() then never rewrites it
+    sync_days : int, optional
+        Completed days between flushes (default: days per time chunk)
+    """
+    def __init__(self, path, transform=None, shape=None, chunk_time=64, chunk_space=128, readonly=False,
+                 sync_days=None):
+        self.path = path
+        self.readonly = readonly
+        if readonly:
+            self.ds = netCDF4.Dataset(path, 'r')
+        elif os.path.exists(path):
+            self.ds = netCDF4.Dataset(path, 'a')
+        else:
+            x, y = grid_centres(transform, shape)
+            chunks = (chunk_time, min(chunk_space, shape[0]), min(chunk_space, shape[1]))
+            self.ds = self._create(path, x[0], y[:, 0], chunks)
+        self.ds.set_auto_maskandscale(False)
+        self._set_chunk_cache(self.ds)
+        self.sync_days = sync_days or self.ds.variables['lst'].chunking()[0]
+        self.unsynced = 0
+        times = self.ds.variables['time'][:]
+        self.index = {(EPOCH + timedelta(days=int(t))).strftime('%Y-%m-%d'): i for i, t in enumerate(times)}
+
+    @staticmethod
+    def _create(path, x, y, chunks):
+        ds = netCDF4.Dataset(path, 'w', format='NETCDF4')
+        ds.createDimension('time', None)
+        ds.createDimension('y', len(y))
+        ds.createDimension('x', len(x))
+        ds.createVariable('x', 'f8', ('x',))[:] = x
+        ds.createVariable('y', 'f8', ('y',))[:] = y
+        ds.variables['x'].setncatts({'standard_name': 'projection_x_coordinate', 'units': 'm'})
+        ds.variables['y'].setncatts({'standard_name': 'projection_y_coordinate', 'units': 'm'})
+        time = ds.createVariable('time', 'i4', ('time',))
+        time.setncatts({'standard_name': 'time', 'units': 'days since 1970-01-01', 'calendar': 'standard'})
+        crs = ds.createVariable('crs', 'i4')
+        crs.setncatts(CRS.from_string(OUTPUT_CRS).to_cf())
+        lst = ds.createVariable('lst', 'u2', ('time', 'y', 'x'), zlib=True, complevel=4, shuffle=True,
+                                chunksizes=chunks, fill_value=0)
+        lst.setncatts({'long_name': 'merged Landsat/ERA5 land surface temperature', 'units': 'K',
+                       'scale_factor': ST_SCALE, 'add_offset': ST_OFFSET, 'grid_mapping': 'crs'})
+        flag = ds.createVariable('flag', 'u1', ('time', 'y', 'x'), zlib=True, complevel=4,
+                                 chunksizes=chunks, fill_value=255)
+        flag.setncatts({'flag_values': np.array([0, 1, 2], dtype=np.uint8),
+                        'flag_meanings': 'water landsat era5', 'grid_mapping': 'crs'})
+        ds.createVariable('written', 'u1', ('time',), fill_value=0)
+        ds.setncatts({'title': 'Daily merged Landsat/ERA5 LST', 'source': 'permafrost/LST_generator.py'})
+        return ds
+
+    @staticmethod
+    def _set_chunk_cache(ds):
+        """Size the chunk cache of lst and flag to one time slab of chunks (see CUBE_CACHE_BYTES)."""
+        for name in ('lst', 'flag'):
+            variable = ds.variables[name]
+            chunk_time, chunk_y, chunk_x = variable.chunking()
+            n_chunks = -(-variable.shape[1] // chunk_y) * -(-variable.shape[2] // chunk_x)
+            slab = n_chunks * chunk_time * chunk_y * chunk_x * variable.dtype.itemsize
+            variable.set_var_chunk_cache(size=int(min(slab, CUBE_CACHE_BYTES)), nelems=max(4 * n_chunks + 1, 1009))
+
+    def _sort_time(self):
+        """Rewrite the cube with the days in date order if they are not (atomic, one day at a time)."""
+        times = self.ds.variables['time'][:]
+        order = np.argsort(times, kind='stable')
+        if np.array_equal(order, np.arange(len(order))):
+            return
+        variables = self.ds.variables
+        tmp_path = self.path + '.part'
+        sorted_ds = self._create(tmp_path, variables['x'][:], variables['y'][:], variables['lst'].chunking())
+        try:
+            sorted_ds.set_auto_maskandscale(False)
+            self._set_chunk_cache(sorted_ds)
+            written = variables['written'][:]
+            sorted_ds.variables['time'][:] = times[order]
+            sorted_ds.variables['written'][:] = written[order]
+            for new_i, old_i in enumerate(order):
+                sorted_ds.variables['lst'][new_i] = variables['lst'][old_i]
+                sorted_ds.variables['flag'][new_i] = variables['flag'][old_i]
+        finally:
+            sorted_ds.close()
+        self.ds.close()
+        os.replace(tmp_path, self.path)
+
+    def written_dates(self):
+        """Dates whose data were completely written."""
+        written = self.ds.variables['written'][:]
+        return {date_str for date_str, i in self.index.items() if written[i] == 1}
+
+    def reserve(self, date_strs):
+        """Return the time index of each date, appending the new dates (in sorted order)."""
+        time = self.ds.variables['time']
+        for date_str in sorted(set(date_strs) - set(self.index)):
+            i = len(time)
+            time[i] = (datetime.strptime(date_str, '%Y-%m-%d') - EPOCH).days
+            self.ds.variables['written'][i] = 0
+            self.index[date_str] = i
+        return {date_str: self.index[date_str] for date_str in date_strs}
+
+    def write(self, i, dn, flag, window=None):
+        """Write the uint16 DN and the flag of day i (optionally a window of it)."""
+        if window is None:
+            rows, cols = slice(None), slice(None)
+        else:
+            rows = slice(window.row_off, window.row_off + window.height)
+            cols = slice(window.col_off, window.col_off + window.width)
+        self.ds.variables['lst'][i, rows, cols] = dn
+        self.ds.variables['flag'][i, rows, cols] = flag.astype(np.uint8)
+
+    def mark_written(self, i):
+        """Mark day i as complete; the file is flushed every sync_days days."""
+        self.ds.variables['written'][i] = 1
+        self.unsynced += 1
+        if self.unsynced >= self.sync_days:
+            self.ds.sync()
+            self.unsynced = 0
+
+    def close(self):
+        """Close the cube, sorting the time axis first if days were appended out of order."""
+        if self.ds.isopen() and not self.readonly:
+            self._sort_time()
+        if self.ds.isopen():
+            self.ds.close()
+
+def cube_written_dates(path):
+    """Dates already complete in a datacube (empty if it does not exist)."""
+    if not os.path.exists(path):
+        return set()
+    cube = MergedCube(path, readonly=True)
+    try:
+        return cube.written_dates()
+    finally:
+        cube.close()
+
+# Per-process state: calibration and the static rasters of each ROI, loaded once per worker
+_worker = {'rois': {}}
+
+def init_worker(calib_landsat, calib_era5, method="nearest", cache_dir=None):
+    """Process pool initializer."""
+    _worker['calib_landsat'] = calib_landsat
+    _worker['calib_era5'] = calib_era5
+    _worker['regrid_method'] = method
+    _worker['regrid_cache_dir'] = cache_dir
+    _worker['rois'] = {}
+    _worker['regrid'] = {}
+
+def roi_static(roi):
+    """Landmask and DEM of a ROI, read on first use in this process."""
+    if roi not in _worker['rois']:
+        paths = roi_paths(roi)
+        with rasterio.open(paths['landmask']) as src:
+            landmask = src.read(1).astype(np.uint8)
+            static = {'landmask': landmask, 'transform': src.transform, 'crs': src.crs}
+        if os.path.exists(paths['dem']):
+            with rasterio.open(paths['dem']) as src:
+                static['dem'] = src.read(1).astype(np.float64)
+        _worker['rois'][roi] = static
+    return _worker['rois'][roi]
+
+def read_day_inputs(roi, nc_path, j, date_str):
+    """Read the ERA5 slice and (if present) the Landsat image of one day."""
+    era5_day, lon, lat = read_era5_day(nc_path, j)
+    landsat_path = os.path.join(roi_paths(roi)['landsat'], f"GEMLST_Landsat_{date_str}.tif")
+    landsat_dn = None
+    if os.path.isfile(landsat_path):
+        with rasterio.open(landsat_path) as src:
+            landsat_dn = src.read(1)
+    return era5_day, lon, lat, landsat_dn
+
+def merge_inputs(roi, era5_day, lon, lat, landsat_dn):
+    """Regrid the ERA5 slice to the ROI grid if needed and merge it with the Landsat image."""
+    static = roi_static(roi)
+    landmask = static['landmask']
+    if era5_day.shape != landmask.shape:
+        regrid = load_regrid_index(lon, lat, static['crs'], static['transform'], landmask.shape,
+                                   _worker.get('regrid_method', "nearest"), _worker.get('regrid_cache_dir'), roi)
+        era5_day = apply_regrid(era5_day, regrid, landmask.shape)
+    return merge_day(landmask, era5_day, landsat_dn, _worker['calib_landsat'], _worker['calib_era5'])
+
+def process_day(roi, nc_path, j, date_str, write_geotiff=True, return_arrays=False):
+    """
+    Produce the merged LST of one ROI and day.
+
+    Returns:
+    --------
+    tuple
+        (output path or None, True if a Landsat image was used,
+         (uint16 DN, flag) if return_arrays else None)
+    """
+    static = roi_static(roi)
+    era5_day, lon, lat, landsat_dn = read_day_inputs(roi, nc_path, j, date_str)
+    merged, flag = merge_inputs(roi, era5_day, lon, lat, landsat_dn)
+    output_path = None
+    if write_geotiff:
+        output_path = os.path.join(roi_paths(roi)['merged'], f"LandsatERA5mergedLST_{date_str}.tif")
+        write_merged(output_path, merged, flag, static['transform'])
+    arrays = (encode_lst(merged), flag) if return_arrays else None
+    return output_path, landsat_dn is not None, arrays
+
+def block_windows(width, height, tile_size):
+    """Yield the windows of a tile_size x tile_size tiling of a raster."""
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+
+def era5_shape(nc_path):
+    """Grid shape (y, x) of the t2m variable of an ERA5 file, read once per process and file."""
+    shapes = _worker.setdefault('era5_shapes', {})
+    if nc_path not in shapes:
+        with netCDF4.Dataset(nc_path) as ds:
+            shapes[nc_path] = tuple(ds.variables['t2m'].shape[-2:])
+    return shapes[nc_path]
+
+def era5_source_grid(nc_path, crs):
+    """
+    lon/lat grids of an ERA5 file, their x/y in crs and the search margin, read once per
+    process and file and reused for all blocks and days of that file.
+
+    The margin is twice the largest distance between neighbouring source cells, so the
+    nearest cell and the enclosing triangle of every target cell of a block lie within
+    the block bounds plus the margin.
+    """
+    key = (nc_path, str(crs))
+    if _worker.get('era5_grid_key') != key:
+        lon, lat = read_era5_grid(nc_path)
+        x, y = Transformer.from_crs('EPSG:4326', crs, always_xy=True).transform(lon, lat)
+        spacing = [np.nanmax(np.hypot(np.diff(x, axis=axis), np.diff(y, axis=axis)))
+                   for axis in (0, 1) if x.shape[axis] > 1]
+        _worker['era5_grid'] = (lon, lat, x, y, 2 * max(spacing, default=0.0))
+        _worker['era5_grid_key'] = key
+    return _worker['era5_grid']
+
+def source_window(x, y, bounds, margin):
+    """
+    Row and column slices of the source grid covering the source cells within bounds
+    (left, bottom, right, top) plus margin; the whole grid if there are none.
+    """
+    left, bottom, right, top = bounds
+    inside = (x >= left - margin) & (x <= right + margin) & (y >= bottom - margin) & (y <= top + margin)
+    if not inside.any():
+        return slice(None), slice(None)
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+def merge_block(roi, nc_path, j, date_str, window):
+    """
+    Merge one block of one day, reading only the block's windows of the inputs.
+
+    If the ERA5 grid has the shape of the landmask it is used as is (as in merge_inputs
+    and LST_generator.m) and only the block's window is read. Otherwise ERA5 is read and
+    regridded only over the source cells around the block (see source_window), so neither
+    the read nor the KD-tree/triangulation grows with the size of the ROI; the block's
+    index map is cached in regrid_cache_dir for the other days.
+
+    Returns:
+    --------
+    tuple
+        (window, merged LST as uint16 DN, flag)
+    """
+    paths = roi_paths(roi)
+    with rasterio.open(paths['landmask']) as src:
+        landmask = src.read(1, window=window).astype(np.uint8)
+        transform = src.window_transform(window)
+        crs = src.crs
+        grid_shape = src.shape
+    if era5_shape(nc_path) == grid_shape:
+        # Same grid as the landmask: no regridding, as in merge_inputs
+        rows = slice(window.row_off, window.row_off + window.height)
+        cols = slice(window.col_off, window.col_off + window.width)
+        era5_block = read_era5_window(nc_path, j, rows, cols)
+    else:
+        lon, lat, x, y, margin = era5_source_grid(nc_path, crs)
+        xs = (transform.c, transform.c + transform.a * landmask.shape[1])
+        ys = (transform.f, transform.f + transform.e * landmask.shape[0])
+        rows, cols = source_window(x, y, (min(xs), min(ys), max(xs), max(ys)), margin)
+        regrid = load_regrid_index(lon[rows, cols], lat[rows, cols], crs, transform, landmask.shape,
+                                   _worker.get('regrid_method', "nearest"), _worker.get('regrid_cache_dir'), roi,
+                                   memory_cache=False)
+        era5_block = apply_regrid(read_era5_window(nc_path, j, rows, cols), regrid, landmask.shape)
+
+    landsat_path = os.path.join(paths['landsat'], f"GEMLST_Landsat_{date_str}.tif")
+    landsat_dn = None
+    if os.path.isfile(landsat_path):
+        with rasterio.open(landsat_path) as src:
+            landsat_dn = src.read(1, window=window)
+
+    merged, flag = merge_day(landmask, era5_block, landsat_dn, _worker['calib_landsat'], _worker['calib_era5'])
+    return window, encode_lst(merged), flag
+
+def process_day_tiled(executor, roi, nc_path, j, date_str, tile_size, max_pending, write_geotiff=True,
+                      cube=None, cube_index=None):
+    """
+    Produce the merged LST of one ROI and day block by block.
+
+    Blocks are merged in the worker processes and written here into a tiled, compressed
+    GeoTIFF (and/or day cube_index of the datacube) as they finish; at most max_pending
+    blocks are submitted at a time.
+
+    Returns:
+    --------
+    tuple
+        (output path or None, True if a Landsat image was used)
+    """
+    paths = roi_paths(roi)
+    with rasterio.open(paths['landmask']) as src:
+        width, height, transform = src.width, src.height, src.transform
+    output_path = os.path.join(paths['merged'], f"LandsatERA5mergedLST_{date_str}.tif") if write_geotiff else None
+    used_landsat = False
+
+    dst = None
+    if write_geotiff:
+        dst = rasterio.open(output_path + '.part', 'w', driver='GTiff', height=height, width=width, count=2,
+                            dtype='uint16', crs=OUTPUT_CRS, transform=transform, compress='deflate', tiled=True,
+                            blockxsize=256, blockysize=256, BIGTIFF='IF_SAFER')
+
+    def write_done(done):
+        nonlocal used_landsat
+        for future in done:
+            window, dn, flag = future.result()
+            if dst is not None:
+                dst.write(dn, 1, window=window)
+                dst.write(flag, 2, window=window)
+            if cube is not None:
+                cube.write(cube_index, dn, flag, window)
+            used_landsat = used_landsat or bool((flag == 1).any())
+
+    try:
+        pending = set()
+        for window in block_windows(width, height, tile_size):
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                write_done(done)
+            pending.add(executor.submit(merge_block, roi, nc_path, j, date_str, window))
+        write_done(concurrent.futures.as_completed(pending))
+    finally:
+        if dst is not None:
+            dst.close()
+    if dst is not None:
+        os.replace(output_path + '.part', output_path)
+    if cube is not None:
+        cube.mark_written(cube_index)
+    return output_path, used_landsat
+
+def list_day_tasks(rois, overwrite=False, output_format="geotiff"):
+    """
+    List (roi, nc_path, time index, date) of every day to process, grouped by ROI.
+
+    A day is done when its GeoTIFF exists and/or it is complete in the datacube,
+    depending on output_format.
+    """
+    tasks = []
+    for roi in rois:
+        paths = roi_paths(roi)
+        if not os.path.exists(paths['landmask']):
+            print(f"Warning: no landmask for {roi}, skipping", file=sys.stderr)
+            continue
+        os.makedirs(paths['merged'], exist_ok=True)
+        in_cube = cube_written_dates(paths['cube']) if output_format in ("netcdf", "both") else None
+        for nc_path in era5_files(roi):
+            for j, date_str in enumerate(read_era5_dates(nc_path)):
+                output_path = os.path.join(paths['merged'], f"LandsatERA5mergedLST_{date_str}.tif")
+                done = (output_format == "netcdf" or os.path.exists(output_path)) and \
+                       (in_cube is None or date_str in in_cube)
+                if overwrite or not done:
+                    tasks.append((roi, nc_path, j, date_str))
+    return tasks
+
+def open_cubes(tasks):
+    """Open (or create) the datacube of every ROI in tasks and reserve the time steps of its days."""
+    cubes, slots = {}, {}
+    for roi in dict.fromkeys(task[0] for task in tasks):
+        paths = roi_paths(roi)
+        with rasterio.open(paths['landmask']) as src:
+            cubes[roi] = MergedCube(paths['cube'], src.transform, (src.height, src.width))
+        dates = [task[3] for task in tasks if task[0] == roi]
+        slots.update({(roi, date_str): i for date_str, i in cubes[roi].reserve(dates).items()})
+    return cubes, slots
+
+def run_generator(rois, max_workers=4, overwrite=False, method=None, cache_dir=None, tile_size=None,
+                  output_format="geotiff"):
+    """
+    Generate the daily merged LST of all ROIs with a process pool.
+
+    Without tile_size the days are processed in parallel; with tile_size the days are
+    processed one after the other and the blocks of each day in parallel. output_format
+    selects daily GeoTIFFs ("geotiff"), the per-ROI datacube ("netcdf") or both ("both").
+
+    Returns:
+    --------
+    list
+        (roi, date, output path or None, Landsat used or error message) per day
+    """
+    if output_format not in ("geotiff", "netcdf", "both"):
+        raise ValueError(f"Unknown output_format '{output_format}', use 'geotiff', 'netcdf' or 'both'")
+    write_geotiff = output_format in ("geotiff", "both")
+    tasks = list_day_tasks(rois, overwrite, output_format)
+    print(f"{len(tasks)} days to process in {len(rois)} ROIs")
+    initargs = (load_calibration(calibfile_landsat), load_calibration(calibfile_era5),
+                method or regrid_method, cache_dir or regrid_cache_dir)
+    # The datacubes are only written by this process
+    cubes, slots = open_cubes(tasks) if output_format != "geotiff" else ({}, {})
+
+    results = []
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                                    initargs=initargs) as executor:
+            if tile_size:
+                for task in tqdm(tasks, desc="Merging days (tiled)"):
+                    roi, _, _, date_str = task
+                    try:
+                        output_path, used_landsat = process_day_tiled(
+                            executor, *task, tile_size, 2 * max_workers, write_geotiff,
+                            cubes.get(roi), slots.get((roi, date_str)))
+                        results.append((roi, date_str, output_path or roi_paths(roi)['cube'], used_landsat))
+                    except Exception as e:
+                        print(f"Error processing {roi} {date_str}: {e}", file=sys.stderr)
+                        results.append((roi, date_str, None, str(e)))
+                return results
+
+            futures = {executor.submit(process_day, *task, write_geotiff, bool(cubes)): task for task in tasks}
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Merging days"):
+                roi, _, _, date_str = futures[future]
+                try:
+                    output_path, used_landsat, arrays = future.result()
+                    if arrays is not None:
+                        i = slots[(roi, date_str)]
+                        cubes[roi].write(i, *arrays)
+                        cubes[roi].mark_written(i)
+                    results.append((roi, date_str, output_path or roi_paths(roi)['cube'], used_landsat))
+                except Exception as e:
+                    print(f"Error processing {roi} {date_str}: {e}", file=sys.stderr)
+                    results.append((roi, date_str, None, str(e)))
+    finally:
+        for cube in cubes.values():
+            cube.close()
+    return results
+
+class StageReport:
+    """Thread-safe accumulator of the busy and stalled time of the pipeline stages."""
+    def __init__(self):
+        self.times = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def summary(self, elapsed):
+        """Format the report, one line per stage."""
+        lines = [f"Pipeline report ({elapsed:.1f} s wall time):"]
+        for stage, busy, stall, note in [
+                ('read', 'read', 'read_stall', 'waiting for free prefetch slots'),
+                ('compute', 'compute', 'compute_wait_input', 'waiting for inputs'),
+                ('compute', None, 'compute_wait_writer', 'waiting for the write queue'),
+                ('write', 'write', 'write_idle', 'waiting for finished days')]:
+            if busy:
+                lines.append(f"  {stage:>8} busy  {self.times.get(busy, 0.0):8.1f} s")
+            lines.append(f"  {stage:>8} stall {self.times.get(stall, 0.0):8.1f} s  ({note})")
+        return "\n".join(lines)
+
+def run_prefetch_pipeline(rois, overwrite=False, method=None, cache_dir=None, output_format="geotiff",
+                          prefetch=2, write_queue=4):
+    """
+    Generate the daily merged LST with prefetching reads and an asynchronous writer.
+
+    A reader thread loads the inputs of up to `prefetch` days ahead, the calling thread
+    merges one day at a time, and a writer thread writes the GeoTIFFs and/or the datacube
+    from a queue of at most `write_queue` days. The time every stage spent working and
+    stalled is printed at the end. Days that fail to read, merge or write are reported
+    per day, as in run_generator. Whole days are merged: tile_size (tiled mode) is
+    ignored in pipeline mode.
+
+    Returns:
+    --------
+    tuple
+        (results as in run_generator, StageReport)
+    """
+    write_geotiff = output_format in ("geotiff", "both")
+    tasks = list_day_tasks(rois, overwrite, output_format)
+    print(f"{len(tasks)} days to process in {len(rois)} ROIs")
+    init_worker(load_calibration(calibfile_landsat), load_calibration(calibfile_era5),
+                method or regrid_method, cache_dir or regrid_cache_dir)
+    cubes, slots = open_cubes(tasks) if output_format != "geotiff" else ({}, {})
+    report = StageReport()
+    inputs = queue.Queue(maxsize=prefetch)
+    outputs = queue.Queue(maxsize=write_queue)
+    results = []
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        # give up when the consumer has stopped, instead of blocking on a full queue
+        while not stop.is_set():
+            try:
+                inputs.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        for task in tasks:
+            if stop.is_set():
+                return
+            start = time.perf_counter()
+            try:
+                item = (task, roi_static(task[0]), read_day_inputs(*task), None)
+            except Exception as e:
+                item = (task, None, None, e)
+            report.add('read', time.perf_counter() - start)
+            start = time.perf_counter()
+            if not put(item):
+                return
+            report.add('read_stall', time.perf_counter() - start)
+        put(done)
+
+    def writer():
+        while True:
+            start = time.perf_counter()
+            item = outputs.get()
+            report.add('write_idle', time.perf_counter() - start)
+            if item is done:
+                return
+            (roi, _, _, date_str), static, dn, flag, used_landsat = item
+            start = time.perf_counter()
+            try:
+                output_path = None
+                if write_geotiff:
+                    output_path = os.path.join(roi_paths(roi)['merged'], f"LandsatERA5mergedLST_{date_str}.tif")
+                    write_merged_dn(output_path, dn, flag, static['transform'])
+                if roi in cubes:
+                    i = slots[(roi, date_str)]
+                    cubes[roi].write(i, dn, flag)
+                    cubes[roi].mark_written(i)
+                results.append((roi, date_str, output_path or roi_paths(roi)['cube'], used_landsat))
+            except Exception as e:
+                print(f"Error writing {roi} {date_str}: {e}", file=sys.stderr)
+                results.append((roi, date_str, None, str(e)))
+            report.add('write', time.perf_counter() - start)
+
+    run_start = time.perf_counter()
+    threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=writer, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        with tqdm(total=len(tasks), desc="Merging days (pipeline)") as progress:
+            while True:
+                start = time.perf_counter()
+                item = inputs.get()
+                report.add('compute_wait_input', time.perf_counter() - start)
+                if item is done:
+                    break
+                task, static, day_inputs, error = item
+                roi, _, _, date_str = task
+                progress.update()
+                if error is not None:
+                    print(f"Error reading {roi} {date_str}: {error}", file=sys.stderr)
+                    results.append((roi, date_str, None, str(error)))
+                    continue
+                start = time.perf_counter()
+                era5_day, lon, lat, landsat_dn = day_inputs
+                try:
+                    merged, flag = merge_inputs(roi, era5_day, lon, lat, landsat_dn)
+                    dn = encode_lst(merged)
+                except Exception as e:
+                    print(f"Error processing {roi} {date_str}: {e}", file=sys.stderr)
+                    results.append((roi, date_str, None, str(e)))
+                    continue
+                finally:
+                    report.add('compute', time.perf_counter() - start)
+                start = time.perf_counter()
+                outputs.put((task, static, dn, flag, landsat_dn is not None))
+                report.add('compute_wait_writer', time.perf_counter() - start)
+    finally:
+        stop.set()
+        outputs.put(done)
+        for thread in threads:
+            thread.join()
+        for cube in cubes.values():
+            cube.close()
+    print(report.summary(time.perf_counter() - run_start))
+    return results, report
+
+#%%
+if __name__ == "__main__":
+    start_time = datetime.now()
+    if mode == "pipeline":
+        results, _ = run_prefetch_pipeline(rois, output_format=output_format)
+    else:
+        max_workers = int(input("Enter number of worker processes (default 4): ") or "4")
+        results = run_generator(rois, max_workers, tile_size=tile_size, output_format=output_format)
+    failed = [r for r in results if r[2] is None]
+    with_landsat = sum(1 for r in results if r[3] is True)
+    print(f"Merged {len(results) - len(failed)} days ({with_landsat} with Landsat), {len(failed)} failed")
+    print(f"Done! Elapsed time is {datetime.now() - start_time}")
@@ -0,0 +1,273 @@
+"""
+Quicklook renderer for the merged LST products and the ERA5 downscaled t2m files.
+
+Rendering is a separate, optional stage instead of part of the product generation loop
+(LST_generator.m, era5downscaled_viewer.m):
+- rasters are block-averaged (NaN-aware) to screen resolution while they are read in
+  strips, so the full-resolution grid is never plotted or held in memory as a whole
+- every frame uses the same colormap and limits (cmocean thermal, -30...30 °C) and the
+  same figure size, so frames can be compared and combined into an animation
+- frames are rendered in a process pool; write_animation appends the finished frames in
+  date order one at a time. MP4 (the default, needs imageio-ffmpeg) is streamed to
+  ffmpeg frame by frame; the GIF writer (Pillow) keeps every frame until the file is
+  closed, so GIF is only the fallback when imageio-ffmpeg is not installed
+
+Merged LST quicklooks show the three panels of LST_generator.m, reconstructed from the
+product: the Landsat pixels (flag 1), the ERA5 pixels (flag 2) and the merged LST.
+Set era5_quicklooks to also render every day of the ERA5 downscaled files of each ROI.
+Frames that fail to render are reported and left out of the animation.
+"""
+#%%
+import os
+import re
+import sys
+import glob
+import concurrent.futures
+from datetime import datetime, timedelta
+
+import numpy as np
+import netCDF4
+import rasterio
+from rasterio.windows import Window
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from tqdm import tqdm
+
+from LST_generator import roi_paths, rois, era5_files, imfolder_era5, ST_SCALE, ST_OFFSET, KELVIN
+
+try:
+    import cmocean
+    THERMAL = cmocean.cm.thermal
+except ImportError:
+    # cmocean is optional; inferno is the closest built-in perceptual colormap
+    THERMAL = 'inferno'
+
+CLIM = (-30, 30)
+
+# ===== CONFIGURE THE QUICKLOOKS =====
+max_pixels = 800        # longest side of the block-averaged raster
+dpi = 100
+animation = True        # also write LandsatERA5mergedLST_<roi>.<animation_format> per ROI
+animation_format = "mp4"    # "mp4" (streamed, needs imageio-ffmpeg) or "gif" (buffers all frames)
+fps = 8
+era5_quicklooks = False # also render every day of the ERA5 downscaled t2m files of each ROI
+# ====================================
+
+#%% functions
+def block_average(data, factor):
+    """NaN-aware mean over factor x factor blocks (edges padded with NaN)."""
+    if factor <= 1:
+        return data.astype(np.float32)
+    h, w = data.shape
+    padded = np.full((-(-h // factor) * factor, -(-w // factor) * factor), np.nan, dtype=np.float32)
+    padded[:h, :w] = data
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    count = np.count_nonzero(~np.isnan(blocks), axis=(1, 3))
+    total = np.nansum(blocks, axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan).astype(np.float32)
+
+def screen_factor(shape, max_pixels=800):
+    """Block size that brings the longest side of a raster down to about max_pixels."""
+    return max(1, int(np.ceil(max(shape) / max_pixels)))
+
+def read_merged_quicklook(path, max_pixels=800):
+    """
+    Read a merged LST GeoTIFF in strips and block-average it to screen resolution.
+
+    Returns:
+    --------
+    tuple
+        (Landsat part, ERA5 part, merged LST) in °C, and the extent (left, right, bottom, top)
+    """
+    with rasterio.open(path) as src:
+        factor = screen_factor((src.height, src.width), max_pixels)
+        t = src.transform
+        extent = (t.c, t.c + t.a * src.width, t.f + t.e * src.height, t.f)
+        parts = {name: [] for name in ('landsat', 'era5', 'merged')}
+        for row in range(0, src.height, factor * 64):
+            window = Window(0, row, src.width, min(factor * 64, src.height - row))
+            dn, flag = src.read(window=window)
+            lst = dn.astype(np.float32) * np.float32(ST_SCALE) + np.float32(ST_OFFSET - KELVIN)
+            lst[dn == 0] = np.nan
+            parts['landsat'].append(block_average(np.where(flag == 1, lst, np.nan), factor))
+            parts['era5'].append(block_average(np.where(flag == 2, lst, np.nan), factor))
+            parts['merged'].append(block_average(lst, factor))
+    return tuple(np.vstack(parts[name]) for name in ('landsat', 'era5', 'merged')), extent
+
+def render_merged(path, png_path, title, max_pixels=800, dpi=100):
+    """Render the three-panel quicklook (Landsat, ERA5, merged) of one merged LST GeoTIFF."""
+    (landsat, era5, merged), extent = read_merged_quicklook(path, max_pixels)
+    fig, axes = plt.subplots(1, 3, figsize=(12, 4.6), constrained_layout=True)
+    panels = [(landsat, 'Landsat LST' if np.isfinite(landsat).any() else 'Landsat LST not available'),
+              (era5, 'ERA5 LST'), (merged, 'Merged LST')]
+    for ax, (data, panel_title) in zip(axes, panels):
+        im = ax.imshow(data, extent=extent, cmap=THERMAL, vmin=CLIM[0], vmax=CLIM[1], interpolation='nearest')
+        ax.set_title(panel_title)
+        ax.set_xticks([])
+        ax.set_yticks([])
+    fig.suptitle(title)
+    fig.colorbar(im, ax=axes, location='bottom', shrink=0.5, label='Temperature (°C)')
+    fig.savefig(png_path, dpi=dpi)
+    plt.close(fig)
+    return png_path
+
+def render_era5(nc_path, j, png_path, max_pixels=800, dpi=100):
+    """Render one time step of an ERA5 downscaled t2m file (era5downscaled_viewer.m)."""
+    with netCDF4.Dataset(nc_path) as ds:
+        t2m = ds.variables['t2m']
+        data = np.ma.filled(np.ma.asarray(t2m[j, 0] if t2m.ndim == 4 else t2m[j], dtype=np.float32), np.nan) - KELVIN
+        lon = np.asarray(ds.variables['X'][:], dtype=np.float64)
+        lat = np.asarray(ds.variables['Y'][:], dtype=np.float64)
+        day = float(ds.variables['time'][j])
+    if lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    factor = screen_factor(data.shape, max_pixels)
+    data, lon, lat = (block_average(a, factor) for a in (data, lon, lat))
+    fig, ax = plt.subplots(figsize=(8, 8), constrained_layout=True)
+    mesh = ax.pcolormesh(lon, lat, data, cmap=THERMAL, vmin=CLIM[0], vmax=CLIM[1], shading='nearest')
+    fig.colorbar(mesh, ax=ax, location='right')
+    ax.set_title((datetime(1850, 1, 1) + timedelta(days=day)).strftime('%Y-%m-%d'))
+    fig.savefig(png_path, dpi=dpi)
+    plt.close(fig)
+    return png_path
+
+def merged_quicklook_tasks(roi, overwrite=False):
+    """(function, args) render tasks of the merged LST GeoTIFFs of a ROI, sorted by date."""
+    merged_dir = roi_paths(roi)['merged']
+    out_dir = os.path.join(merged_dir, 'quicklook')
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = []
+    for path in sorted(glob.glob(os.path.join(merged_dir, 'LandsatERA5mergedLST_*.tif'))):
+        match = re.search(r'(\d{4}-\d{2}-\d{2})\.tif$', path)
+        if not match:
+            continue
+        png_path = os.path.join(out_dir, os.path.basename(path)[:-len('.tif')] + '.png')
+        tasks.append((render_merged, (path, png_path, f"{roi} {match.group(1)}", max_pixels, dpi),
+                      png_path, overwrite or not os.path.exists(png_path)))
+    return tasks
+
+def era5_quicklook_tasks(nc_paths, out_dir, overwrite=False):
+    """(function, args) render tasks of every time step of ERA5 downscaled files."""
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = []
+    for nc_path in nc_paths:
+        with netCDF4.Dataset(nc_path) as ds:
+            days = np.asarray(ds.variables['time'][:], dtype=np.float64)
+        for j, day in enumerate(days):
+            date_str = (datetime(1850, 1, 1) + timedelta(days=float(day))).strftime('%Y-%m-%d')
+            png_path = os.path.join(out_dir, f"{date_str}.png")
+            tasks.append((render_era5, (nc_path, j, png_path, max_pixels, dpi),
+                          png_path, overwrite or not os.path.exists(png_path)))
+    return tasks
+
+def _run_task(function, args):
+    return function(*args)
+
+def render_frames(tasks, max_workers=4, progress=None, failed=None):
+    """
+    Render tasks in a process pool and yield the frame paths in task order.
+
+    Frames that exist (and are not to be overwritten) are yielded without rendering.
+    Only the paths are kept, so the frames can be streamed into an animation. Frames
+    that fail are not yielded but appended to failed; progress (a tqdm bar) is advanced
+    for every task, failed or not.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_run_task, function, args) if todo else None
+                   for function, args, _, todo in tasks]
+        for (function, args, png_path, _), future in zip(tasks, futures):
+            try:
+                result = png_path if future is None else future.result()
+            except Exception as e:
+                print(f"Error rendering {png_path}: {e}", file=sys.stderr)
+                if failed is not None:
+                    failed.append(png_path)
+                result = None
+            if progress is not None:
+                progress.update(1)
+            if result is not None:
+                yield result
+
+def animation_extension(preferred="mp4"):
+    """File extension of the animation: mp4 if imageio-ffmpeg is installed, otherwise gif."""
+    if preferred == "mp4":
+        try:
+            import imageio_ffmpeg  # noqa: F401
+        except ImportError:
+            print("Warning: imageio-ffmpeg is not installed, writing a GIF (all frames are kept "
+                  "in memory until the file is closed)", file=sys.stderr)
+            return "gif"
+    return preferred
+
+def write_animation(frame_paths, output_path, fps=8):
+    """
+    Append frames to an animation one by one.
+
+    MP4 frames are piped to ffmpeg as they arrive. GIF frames are buffered by the Pillow
+    writer until the file is closed, so long GIF animations need memory for every frame.
+
+    Returns:
+    --------
+    int
+        Number of frames written
+    """
+    import imageio.v2 as imageio
+    n = 0
+    # the Pillow GIF writer takes the frame duration in milliseconds
+    kwargs = {'duration': 1000 / fps, 'loop': 0} if output_path.lower().endswith('.gif') else {'fps': fps}
+    with imageio.get_writer(output_path, **kwargs) as writer:
+        for path in frame_paths:
+            writer.append_data(imageio.imread(path))
+            n += 1
+    return n
+
+def render_tasks(tasks, animation_path=None, max_workers=4, desc="Quicklooks"):
+    """
+    Render tasks and, given animation_path (without extension), stream the frames into an
+    animation.
+
+    Returns:
+    --------
+    list
+        Paths of the frames that failed to render
+    """
+    failed = []
+    with tqdm(total=len(tasks), desc=desc) as progress:
+        frames = render_frames(tasks, max_workers, progress, failed)
+        if animation_path and tasks:
+            output_path = f"{animation_path}.{animation_extension(animation_format)}"
+            n = write_animation(frames, output_path, fps)
+            print(f"Saved {n} frames to {output_path}")
+        else:
+            for _ in frames:
+                pass
+    if failed:
+        print(f"{len(failed)} of {len(tasks)} frames failed to render", file=sys.stderr)
+    return failed
+
+def render_roi(roi, max_workers=4, animate=True, overwrite=False):
+    """Render the merged LST quicklooks of a ROI and optionally stream them into an animation."""
+    tasks = merged_quicklook_tasks(roi, overwrite)
+    animation_path = os.path.join(roi_paths(roi)['merged'], f"LandsatERA5mergedLST_{roi}") if animate else None
+    return render_tasks(tasks, animation_path, max_workers, desc=f"Quicklooks {roi}")
+
+def render_era5_roi(roi, max_workers=4, animate=True, overwrite=False):
+    """Render every day of the ERA5 downscaled files of a ROI (era5downscaled_viewer.m)."""
+    out_dir = os.path.join(imfolder_era5, roi, 'quicklook')
+    tasks = era5_quicklook_tasks(era5_files(roi), out_dir, overwrite)
+    animation_path = os.path.join(imfolder_era5, roi, f"t2m_elvcorr_{roi}") if animate else None
+    return render_tasks(tasks, animation_path, max_workers, desc=f"ERA5 quicklooks {roi}")
+
+#%%
+if __name__ == "__main__":
+    max_workers = int(input("Enter number of worker processes (default 4): ") or "4")
+    failed = []
+    for roi in rois:
+        if os.path.isdir(roi_paths(roi)['merged']):
+            failed += render_roi(roi, max_workers, animation)
+        if era5_quicklooks and era5_files(roi):
+            failed += render_era5_roi(roi, max_workers, animation)
+    if failed:
+        print(f"{len(failed)} frames failed to render in total", file=sys.stderr)
@@ -0,0 +1,269 @@
+"""
+Pixel time-series queries over the merged Landsat/ERA5 LST archive of LST_generator.py.
+
+query_timeseries returns the calibrated merged LST (°C) and the source flag (0 water,
+1 Landsat, 2 ERA5) at a point given in lon/lat or EPSG:3413, optionally averaged over a
+circular buffer, for a date range. Data are read from, in order of preference:
+1. the time-series store LandsatERA5mergedLST_<roi>_timeseries.nc, a copy of the datacube
+   chunked for time-series access (all days of a 16 x 16 pixel block in a few chunks),
+   built and updated with build_timeseries_store
+2. the datacube LandsatERA5mergedLST_<roi>.nc (chunked for maps)
+3. the daily GeoTIFFs (one windowed read per day)
+
+Command line use:
+    python lst_timeseries.py Zackenberg --lon -20.55 --lat 74.47 --start 2000-01-01 --end 2024-12-31 --buffer 60
+    python lst_timeseries.py Zackenberg --build
+"""
+#%%
+import os
+import re
+import sys
+import glob
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import netCDF4
+import rasterio
+from rasterio.windows import Window
+from pyproj import Transformer
+from tqdm import tqdm
+
+import LST_generator
+from LST_generator import MergedCube, roi_paths, ST_SCALE, ST_OFFSET, KELVIN, EPOCH, OUTPUT_CRS
+
+FLAG_NAMES = {0: 'water', 1: 'landsat', 2: 'era5'}
+
+#%% functions
+def timeseries_store_path(roi):
+    """Path of the time-series store of a ROI."""
+    return roi_paths(roi)['cube'][:-len('.nc')] + '_timeseries.nc'
+
+def grid_from_coordinates(x, y):
+    """Geotransform of a grid from its cell-centre coordinates."""
+    dx, dy = x[1] - x[0], y[1] - y[0]
+    return rasterio.Affine(dx, 0, x[0] - dx / 2, 0, dy, y[0] - dy / 2)
+
+def build_timeseries_store(roi, chunk_time=2048, chunk_space=16, block_days=512, block_rows=64, verbose=True):
+    """
+    Create or update the time-series store of a ROI from its datacube.
+
+    The store has the same variables as the datacube but chunks of chunk_time days x
+    chunk_space x chunk_space pixels. The days are matched by date: everything from the
+    first day whose date or completeness differs from the datacube is copied, in blocks
+    of block_days x block_rows rows.
+
+    Returns:
+    --------
+    str
+        Path of the store
+    """
+    cube_path = roi_paths(roi)['cube']
+    store_path = timeseries_store_path(roi)
+    cube = MergedCube(cube_path, readonly=True)
+    try:
+        src = cube.ds
+        x, y = src.variables['x'][:], src.variables['y'][:]
+        store = MergedCube(store_path, grid_from_coordinates(x, y), (len(y), len(x)), chunk_time, chunk_space)
+        try:
+            dst = store.ds
+            n_days = len(src.variables['time'])
+            times = src.variables['time'][:]
+            written = src.variables['written'][:]
+            # Copy from the first day that is missing, was completed since the last update or
+            # moved: a backfill inserts earlier days when the datacube is sorted, shifting the
+            # positions of all later days
+            common = min(len(dst.variables['time']), n_days)
+            stale = np.flatnonzero((dst.variables['time'][:common] != times[:common]) |
+                                   (dst.variables['written'][:common] != written[:common]))
+            first = int(stale[0]) if len(stale) else common
+            if first < n_days:
+                dst.variables['time'][first:n_days] = times[first:n_days]
+                blocks = [(t0, r0) for t0 in range(first, n_days, block_days) for r0 in range(0, len(y), block_rows)]
+                for t0, r0 in tqdm(blocks, desc=f"Building {os.path.basename(store_path)}", disable=not verbose):
+                    t1, r1 = min(t0 + block_days, n_days), min(r0 + block_rows, len(y))
+                    for name in ('lst', 'flag'):
+                        dst.variables[name][t0:t1, r0:r1, :] = src.variables[name][t0:t1, r0:r1, :]
+                dst.variables['written'][first:n_days] = written[first:n_days]
+                dst.sync()
+        finally:
+            store.close()
+    finally:
+        cube.close()
+    return store_path
+
+def to_grid_coordinates(lon=None, lat=None, x=None, y=None):
+    """EPSG:3413 coordinates of a point given in lon/lat or directly in EPSG:3413."""
+    if x is not None and y is not None:
+        return float(x), float(y)
+    if lon is None or lat is None:
+        raise ValueError("Give either lon/lat or x/y (EPSG:3413)")
+    x, y = Transformer.from_crs('EPSG:4326', OUTPUT_CRS, always_xy=True).transform(lon, lat)
+    return float(x), float(y)
+
+def buffer_pixels(xs, ys, x, y, buffer=0):
+    """
+    Pixels of a grid within a circular buffer around a point.
+
+    Parameters:
+    -----------
+    xs, ys : numpy.ndarray
+        Cell-centre coordinates of the grid columns and rows
+    x, y : float
+        Point in the grid CRS
+    buffer : float
+        Radius in metres; 0 selects the pixel containing the point
+
+    Returns:
+    --------
+    tuple
+        (row slice, column slice, boolean mask of the pixels inside the buffer)
+    """
+    dx, dy = abs(xs[1] - xs[0]), abs(ys[1] - ys[0])
+    col = int(np.argmin(np.abs(xs - x)))
+    row = int(np.argmin(np.abs(ys - y)))
+    if abs(xs[col] - x) > dx / 2 + 1e-6 or abs(ys[row] - y) > dy / 2 + 1e-6:
+        raise ValueError(f"Point ({x:.0f}, {y:.0f}) is outside the grid")
+    if buffer <= 0:
+        return slice(row, row + 1), slice(col, col + 1), np.ones((1, 1), dtype=bool)
+    half_cols, half_rows = int(np.ceil(buffer / dx)), int(np.ceil(buffer / dy))
+    rows = slice(max(row - half_rows, 0), min(row + half_rows + 1, len(ys)))
+    cols = slice(max(col - half_cols, 0), min(col + half_cols + 1, len(xs)))
+    xx, yy = np.meshgrid(xs[cols], ys[rows])
+    inside = (xx - x) ** 2 + (yy - y) ** 2 <= buffer ** 2
+    inside[row - rows.start, col - cols.start] = True
+    return rows, cols, inside
+
+def summarise(dates, dn, flag, inside, centre):
+    """Turn DN/flag stacks (day x pixel window) into the output DataFrame."""
+    lst = dn.astype(np.float64) * ST_SCALE + ST_OFFSET - KELVIN
+    lst[dn == 0] = np.nan
+    lst = np.where(inside, lst, np.nan)
+    land = inside & (flag != 0)
+    n_land = land.sum(axis=(1, 2))
+    lst = lst.reshape(len(dates), inside.size)
+    n_valid = np.count_nonzero(~np.isnan(lst), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = np.where(n_valid > 0, np.nansum(lst, axis=1) / n_valid, np.nan)
+        landsat_fraction = np.where(n_land > 0, (inside & (flag == 1)).sum(axis=(1, 2)) / n_land, np.nan)
+    centre_flag = flag[:, centre[0], centre[1]].astype(int)
+    return pd.DataFrame({'date': pd.to_datetime(dates), 'lst': values,
+                         'flag': centre_flag, 'source': [FLAG_NAMES.get(f, 'missing') for f in centre_flag],
+                         'landsat_fraction': landsat_fraction, 'pixels': int(inside.sum())})
+
+def query_store(path, x, y, buffer, start, end):
+    """Query a datacube or time-series store (both have the MergedCube layout)."""
+    with netCDF4.Dataset(path) as ds:
+        ds.set_auto_maskandscale(False)
+        xs, ys = ds.variables['x'][:], ds.variables['y'][:]
+        rows, cols, inside = buffer_pixels(xs, ys, x, y, buffer)
+        days = ds.variables['time'][:]
+        written = ds.variables['written'][:] == 1
+        # The time axis is appended in runs, select the days by value
+        selected = written & (days >= start) & (days <= end)
+        idx = np.flatnonzero(selected)
+        if len(idx) == 0:
+            dn = np.zeros((0,) + inside.shape, dtype=np.uint16)
+            flag = np.zeros_like(dn, dtype=np.uint8)
+        else:
+            t0, t1 = idx[0], idx[-1] + 1
+            dn = ds.variables['lst'][t0:t1, rows, cols][selected[t0:t1]]
+            flag = ds.variables['flag'][t0:t1, rows, cols][selected[t0:t1]]
+        dates = [EPOCH + timedelta(days=int(d)) for d in days[idx]]
+    order = np.argsort(days[idx], kind='stable')
+    centre = (int(np.argmin(np.abs(ys[rows] - y))), int(np.argmin(np.abs(xs[cols] - x))))
+    return summarise([dates[i] for i in order], dn[order], flag[order], inside, centre)
+
+def query_geotiffs(roi, x, y, buffer, start, end):
+    """Query the daily GeoTIFFs (slow fallback, one windowed read per day)."""
+    files = {}
+    for path in glob.glob(os.path.join(roi_paths(roi)['merged'], 'LandsatERA5mergedLST_*.tif')):
+        match = re.search(r'(\d{4}-\d{2}-\d{2})\.tif$', path)
+        if match:
+            day = (datetime.strptime(match.group(1), '%Y-%m-%d') - EPOCH).days
+            if start <= day <= end:
+                files[day] = path
+    if not files:
+        return summarise([], np.zeros((0, 1, 1), np.uint16), np.zeros((0, 1, 1), np.uint8),
+                         np.ones((1, 1), bool), (0, 0))
+    with rasterio.open(next(iter(files.values()))) as src:
+        t = src.transform
+        xs = t.c + (np.arange(src.width) + 0.5) * t.a
+        ys = t.f + (np.arange(src.height) + 0.5) * t.e
+    rows, cols, inside = buffer_pixels(xs, ys, x, y, buffer)
+    window = Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+    days = sorted(files)
+    dn = np.zeros((len(days),) + inside.shape, dtype=np.uint16)
+    flag = np.zeros_like(dn)
+    for i, day in enumerate(days):
+        with rasterio.open(files[day]) as src:
+            dn[i], flag[i] = src.read(window=window)
+    centre = (int(np.argmin(np.abs(ys[rows] - y))), int(np.argmin(np.abs(xs[cols] - x))))
+    return summarise([EPOCH + timedelta(days=d) for d in days], dn, flag, inside, centre)
+
+def query_timeseries(roi, lon=None, lat=None, x=None, y=None, buffer=0, start=None, end=None, source='auto'):
+    """
+    Merged LST time series at a point.
+
+    Parameters:
+    -----------
+    roi : str
+        ROI name (as in LST_generator.rois)
+    lon, lat : float, optional
+        Point in degrees
+    x, y : float, optional
+        Point in EPSG:3413 (instead of lon/lat)
+    buffer : float
+        Radius in metres of a circular buffer to average over (0: single pixel)
+    start, end : str, optional
+        Date range (inclusive), e.g. '2000-01-01'
+    source : str
+        'auto' (time-series store, datacube, GeoTIFFs - whichever exists first),
+        'timeseries', 'cube' or 'geotiff'
+
+    Returns:
+    --------
+    pandas.DataFrame
+        date, lst (°C, mean over the buffer), flag and source of the centre pixel,
+        landsat_fraction (share of the land pixels in the buffer from Landsat), pixels
+    """
+    x, y = to_grid_coordinates(lon, lat, x, y)
+    start = (pd.Timestamp(start) - pd.Timestamp(EPOCH)).days if start else -10 ** 6
+    end = (pd.Timestamp(end) - pd.Timestamp(EPOCH)).days if end else 10 ** 6
+    stores = {'timeseries': timeseries_store_path(roi), 'cube': roi_paths(roi)['cube']}
+    if source == 'auto':
+        source = next((name for name, path in stores.items() if os.path.exists(path)), 'geotiff')
+    if source == 'geotiff':
+        return query_geotiffs(roi, x, y, buffer, start, end)
+    return query_store(stores[source], x, y, buffer, start, end)
+
+#%%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merged LST time series at a point")
+    parser.add_argument('roi', help="ROI name, e.g. Zackenberg")
+    parser.add_argument('--lon', type=float)
+    parser.add_argument('--lat', type=float)
+    parser.add_argument('--x', type=float, help="EPSG:3413 easting (instead of --lon)")
+    parser.add_argument('--y', type=float, help="EPSG:3413 northing (instead of --lat)")
+    parser.add_argument('--buffer', type=float, default=0, help="buffer radius in metres")
+    parser.add_argument('--start', help="first date, YYYY-MM-DD")
+    parser.add_argument('--end', help="last date, YYYY-MM-DD")
+    parser.add_argument('--source', default='auto', choices=['auto', 'timeseries', 'cube', 'geotiff'])
+    parser.add_argument('--merged-folder', help="folder of the merged LST (default: imfolder_merged of LST_generator.py)")
+    parser.add_argument('--build', action='store_true', help="create/update the time-series store and exit")
+    parser.add_argument('--output', help="write the series to this CSV file instead of printing it")
+    args = parser.parse_args()
+
+    if args.merged_folder:
+        LST_generator.imfolder_merged = args.merged_folder
+    if args.build:
+        print(f"Time-series store: {build_timeseries_store(args.roi)}")
+        sys.exit(0)
+
+    df = query_timeseries(args.roi, args.lon, args.lat, args.x, args.y, args.buffer, args.start, args.end, args.source)
+    if args.output:
+        df.to_csv(args.output, index=False)
+        print(f"Saved {len(df)} days to {args.output}")
+    else:
+        print(df.to_string(index=False))
@@ -0,0 +1,104 @@
+"""Checks of LST_generator.py on a small synthetic ROI (run with pytest)."""
+import os
+
+import numpy as np
+import pytest
+import rasterio
+import netCDF4
+from pyproj import Transformer
+
+import LST_generator
+
+HEIGHT, WIDTH = 40, 30
+TRANSFORM = rasterio.Affine(30, 0, -300000, 0, -30, -2000000)
+ROI = 'Test'
+DATES = ['2020-07-01', '2020-07-02']
+
+def write_raster(path, array):
+    with rasterio.open(path, 'w', driver='GTiff', height=HEIGHT, width=WIDTH, count=1, dtype=array.dtype,
+                       crs='EPSG:3413', transform=TRANSFORM) as dst:
+        dst.write(array, 1)
+
+def make_roi(root, era5_grid):
+    """
+    Landmask, one Landsat day and an ERA5 file of two days. era5_grid "coarse" is a 9 x 12
+    lon/lat grid around the ROI, "same" a grid of the landmask shape stored south first.
+    """
+    rng = np.random.default_rng(1)
+    for folder in ('landmask', f'LandsatLST/{ROI}', f'era5downscaled/{ROI}', f'mergedLST/{ROI}'):
+        os.makedirs(root / folder, exist_ok=True)
+    write_raster(root / 'landmask' / f'GreenlandMask_{ROI}.tif', (rng.random((HEIGHT, WIDTH)) > 0.3).astype(np.uint8))
+    landsat = rng.integers(38000, 42000, (HEIGHT, WIDTH)).astype(np.uint16)
+    landsat[:10] = 0
+    write_raster(root / f'LandsatLST/{ROI}' / f'GEMLST_Landsat_{DATES[1]}.tif', landsat)
+
+    x0, y0 = TRANSFORM.c, TRANSFORM.f
+    if era5_grid == 'coarse':
+        xs = np.linspace(x0 - 3000, x0 + 30 * WIDTH + 3000, 12)
+        ys = np.linspace(y0 + 3000, y0 - 30 * HEIGHT - 3000, 9)
+    else:
+        xs = x0 + (np.arange(WIDTH) + 0.5) * 30
+        ys = (y0 - (np.arange(HEIGHT) + 0.5) * 30)[::-1]
+    lon, lat = Transformer.from_crs('EPSG:3413', 'EPSG:4326', always_xy=True).transform(*np.meshgrid(xs, ys))
+    with netCDF4.Dataset(root / f'era5downscaled/{ROI}' / 't2m_elvcorr_2020_07.nc', 'w') as ds:
+        ds.createDimension('time', len(DATES))
+        ds.createDimension('Y', len(ys))
+        ds.createDimension('X', len(xs))
+        ds.createVariable('time', 'f8', ('time',))[:] = [62273, 62274]   # days since 1850-01-01
+        ds.createVariable('t2m', 'f4', ('time', 'Y', 'X'))[:] = 270 + 10 * rng.random((len(DATES), len(ys), len(xs)))
+        ds.createVariable('X', 'f8', ('Y', 'X'))[:] = lon
+        ds.createVariable('Y', 'f8', ('Y', 'X'))[:] = lat
+
+def read_outputs(root):
+    outputs = {}
+    for date_str in DATES:
+        with rasterio.open(root / f'mergedLST/{ROI}' / f'LandsatERA5mergedLST_{date_str}.tif') as src:
+            outputs[date_str] = src.read()
+    return outputs
+
+@pytest.mark.parametrize('era5_grid', ['coarse', 'same'])
+def test_tiled_matches_whole_day(tmp_path, monkeypatch, era5_grid):
+    make_roi(tmp_path, era5_grid)
+    monkeypatch.setattr(LST_generator, 'imfolder_landmask', str(tmp_path / 'landmask'))
+    monkeypatch.setattr(LST_generator, 'imfolder_landsat', str(tmp_path / 'LandsatLST'))
+    monkeypatch.setattr(LST_generator, 'imfolder_era5', str(tmp_path / 'era5downscaled'))
+    monkeypatch.setattr(LST_generator, 'imfolder_merged', str(tmp_path / 'mergedLST'))
+
+    results = LST_generator.run_generator([ROI], 2, overwrite=True, cache_dir=str(tmp_path / 'whole'))
+    assert all(r[2] is not None for r in results)
+    whole = read_outputs(tmp_path)
+    results = LST_generator.run_generator([ROI], 2, overwrite=True, cache_dir=str(tmp_path / 'tiled'), tile_size=16)
+    assert all(r[2] is not None for r in results)
+    tiled = read_outputs(tmp_path)
+
+    for date_str in DATES:
+        np.testing.assert_array_equal(tiled[date_str], whole[date_str])
+    if era5_grid == 'same':
+        # no regridding, so no index maps
+        assert not os.path.exists(tmp_path / 'tiled') or not os.listdir(tmp_path / 'tiled')
+
+def test_cube_sorted_on_close_but_not_by_queries(tmp_path):
+    path = str(tmp_path / 'cube.nc')
+    cube = LST_generator.MergedCube(path, TRANSFORM, (HEIGHT, WIDTH), chunk_time=4, chunk_space=16)
+    for date_str, i in cube.reserve(['2020-07-05', '2020-07-06']).items():
+        cube.write(i, np.full((HEIGHT, WIDTH), int(date_str[-2:]), np.uint16), np.ones((HEIGHT, WIDTH), np.uint8))
+        cube.mark_written(i)
+    cube.close()
+    # backfill interrupted before close(): the file is left out of order
+    cube = LST_generator.MergedCube(path)
+    for date_str, i in cube.reserve(['2020-07-01']).items():
+        cube.write(i, np.full((HEIGHT, WIDTH), 1, np.uint16), np.ones((HEIGHT, WIDTH), np.uint8))
+        cube.mark_written(i)
+    cube.ds.close()
+
+    inode = os.stat(path).st_ino
+    assert LST_generator.cube_written_dates(path) == {'2020-07-01', '2020-07-05', '2020-07-06'}
+    assert os.stat(path).st_ino == inode
+    with netCDF4.Dataset(path) as ds:
+        assert list(np.diff(ds.variables['time'][:]) > 0) == [True, False]
+
+    LST_generator.MergedCube(path).close()
+    with netCDF4.Dataset(path) as ds:
+        ds.set_auto_maskandscale(False)
+        assert list(ds.variables['lst'][:, 0, 0]) == [1, 5, 6]
+        assert list(ds.variables['written'][:]) == [1, 1, 1]
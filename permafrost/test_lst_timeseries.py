@@ -0,0 +1,52 @@
+"""Checks of the time-series store of lst_timeseries.py against the datacube (run with pytest)."""
+import numpy as np
+import pandas as pd
+import netCDF4
+import rasterio
+
+import LST_generator
+from LST_generator import MergedCube
+from lst_timeseries import build_timeseries_store, timeseries_store_path, query_timeseries
+
+TRANSFORM = rasterio.Affine(30, 0, -300000, 0, -30, -2000000)
+SHAPE = (8, 6)
+
+def write_days(path, dates):
+    """Write days to the datacube with a DN that encodes the date and the pixel."""
+    cube = MergedCube(path, TRANSFORM, SHAPE, chunk_time=4, chunk_space=4)
+    try:
+        for date_str, i in cube.reserve(dates).items():
+            day = (pd.Timestamp(date_str) - pd.Timestamp(LST_generator.EPOCH)).days
+            dn = (day % 1000) * 10 + np.arange(np.prod(SHAPE), dtype=np.uint16).reshape(SHAPE) % 10 + 1
+            cube.write(i, dn.astype(np.uint16), np.full(SHAPE, 2, dtype=np.uint8))
+            cube.mark_written(i)
+    finally:
+        cube.close()
+
+def read_cube(path):
+    with netCDF4.Dataset(path) as ds:
+        ds.set_auto_maskandscale(False)
+        return {name: ds.variables[name][:] for name in ('time', 'written', 'lst', 'flag')}
+
+def test_store_follows_backfilled_cube(tmp_path, monkeypatch):
+    monkeypatch.setattr(LST_generator, 'imfolder_merged', str(tmp_path))
+    roi = 'Test'
+    (tmp_path / roi).mkdir()
+    cube_path = LST_generator.roi_paths(roi)['cube']
+
+    write_days(cube_path, [str(d.date()) for d in pd.date_range('2001-01-01', '2001-01-05')])
+    build_timeseries_store(roi, chunk_time=4, chunk_space=4, block_days=3, block_rows=5, verbose=False)
+    # backfill: the earlier days are sorted in front of the existing ones
+    write_days(cube_path, [str(d.date()) for d in pd.date_range('2000-12-27', '2000-12-31')])
+    build_timeseries_store(roi, chunk_time=4, chunk_space=4, block_days=3, block_rows=5, verbose=False)
+
+    cube, store = read_cube(cube_path), read_cube(timeseries_store_path(roi))
+    assert np.all(np.diff(cube['time']) == 1) and len(cube['time']) == 10
+    for name in ('time', 'written', 'lst', 'flag'):
+        np.testing.assert_array_equal(store[name], cube[name])
+
+    x = TRANSFORM.c + 2.5 * TRANSFORM.a
+    y = TRANSFORM.f + 3.5 * TRANSFORM.e
+    series = {source: query_timeseries(roi, x=x, y=y, source=source) for source in ('timeseries', 'cube')}
+    assert len(series['timeseries']) == 10
+    pd.testing.assert_frame_equal(series['timeseries'], series['cube'])